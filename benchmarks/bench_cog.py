@@ -0,0 +1,97 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Benchmark of Cloud Optimized GeoTIFF output (-c) against the standard GeoTIFF output of the warp stage.
+
+Compares, for one warped frame:
+- plain:         warp_image_to_geotiff without -c (tiled=False, uncompressed GTiff);
+- cog_translate: the former approach, a plain GeoTIFF rewritten in place by rio-cogeo's cog_translate
+                 (single-threaded, in memory);
+- direct COG:    warp_image_to_geotiff with -c, written once by the GDAL COG driver with multithreaded
+                 overviews.
+
+Usage:
+    python benchmarks/bench_cog.py [--width 5472] [--height 3648] [--repeat 3]
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from shapely.geometry import Polygon
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from Utils import config  # noqa: E402
+from Utils.raster_utils import warp_image_to_geotiff  # noqa: E402
+from bench_warp import synthetic_footprint  # noqa: E402
+
+
+def cog_translate_rewrite(geotiff_file):
+    from rio_cogeo.cogeo import cog_translate
+    from rio_cogeo.profiles import cog_profiles
+    cog_translate(geotiff_file, geotiff_file, cog_profiles.get("deflate"), in_memory=True, quiet=True)
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=5472, help="Image width in pixels.")
+    parser.add_argument("--height", type=int, default=3648, help="Image height in pixels.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per method (best is reported).")
+    args = parser.parse_args()
+
+    config.update_epsg(4326)
+    # A smooth image compresses like aerial imagery rather than like noise.
+    y, x = np.mgrid[0:args.height, 0:args.width]
+    image = np.stack([(x // 7) % 256, (y // 5) % 256, ((x + y) // 11) % 256], axis=-1).astype(np.uint8)
+    coordinate_array = synthetic_footprint(4326)
+    polygon = Polygon(coordinate_array)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output = str(Path(tmp) / "out.tif")
+
+        def plain():
+            config.update_cog(False)
+            warp_image_to_geotiff(image, output, polygon, coordinate_array)
+
+        def rewrite():
+            plain()
+            cog_translate_rewrite(output)
+
+        def direct():
+            config.update_cog(True)
+            warp_image_to_geotiff(image, output, polygon, coordinate_array)
+
+        results = {}
+        for name, function in (("plain", plain), ("cog_translate", rewrite), ("direct COG", direct)):
+            results[name] = best_time(function, args.repeat)
+            with rasterio.open(output) as dataset:
+                layout = dataset.tags(ns="IMAGE_STRUCTURE").get("LAYOUT", "-")
+                overviews = len(dataset.overviews(1))
+            results[name] = (results[name], Path(output).stat().st_size / 2 ** 20, layout, overviews)
+
+    print(f"image: {args.width}x{args.height} RGB, repeat: {args.repeat}")
+    print(f"{'method':<14} {'best s':>8} {'size MB':>8} {'layout':>8} {'overviews':>10}")
+    for name, (seconds, size, layout, overviews) in results.items():
+        print(f"{name:<14} {seconds:8.3f} {size:8.1f} {layout:>8} {overviews:>10}")
+
+
+if __name__ == "__main__":
+    main()
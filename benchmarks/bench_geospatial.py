@@ -0,0 +1,88 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Microbenchmark of the per-image coordinate conversions done by HighAccuracyFOVCalculator.get_fov_bbox.
+
+Compares the previous approach, which built new CRS and Transformer objects on every call, with the cached
+transformer registry and bulk transforms of Utils.geospatial_conversions.
+
+Usage:
+    python benchmarks/bench_geospatial.py [--images 500] [--epsg 32612]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from pyproj import CRS, Transformer
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from Utils import config  # noqa: E402
+from Utils.geospatial_conversions import find_geodetic_intersections, gps_to_utm, translate_to_wgs84  # noqa: E402
+
+
+def legacy_image_conversions(offsets, lon, lat, epsg_code):
+    """The conversions of one image as performed before the transformer registry existed."""
+    zone_number = int((lon + 180) / 6) + 1
+    utm = CRS(proj="utm", zone=zone_number, ellps="WGS84", datum="WGS84", south=lat < 0)
+    wgs84 = CRS(proj="latlong", datum="WGS84")
+    utmx, utmy = Transformer.from_crs(wgs84, utm, always_xy=True).transform(lon, lat)
+
+    hemisphere = "north" if lat >= 0 else "south"
+    crs_utm = f"+proj=utm +zone={zone_number} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
+    to_utm = Transformer.from_crs("epsg:4326", crs_utm, always_xy=True)
+    to_geo = Transformer.from_crs(crs_utm, epsg_code, always_xy=True)
+    drone_easting, drone_northing = to_utm.transform(lon, lat)
+    bbox = []
+    for x, y in offsets:
+        easting, northing = drone_easting + x, drone_northing + y
+        to_geo.transform(easting, northing)
+        bbox.append((easting, northing))
+
+    to_out = Transformer.from_crs(crs_utm, f"epsg:{epsg_code}", always_xy=True)
+    to_dd = Transformer.from_crs(crs_utm, "epsg:4326", always_xy=True)
+    return [to_out.transform(x, y) for x, y in bbox], [to_dd.transform(x, y) for x, y in bbox]
+
+
+def registry_image_conversions(offsets, lon, lat):
+    gps_to_utm(lat, lon)
+    bbox = find_geodetic_intersections(offsets, lon, lat)
+    return translate_to_wgs84(bbox, lon, lat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=500, help="Number of simulated images.")
+    parser.add_argument("--epsg", type=int, default=32612, help="Output EPSG code.")
+    args = parser.parse_args()
+
+    config.update_epsg(args.epsg)
+    rng = np.random.default_rng(0)
+    lons = -111.0 + rng.uniform(0, 0.01, args.images)
+    lats = 45.0 + rng.uniform(0, 0.01, args.images)
+    offsets = rng.uniform(-80, 80, (args.images, 4, 2))
+
+    start = time.perf_counter()
+    for i in range(args.images):
+        legacy_image_conversions(offsets[i], lons[i], lats[i], args.epsg)
+    legacy = (time.perf_counter() - start) / args.images
+
+    start = time.perf_counter()
+    for i in range(args.images):
+        registry_image_conversions(offsets[i], lons[i], lats[i])
+    registry = (time.perf_counter() - start) / args.images
+
+    print(f"images: {args.images}, output EPSG: {args.epsg}")
+    print(f"per-call transformers : {legacy * 1e3:8.3f} ms/image")
+    print(f"transformer registry  : {registry * 1e3:8.3f} ms/image")
+    print(f"speedup               : {legacy / registry:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Startup-time check of the command line interface.
+
+Runs `python -X importtime src/Drone_Footprints.py --help` in a fresh interpreter, reports the wall time and
+the slowest imports, and fails when:
+- a heavy module (OpenCV, rasterio, lensfun, pandas, ...) is imported just to print the help, or
+- the best wall time of the runs exceeds the budget.
+
+The heavy modules are loaded by the stages that need them (metadata processing, GeoTIFF creation, the
+mosaic), so they must not appear on the --help path.
+
+Usage:
+    python benchmarks/bench_import_time.py [--repeat 5] [--budget 600] [--top 15]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parents[1] / "src" / "Drone_Footprints.py"
+# Top-level packages that must not be imported by `--help`.
+HEAVY_MODULES = ("cv2", "rasterio", "lensfunpy", "skimage", "scipy", "pandas", "shapely", "rio_cogeo", "pyproj",
+                 "geojson", "geojson_rewind", "magnetismi", "meta_data", "imagedrone", "create_geotiffs",
+                 "new_fov", "Utils.raster_utils", "Utils.lens_correction", "Utils.mosaic",
+                 "Utils.mission_vrt", "Utils.footprint_sinks", "pyarrow")
+
+
+def run_help() -> tuple[float, str]:
+    """Run the CLI once; returns the wall time in seconds and the -X importtime report."""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", str(SCRIPT), "--help"], cwd=SCRIPT.parent,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.exit(f"{SCRIPT.name} --help failed:\n{result.stderr}")
+    return elapsed, result.stderr
+
+
+def parse_importtime(report: str) -> list[tuple[str, int, int, int]]:
+    """
+    Parse a -X importtime report.
+
+    Returns:
+    - list[tuple]: (module, self time in us, cumulative time in us, nesting level) for each import.
+    """
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), level))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs (best is reported).")
+    parser.add_argument("--budget", type=float, default=600, help="Wall time budget of --help in milliseconds.")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to list.")
+    args = parser.parse_args()
+
+    runs = [run_help() for _ in range(max(1, args.repeat))]
+    best, report = min(runs, key=lambda run: run[0])
+    imports = parse_importtime(report)
+
+    top_level = sorted((item for item in imports if item[3] == 0), key=lambda item: item[2], reverse=True)
+    print(f"{'module':<40}{'cumulative ms':>15}{'self ms':>10}")
+    for name, self_us, cumulative_us, _ in top_level[:args.top]:
+        print(f"{name:<40}{cumulative_us / 1000:>15.1f}{self_us / 1000:>10.1f}")
+    total = sum(item[2] for item in top_level) / 1000
+    print(f"\nImports: {len(imports)} modules, {total:.1f} ms; best wall time of {len(runs)} runs: "
+          f"{best * 1000:.0f} ms (budget {args.budget:.0f} ms).")
+
+    imported = {item[0] for item in imports}
+    heavy = sorted(module for module in HEAVY_MODULES
+                   if module in imported or any(name.startswith(module + ".") for name in imported))
+    failed = False
+    if heavy:
+        print(f"FAIL: heavy modules imported by --help: {', '.join(heavy)}")
+        failed = True
+    if best * 1000 > args.budget:
+        print(f"FAIL: --help took {best * 1000:.0f} ms, over the {args.budget:.0f} ms budget.")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
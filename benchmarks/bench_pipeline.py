@@ -0,0 +1,377 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Benchmark suite of the processing pipeline on a synthetic flight (see synthetic_flight.py), offline.
+
+Each stage is timed on its own, then the whole pipeline end to end:
+- metadata:               Drone_Footprints.get_metadata (skipped when ExifTool is not installed);
+- imagedrone:             ImageDrone construction from the metadata;
+- fov:                    HighAccuracyFOVCalculator.get_fov_bbox, without elevation data;
+- elevation:              DSM loading and the point lookups of the footprint (centre and corners);
+- decode:                 cv2.imread of the frames;
+- lens_correction:        undistort_image;
+- warp_image_to_polygon,
+  array2ds,
+  warp_to_geotiff_file:   the former two-resampling warp, step by step (kept in bench_warp.py);
+- warp_image_to_geotiff:  the direct warp used by create_geotiffs;
+- end_to_end:             meta_data.process_metadata with the DSM, writing GeoTIFFs;
+- end_to_end_footprints:  the same with --footprints_only;
+- mosaic, mosaic_cog:     Utils.mosaic.build_mosaic of the GeoTIFFs of the flight, written as plain GeoTIFFs or as
+                          COGs (-c) by an untimed end-to-end run.
+
+Raster stages use the first --raster-frames frames. Every stage runs --repeat times, each time in a fresh
+process so that caches start cold and the peak resident memory (ru_maxrss, Unix only) belongs to that stage;
+the best time and the highest peak memory are kept. Results are written to a JSON file that a later run can
+be compared with (--baseline): stages slower than the tolerance make the run exit with status 1. The run also
+exits with status 1 when the mosaic of COGs is more than MOSAIC_COG_RATIO times slower than that of plain GeoTIFFs.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--count 20] [--width 4000] [--height 3000] [--format jpg]
+        [--heading 0] [--gimbal-pitch -90] [--raster-frames 5] [--repeat 3] [--workers 1]
+        [--stages fov elevation ...] [--flight-dir DIR]
+        [--output bench_pipeline.json] [--baseline OLD.json] [--tolerance 0.1]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+sys.path.insert(0, str(SRC))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synthetic_flight import generate_flight  # noqa: E402
+
+STAGES = ("metadata", "imagedrone", "fov", "elevation", "decode", "lens_correction", "warp_image_to_polygon",
+          "array2ds", "warp_to_geotiff_file", "warp_image_to_geotiff", "end_to_end", "end_to_end_footprints",
+          "mosaic", "mosaic_cog")
+RASTER_STAGES = ("decode", "lens_correction", "warp_image_to_polygon", "array2ds", "warp_to_geotiff_file",
+                 "warp_image_to_geotiff")
+# Reading COG sources is a little slower than plain GeoTIFFs (compressed blocks), not tens of times.
+MOSAIC_COG_RATIO: float = 3.0
+
+
+def rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+class StageTimer:
+    """Accumulates the time of the measured sections of a stage, leaving its setup out."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.rss_before = None
+
+    def __enter__(self):
+        if self.rss_before is None:
+            self.rss_before = rss_mb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds += time.perf_counter() - self.start
+
+
+def prepared_images(metadata, sensor_dimensions, with_footprints=False):
+    """ImageDrone objects of the flight and their unit offsets; with footprints, get_fov_bbox has run on them."""
+    from meta_data import prepare_images
+    from new_fov import HighAccuracyFOVCalculator
+
+    images, unit_offsets = prepare_images(metadata, sensor_dimensions)
+    if with_footprints:
+        for image, offsets in zip(images, unit_offsets):
+            image.coord_array, image.footprint_coordinates = HighAccuracyFOVCalculator(image, offsets).get_fov_bbox()
+    return images, unit_offsets
+
+
+def run_raster_stage(stage, images, timer, output_dir):
+    """Run a per-frame raster stage; decoding and the inputs made by earlier steps are setup, not timed."""
+    import cv2
+    from shapely.geometry import Polygon
+    from Utils.lens_correction import undistort_image
+    from Utils.raster_utils import warp_image_to_geotiff
+    from bench_warp import array2ds, warp_image_to_polygon, warp_to_geotiff_file
+
+    for image in images:
+        geotiff_file = str(Path(output_dir) / f"{Path(image.file_name).stem}.tif")
+        if stage == "decode":
+            with timer:
+                cv2.imread(image.metadata["SourceFile"], cv2.IMREAD_UNCHANGED)
+            continue
+        array = cv2.imread(image.metadata["SourceFile"], cv2.IMREAD_UNCHANGED)
+        if stage == "lens_correction":
+            with timer:
+                undistort_image(image, array)
+            continue
+        array = cv2.cvtColor(array, cv2.COLOR_BGR2RGB)
+        polygon = Polygon(image.coord_array)
+        if stage == "warp_image_to_geotiff":
+            with timer:
+                warp_image_to_geotiff(array, geotiff_file, polygon, image.coord_array)
+            continue
+        if stage == "warp_image_to_polygon":
+            with timer:
+                warp_image_to_polygon(array, polygon, image.coord_array)
+            continue
+        warped = warp_image_to_polygon(array, polygon, image.coord_array)
+        if stage == "array2ds":
+            with timer:
+                array2ds(warped, str(polygon)).close()
+            continue
+        dataset = array2ds(warped, str(polygon))
+        with timer:
+            warp_to_geotiff_file(geotiff_file, dataset)
+        dataset.close()
+
+
+def run_stage(stage, flight, raster_frames, workers, epsg):
+    """
+    Run one stage in the current process.
+
+    Returns:
+    dict: seconds, images, megapixels and memory of the stage, or the reason it was skipped.
+    """
+    from Utils import config
+    from Utils.utils import read_sensor_dimensions_from_csv
+
+    config.update_epsg(epsg)
+    config.update_workers(workers)
+    sensor_dimensions = read_sensor_dimensions_from_csv(SRC / "drone_sensors.csv", None, None)
+    metadata = flight["metadata"]
+    parameters = flight["parameters"]
+    files = [Path(data["SourceFile"]) for data in metadata]
+    timer = StageTimer()
+    images = len(metadata)
+    extra = {}
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        if stage == "metadata":
+            if shutil.which("exiftool") is None:
+                return dict(skipped="ExifTool not found")
+            from Drone_Footprints import get_metadata
+            with timer:
+                extracted = [data for chunk in get_metadata(files) for data in chunk]
+            extra["extracted"] = len(extracted)
+        elif stage == "imagedrone":
+            from imagedrone import ImageDrone
+            with timer:
+                for data in metadata:
+                    ImageDrone(data, sensor_dimensions, config)
+        elif stage == "fov":
+            from new_fov import HighAccuracyFOVCalculator
+            prepared, unit_offsets = prepared_images(metadata, sensor_dimensions)
+            with timer:
+                for image, offsets in zip(prepared, unit_offsets):
+                    HighAccuracyFOVCalculator(image, offsets).get_fov_bbox()
+        elif stage == "elevation":
+            from new_fov import HighAccuracyFOVCalculator
+            from Utils.geospatial_conversions import gps_to_utm
+            from Utils.new_elevation import get_altitude_at_point, get_elevation_source
+            prepared, unit_offsets = prepared_images(metadata, sensor_dimensions)
+            points = []
+            for image, offsets in zip(prepared, unit_offsets):
+                utmx, utmy = gps_to_utm(image.latitude, image.longitude)[:2]
+                corners = HighAccuracyFOVCalculator(image, offsets).get_footprint_utm(image.relative_altitude)
+                points.append((image, [(utmx, utmy)] + [tuple(corner[:2]) for corner in corners]))
+            config.update_dtm(flight["dsm"])
+            with timer:
+                get_elevation_source()
+                for image, image_points in points:
+                    for x, y in image_points:
+                        get_altitude_at_point(x, y, image.absolute_altitude, image.file_name)
+            extra["load_seconds"] = get_elevation_source().load_time
+            extra["lookups"] = sum(len(image_points) for _, image_points in points)
+        elif stage in RASTER_STAGES:
+            prepared, _ = prepared_images(metadata[:raster_frames], sensor_dimensions, with_footprints=True)
+            images = len(prepared)
+            run_raster_stage(stage, prepared, timer, output_dir)
+        elif stage in ("end_to_end", "end_to_end_footprints"):
+            import meta_data
+            config.update_dtm(flight["dsm"])
+            config.update_footprints_only(stage == "end_to_end_footprints")
+            geotiff_dir = Path(output_dir) / "geotiffs"
+            geotiff_dir.mkdir()
+            with timer:
+                if shutil.which("exiftool") is not None:
+                    from Drone_Footprints import get_metadata
+                    chunks = get_metadata(files)
+                    extra["metadata_source"] = "exiftool"
+                else:
+                    chunks = [metadata]
+                    extra["metadata_source"] = "synthetic"
+                _, processed = meta_data.process_metadata(chunks, flight["images_dir"], geotiff_dir,
+                                                          sensor_dimensions, total=len(metadata))
+            extra["processed"] = len(processed)
+            extra["geotiffs"] = len(list(geotiff_dir.glob("*.tif")))
+        elif stage in ("mosaic", "mosaic_cog"):
+            import meta_data
+            from Utils.mosaic import build_mosaic
+            config.update_dtm(flight["dsm"])
+            config.update_cog(stage == "mosaic_cog")
+            geotiff_dir = Path(output_dir) / "geotiffs"
+            geotiff_dir.mkdir()
+            feature_collection, _ = meta_data.process_metadata([metadata], flight["images_dir"], geotiff_dir,
+                                                               sensor_dimensions, total=len(metadata))
+            with timer:
+                mosaic_file = build_mosaic(feature_collection, geotiff_dir, Path(output_dir) / "mosaic.tif")
+            extra["mosaic_megapixels"] = _megapixels(mosaic_file)
+        else:
+            raise ValueError(f"Unknown stage {stage}")
+
+    megapixels = images * parameters["width"] * parameters["height"] / 1e6
+    peak = rss_mb()
+    return dict(seconds=timer.seconds, images=images, megapixels=megapixels,
+                images_per_second=images / timer.seconds if timer.seconds else None,
+                megapixels_per_second=megapixels / timer.seconds if timer.seconds else None,
+                peak_rss_mb=peak, stage_rss_mb=peak - (timer.rss_before or peak), **extra)
+
+
+def _megapixels(geotiff_file) -> float:
+    import rasterio
+    with rasterio.open(geotiff_file) as src:
+        return src.width * src.height / 1e6
+
+
+def run_stage_process(stage, flight_dir, args) -> dict:
+    """Run a stage in a fresh interpreter and return its result."""
+    command = [sys.executable, __file__, "--stage", stage, "--flight-dir", str(flight_dir),
+               "--raster-frames", str(args.raster_frames), "--workers", str(args.workers), "--epsg", str(args.epsg)]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        return dict(error=result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def aggregate(runs: list[dict]) -> dict:
+    """Best time and highest memory of the runs of a stage."""
+    failed = [run for run in runs if "seconds" not in run]
+    if failed:
+        return failed[0]
+    best = dict(min(runs, key=lambda run: run["seconds"]))
+    best["mean_seconds"] = sum(run["seconds"] for run in runs) / len(runs)
+    best["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+    best["stage_rss_mb"] = max(run["stage_rss_mb"] for run in runs)
+    best["runs"] = len(runs)
+    return best
+
+
+def environment() -> dict:
+    import numpy
+    versions = dict(python=platform.python_version(), numpy=numpy.__version__)
+    for module in ("cv2", "rasterio", "pyproj", "lensfunpy"):
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return dict(platform=platform.platform(), processor=platform.processor(), cpu_count=os.cpu_count(),
+                exiftool=shutil.which("exiftool") is not None, versions=versions)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Print the ratios to a baseline; returns the stages slower than the tolerance."""
+    if baseline.get("flight") != results["flight"]:
+        print(f"Warning: the baseline was run on a different flight ({baseline.get('flight')}).")
+    print(f"\n{'stage':<24}{'baseline s':>12}{'now s':>10}{'time':>8}{'peak MB':>10}{'memory':>8}")
+    regressions = []
+    for stage, result in results["stages"].items():
+        old = baseline.get("stages", {}).get(stage, {})
+        if "seconds" not in result or "seconds" not in old:
+            continue
+        time_ratio = result["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+        memory_ratio = result["peak_rss_mb"] / old["peak_rss_mb"] if old["peak_rss_mb"] else float("inf")
+        flag = ""
+        if time_ratio > 1 + tolerance:
+            flag = "  slower"
+            regressions.append(stage)
+        print(f"{stage:<24}{old['seconds']:>12.3f}{result['seconds']:>10.3f}{time_ratio:>7.2f}x"
+              f"{result['peak_rss_mb']:>10.0f}{memory_ratio:>7.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=20, help="Number of frames of the flight.")
+    parser.add_argument("--width", type=int, default=4000, help="Frame width in pixels.")
+    parser.add_argument("--height", type=int, default=3000, help="Frame height in pixels.")
+    parser.add_argument("--format", choices=("jpg", "tif"), default="jpg", help="Frame file format.")
+    parser.add_argument("--heading", type=float, default=0.0,
+                        help="Direction of the survey lines in degrees from north (45 for rotated frames).")
+    parser.add_argument("--gimbal-pitch", type=float, default=-90.0,
+                        help="Gimbal pitch in degrees (-90 for nadir frames, e.g. -60 for oblique frames).")
+    parser.add_argument("--raster-frames", type=int, default=5, help="Frames used by the raster stages.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage (best is reported).")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes of the end-to-end stages.")
+    parser.add_argument("--epsg", type=int, default=4326, help="Output EPSG code.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to run.")
+    parser.add_argument("--flight-dir", help="Directory of the synthetic flight, kept and reused between runs "
+                                             "(default: a temporary directory).")
+    parser.add_argument("--output", default="bench_pipeline.json", help="JSON file for the results.")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Slowdown relative to the baseline reported as a regression (0.1 = 10%%).")
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        flight = json.loads((Path(args.flight_dir) / "flight.json").read_text())
+        print(json.dumps(run_stage(args.stage, flight, args.raster_frames, args.workers, args.epsg)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        flight_dir = Path(args.flight_dir or tmp)
+        start = time.perf_counter()
+        flight = generate_flight(flight_dir, args.count, args.width, args.height, args.format, heading=args.heading,
+                                 gimbal_pitch=args.gimbal_pitch)
+        print(f"flight: {args.count} frames of {args.width}x{args.height} {args.format} in {flight_dir} "
+              f"({time.perf_counter() - start:.1f}s)")
+
+        results = dict(created=datetime.datetime.now().isoformat(timespec="seconds"), environment=environment(),
+                       flight=flight["parameters"],
+                       settings=dict(raster_frames=args.raster_frames, repeat=args.repeat, workers=args.workers,
+                                     epsg=args.epsg),
+                       stages={})
+        print(f"{'stage':<24}{'best s':>9}{'mean s':>9}{'images/s':>10}{'MP/s':>9}{'peak MB':>9}{'stage MB':>10}")
+        for stage in args.stages:
+            result = aggregate([run_stage_process(stage, flight_dir, args) for _ in range(max(1, args.repeat))])
+            results["stages"][stage] = result
+            if "seconds" in result:
+                print(f"{stage:<24}{result['seconds']:>9.3f}{result['mean_seconds']:>9.3f}"
+                      f"{result['images_per_second'] or 0:>10.1f}{result['megapixels_per_second'] or 0:>9.1f}"
+                      f"{result['peak_rss_mb']:>9.0f}{result['stage_rss_mb']:>10.0f}")
+            else:
+                print(f"{stage:<24}{result.get('skipped') or 'error: ' + result.get('error', '')}")
+
+    Path(args.output).write_text(json.dumps(results, indent=1))
+    print(f"Results written to {args.output}")
+
+    mosaic, mosaic_cog = results["stages"].get("mosaic", {}), results["stages"].get("mosaic_cog", {})
+    if "seconds" in mosaic and "seconds" in mosaic_cog:
+        ratio = mosaic_cog["seconds"] / mosaic["seconds"]
+        print(f"mosaic of COGs / plain GeoTIFFs: {ratio:.2f}x (limit {MOSAIC_COG_RATIO:.0f}x)")
+        if ratio > MOSAIC_COG_RATIO:
+            print("FAIL: the mosaic of COG GeoTIFFs is much slower than that of plain GeoTIFFs.")
+            sys.exit(1)
+
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        if regressions:
+            print(f"FAIL: slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Benchmark of the per-image orthorectification step of create_geotiffs.rectify_and_warp_to_geotiff.
+
+Compares the former two-resampling path (warp_image_to_polygon, array2ds into a MemoryFile, then reproject
+in warp_to_geotiff_file) with the direct path (raster_utils.warp_image_to_geotiff), which warps the image once onto
+the output CRS grid and writes it straight to the destination file. The former path is kept here, as it was in
+raster_utils, only for this comparison and for the matching stages of bench_pipeline.py.
+
+Each method runs in its own subprocess so that its peak resident memory (ru_maxrss, Unix only) is measured
+in isolation.
+
+Usage:
+    python benchmarks/bench_warp.py [--width 5472] [--height 3648] [--repeat 5] [--epsg 4326]
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+import rasterio
+from loguru import logger
+from rasterio.enums import ColorInterp
+from rasterio.transform import from_bounds
+from rasterio.warp import calculate_default_transform, reproject, Resampling
+from shapely.wkt import loads
+from skimage.exposure import equalize_adapthist
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from Utils import config  # noqa: E402
+from Utils.raster_utils import geotiff_writer  # noqa: E402
+
+METHODS = ("legacy", "direct")
+
+
+def synthetic_footprint(epsg_code):
+    """A rotated, slightly oblique footprint of about 80 x 55 m, in the order of the image corners."""
+    corners = np.array([[-40.0, 30.0], [42.0, 26.0], [38.0, -27.0], [-37.0, -25.0]])
+    angle = np.radians(20)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    corners = corners @ rotation.T
+    if epsg_code == 4326:
+        # Meters to degrees around 45N, 111W.
+        return [(-111.0 + x / 78_847.0, 45.0 + y / 111_132.0) for x, y in corners]
+    return [(450_000.0 + x, 4_980_000.0 + y) for x, y in corners]
+
+
+def warp_image_to_polygon(img_arry, polygon, coordinate_array):
+    """
+    Warps an image array to fit within a specified polygon using coordinates mapping
+    after applying auto-leveling for color, brightness, and contrast adjustments.
+
+    Parameters:
+    - img_arry: The image array to be auto-leveled and then warped.
+    - polygon: The polygon to which the image should be warped.
+    - coordinate_array: Array of coordinates defining the mapping from image to polygon.
+
+    Returns:
+    - The auto-leveled and then warped image array.
+    """
+
+    if config.image_equalize is True:
+        img_arry_equalized = equalize_adapthist(img_arry, clip_limit=0.03)
+    else:
+        img_arry_equalized = img_arry
+
+    # Continue with warping as before
+    src_points = np.float32([
+        [0, 0],
+        [img_arry_equalized.shape[1], 0],
+        [img_arry_equalized.shape[1], img_arry_equalized.shape[0]],
+        [0, img_arry_equalized.shape[0]]
+    ])
+
+    # Calculate bounds, resolution, and destination points as before
+
+    minx, miny, maxx, maxy = polygon.bounds
+    resolution_x = (maxx - minx) / img_arry_equalized.shape[1]
+    resolution_y = (maxy - miny) / img_arry_equalized.shape[0]
+
+    dst_points = np.float32([gps_to_pixel(coord, minx, maxy, resolution_x, resolution_y) for coord in coordinate_array])
+
+    # Apply warping to the CLAHE-processed image
+    try:
+        h_matrix, _ = cv.findHomography(src_points, dst_points, cv.RANSAC, 5)
+        georef_image_array = cv.warpPerspective(img_arry_equalized, h_matrix,
+                                                (img_arry_equalized.shape[1], img_arry_equalized.shape[0]),
+                                                borderMode=cv.BORDER_CONSTANT, borderValue=(0, 0, 0))
+    except Exception as e:
+        logger.opt(exception=True).warning(f"Error warping image to polygon: {e}")
+        return None
+
+    return georef_image_array
+
+
+def gps_to_pixel(gps_coord, x_min, y_max, resolution_x, resolution_y):
+    """
+    Converts GPS coordinates to pixel coordinates based on image resolution and bounds.
+
+    Parameters:
+    - gps_coord: Tuple of GPS coordinates (longitude, latitude).
+    - x_min, y_max: Minimum X and maximum Y bounds of the target area.
+    - resolution_x, resolution_y: X and Y resolutions of the target image.
+
+    Returns:
+    - Tuple of pixel coordinates (x, y).
+    """
+    lon, lat = gps_coord
+    try:
+        Px = (lon - x_min) / resolution_x
+        Py = (y_max - lat) / resolution_y
+    except Exception as e:
+        logger.opt(exception=True).warning(f"Error converting GPS to pixel: {e}")
+    return int(Px), int(Py)
+
+
+def array2ds(cv2_array, polygon_wkt):
+    """
+    Converts an OpenCV image array to a rasterio dataset with geospatial data.
+
+    Parameters:
+    - cv2_array: The OpenCV image array to convert.
+    - polygon_wkt: Well-Known Text (WKT) representation of the polygon for spatial reference.
+    - epsg_code: EPSG code for the spatial reference system (default: 4326 for WGS84).
+
+    Returns:
+    - rasterio dataset object with the image and geospatial data.
+    """
+    # Check input parameters
+    if not isinstance(cv2_array, np.ndarray):
+        logger.opt(exception=True).warning(f"cv2_array must be a numpy array.")
+    if not isinstance(polygon_wkt, str):
+        logger.opt(exception=True).warning(f"polygon_wkt must be a string.")
+    if not isinstance(config.epsg_code, int):
+        logger.opt(exception=True).warning(f"epsg_code must be an integer.")
+
+    polygon = loads(polygon_wkt)
+    minx, miny, maxx, maxy = polygon.bounds
+
+    # Image dimensions and bands
+    if len(cv2_array.shape) == 3:  # For color images
+        height, width, bands = cv2_array.shape
+    else:  # For grayscale images
+        height, width = cv2_array.shape
+        bands = 1
+
+    # Determine rasterio data type based on cv2_array data type
+    if cv2_array.dtype == np.uint8:
+        dtype = rasterio.uint8
+    elif cv2_array.dtype == np.uint16:
+        dtype = rasterio.uint16
+    elif cv2_array.dtype == np.int32:
+        dtype = rasterio.int32
+    elif cv2_array.dtype == np.float32:
+        dtype = rasterio.float32
+    elif cv2_array.dtype == np.float64:
+        dtype = rasterio.float64
+    else:
+        logger.opt(exception=True).warning(f"Unsupported data type: {str(cv2_array.dtype)}")
+
+    # Create and configure the rasterio dataset
+    transform = from_bounds(minx, miny, maxx, maxy, width, height)
+    crs = rasterio.crs.CRS.from_epsg(config.epsg_code)
+
+    # The MemoryFile must outlive this function: the returned dataset reads from it.
+    memfile = rasterio.MemoryFile()
+    with memfile.open(driver='GTiff', height=height, width=width, count=bands, dtype=dtype, crs=crs,
+                      transform=transform) as dst:
+        if len(cv2_array.shape) == 3:  # For color images
+            for i in range(1, bands + 1):
+                dst.write(cv2_array[:, :, i - 1], i)
+                # Set color interpretation for each band if applicable
+                if bands == 3:
+                    color_interpretations = [ColorInterp.red, ColorInterp.green, ColorInterp.blue]
+                    dst.colorinterp = color_interpretations[:bands]
+                elif bands == 4:
+                    color_interpretations = [ColorInterp.red, ColorInterp.green, ColorInterp.blue,
+                                             ColorInterp.alpha]
+                    dst.colorinterp = color_interpretations[:bands]
+        else:  # For grayscale images
+            dst.write(cv2_array, 1)
+            color_interpretations = [ColorInterp.gray]
+            dst.colorinterp = color_interpretations[:bands]
+    return memfile.open()
+
+
+def warp_to_geotiff_file(geotiff_file:str, dataset):
+    """
+    Warps a georeferenced image array into a GeoTIFF file.
+
+    Parameters:
+    - dst_utf8_path: Destination path for the output GeoTIFF file.
+    - ds: rasterio dataset object to be warped.
+
+    No return value.
+    """
+    dst_crs = rasterio.crs.CRS.from_epsg(config.epsg_code)
+
+    transform, width, height = calculate_default_transform(
+        dataset.crs, dst_crs, dataset.width, dataset.height, *dataset.bounds)
+
+    kwargs = dataset.meta.copy()
+    kwargs.update({
+        'crs': dst_crs,
+        'transform': transform,
+        'width': width,
+        'height': height,
+        'nodata': 0  # Set nodata value to 0 (transparent)
+    })
+
+    kwargs.pop('driver', None)
+    with geotiff_writer(geotiff_file, **kwargs) as dst:
+        for i in range(1, dataset.count + 1):
+            reproject(
+                source=rasterio.band(dataset, i),
+                destination=rasterio.band(dst, i),
+                src_transform=dataset.transform,
+                src_crs=dataset.crs,
+                dst_transform=transform,
+                dst_crs=dst_crs,
+                resampling=Resampling.nearest)
+
+
+def run_method(method, width, height, repeat, epsg_code):
+    from shapely.geometry import Polygon
+    from Utils.raster_utils import warp_image_to_geotiff
+
+    config.update_epsg(epsg_code)
+    image = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    coordinate_array = synthetic_footprint(epsg_code)
+    polygon = Polygon(coordinate_array)
+    with tempfile.TemporaryDirectory() as tmp:
+        geotiff_file = str(Path(tmp) / f"{method}.tif")
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if method == "legacy":
+                dataset = array2ds(warp_image_to_polygon(image, polygon, coordinate_array), str(polygon))
+                warp_to_geotiff_file(geotiff_file, dataset)
+                dataset.close()
+            else:
+                warp_image_to_geotiff(image, geotiff_file, polygon, coordinate_array)
+            times.append(time.perf_counter() - start)
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return dict(method=method, seconds=min(times), mean_seconds=sum(times) / len(times),
+                peak_rss_mb=rss_after * scale / 2 ** 20, warp_rss_mb=(rss_after - rss_before) * scale / 2 ** 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=5472, help="Image width in pixels.")
+    parser.add_argument("--height", type=int, default=3648, help="Image height in pixels.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of warps per method.")
+    parser.add_argument("--epsg", type=int, default=4326, help="Output EPSG code (4326 or a UTM code).")
+    parser.add_argument("--method", choices=METHODS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method:
+        print(json.dumps(run_method(args.method, args.width, args.height, args.repeat, args.epsg)))
+        return
+
+    results = {}
+    for method in METHODS:
+        output = subprocess.run([sys.executable, __file__, "--method", method, "--width", str(args.width),
+                                 "--height", str(args.height), "--repeat", str(args.repeat),
+                                 "--epsg", str(args.epsg)], check=True, capture_output=True, text=True).stdout
+        results[method] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"image: {args.width}x{args.height} RGB, repeat: {args.repeat}, output EPSG: {args.epsg}")
+    print(f"{'method':<8} {'best s':>8} {'mean s':>8} {'peak RSS MB':>12} {'warp RSS MB':>12}")
+    for method, result in results.items():
+        print(f"{method:<8} {result['seconds']:8.3f} {result['mean_seconds']:8.3f} "
+              f"{result['peak_rss_mb']:12.1f} {result['warp_rss_mb']:12.1f}")
+    legacy, direct = results["legacy"], results["direct"]
+    print(f"speedup: {legacy['seconds'] / direct['seconds']:.2f}x, "
+          f"warp memory: {direct['warp_rss_mb'] / max(legacy['warp_rss_mb'], 1e-9):.2f}x of legacy")
+
+
+if __name__ == "__main__":
+    main()
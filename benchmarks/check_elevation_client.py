@@ -0,0 +1,155 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Regression check of the Open-Elevation client (Utils.elevation_client) and the mission elevation table
+(Utils.new_elevation.OpenElevationTable) against the local fake server (Utils.fake_elevation_server), offline.
+
+- every distinct point is sent once, in batches, and answered with the terrain of the server;
+- with the server failing every few requests (fail_every), retries still answer every point;
+- batches that fail after all retries leave only their own points unanswered;
+- when every batch fails, the client raises ElevationServiceError and the table stops calling the service and
+  answers None;
+- with a persistent elevation cache, points get the elevation of the centre of their cache cell, and a second
+  mission is answered without any request.
+
+Usage:
+    python benchmarks/check_elevation_client.py
+
+tests/test_elevation_client.py runs the same checks under pytest.
+"""
+
+import math
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from Utils.elevation_client import ElevationServiceError, OpenElevationClient, elevation_key  # noqa: E402
+from Utils.fake_elevation_server import FakeElevationServer, synthetic_elevation  # noqa: E402
+from Utils.new_elevation import OpenElevationTable  # noqa: E402
+
+# Retries without waiting: the checks exercise the retry logic, not the backoff delays.
+FAST_RETRIES: dict = dict(max_retries=2, backoff=0.001, max_backoff=0.002)
+TOLERANCE_M: float = 1e-6
+
+
+def mission_points(count=2000, seed=0):
+    """(latitude, longitude) points around a mission, each one repeated once."""
+    rng = np.random.default_rng(seed)
+    points = [(45.0 + float(dy), -111.0 + float(dx)) for dy, dx in rng.uniform(-0.01, 0.01, (count, 2))]
+    return points + points[::-1]
+
+
+def expected(point, base=1000.0):
+    return synthetic_elevation(*elevation_key(*point), base)
+
+
+def check_batched_lookup():
+    points = mission_points()
+    with FakeElevationServer() as server:
+        client = OpenElevationClient(server.url, batch_size=300, **FAST_RETRIES)
+        elevations = client.lookup(points)
+        distinct = len(set(elevation_key(*point) for point in points))
+        assert len(elevations) == distinct, f"{len(elevations)} elevations for {distinct} distinct points"
+        assert server.points == distinct, f"{server.points} points sent for {distinct} distinct points"
+        assert client.requests == math.ceil(distinct / 300) == server.requests, \
+            f"{client.requests} requests for {distinct} points in batches of 300"
+        worst = max(abs(elevations[elevation_key(*point)] - expected(point)) for point in points)
+        assert worst <= TOLERANCE_M, f"elevations differ from the terrain by up to {worst} m"
+
+
+def check_retries():
+    points = mission_points()
+    with FakeElevationServer(fail_every=3) as server:
+        client = OpenElevationClient(server.url, batch_size=300, **FAST_RETRIES)
+        elevations = client.lookup(points)
+        assert client.failures > 0, "the server never failed"
+        assert len(elevations) == len(set(elevation_key(*point) for point in points)), "retries lost points"
+        assert all(abs(elevations[elevation_key(*point)] - expected(point)) <= TOLERANCE_M for point in points)
+
+
+def check_partial_failure():
+    # One connection and no retries: every second request, hence every second batch, fails.
+    points = [(45.0 + i * 1e-4, -111.0) for i in range(1000)]
+    with FakeElevationServer(fail_every=2) as server:
+        client = OpenElevationClient(server.url, batch_size=100, concurrency=1, max_retries=0)
+        elevations = client.lookup(points)
+    answered = [point for point in points if elevation_key(*point) in elevations]
+    assert len(answered) == 500, f"{len(answered)} of 1000 points answered, expected the 5 batches that succeeded"
+    assert all(abs(elevations[elevation_key(*point)] - expected(point)) <= TOLERANCE_M for point in answered)
+
+
+def check_total_failure():
+    points = mission_points(200)
+    with FakeElevationServer(fail_every=1) as server:
+        client = OpenElevationClient(server.url, batch_size=50, **FAST_RETRIES)
+        try:
+            client.lookup(points)
+        except ElevationServiceError:
+            pass
+        else:
+            raise AssertionError("no ElevationServiceError when every request fails")
+        assert server.requests == 4 * (FAST_RETRIES["max_retries"] + 1), f"{server.requests} requests"
+
+        table = OpenElevationTable(server.url)
+        table.client = OpenElevationClient(server.url, **FAST_RETRIES)
+        assert table.lookup(points) == [None] * len(points), "the table answered without a service"
+        assert not table.available, "the table still considers the service available"
+        requests = server.requests
+        table.lookup(mission_points(10, seed=1))
+        assert server.requests == requests, "the table kept calling an unreachable service"
+
+
+def check_table_and_cache():
+    points = mission_points()
+    with FakeElevationServer() as server, tempfile.TemporaryDirectory() as directory:
+        table = OpenElevationTable(server.url)
+        table.client = OpenElevationClient(server.url, **FAST_RETRIES)
+        elevations = table.lookup(points)
+        worst = max(abs(elevation - expected(point)) for point, elevation in zip(points, elevations))
+        assert worst <= TOLERANCE_M, f"table elevations differ from the terrain by up to {worst} m"
+
+        cache_path = Path(directory) / "elevations.sqlite"
+        first = OpenElevationTable(server.url, cache_path)
+        first.client = OpenElevationClient(server.url, **FAST_RETRIES)
+        cached = first.lookup(points)
+        assert None not in cached, "points missing with the cache"
+        worst = max(abs(elevation - expected(first.cache.cell_centre(first.cache.cell(*elevation_key(*point)))))
+                    for point, elevation in zip(points, cached))
+        assert worst <= TOLERANCE_M, f"cached elevations differ from those of the cell centres by up to {worst} m"
+        first.cache.close()
+        requests = server.requests
+        second = OpenElevationTable(server.url, cache_path)
+        assert second.lookup(points) == cached, "the cache answered other elevations than it stored"
+        assert server.requests == requests, f"{server.requests - requests} requests despite a warm cache"
+        second.cache.close()
+
+
+CHECKS = (check_batched_lookup, check_retries, check_partial_failure, check_total_failure, check_table_and_cache)
+
+
+def main():
+    logger.remove()
+    failed = False
+    for check in CHECKS:
+        try:
+            check()
+            print(f"{check.__name__:<24} ok")
+        except Exception as error:
+            print(f"{check.__name__:<24} FAIL: {type(error).__name__}: {error}")
+            failed = True
+    if failed:
+        print("FAIL: the elevation client or table misbehaves against the fake server.")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
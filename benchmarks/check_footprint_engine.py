@@ -0,0 +1,110 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Regression check of the vectorized footprint engine against the former per-image implementation.
+
+The reference reproduces the mpmath/vector3d/numpy-quaternion math that footprint_engine replaced (camera rays
+from the fields of view, z-y-z quaternion rotation, intersection with the ground plane). Corner offsets of
+random poses, nadir and oblique, with and without declination correction, must agree to TOLERANCE relative to
+the corner distance.
+
+Usage:
+    python benchmarks/check_footprint_engine.py [--poses 500]
+
+tests/test_footprint_engine.py runs the same check under pytest.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import quaternion
+from mpmath import mp, radians
+from vector3d.vector import Vector
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from footprint_engine import fov_angles, ground_offsets  # noqa: E402
+
+mp.dps = 50
+TOLERANCE: float = 1e-12
+
+
+def legacy_offsets(yaw_deg, pitch_deg, roll_deg, altitude, sensor_width, sensor_height, focal_length,
+                   lens_fov_w, lens_fov_h, declination=None):
+    """Footprint corner offsets (east, north) of one image, computed as before footprint_engine."""
+    fov_w = 2 * mp.atan(mp.mpf(sensor_width) / (2 * focal_length)) * lens_fov_w
+    fov_h = 2 * mp.atan(mp.mpf(sensor_height) / (2 * focal_length)) * lens_fov_h
+    rays = [Vector(-mp.tan(fov_h / 2), mp.tan(fov_w / 2), 1).normalize(),
+            Vector(-mp.tan(fov_h / 2), -mp.tan(fov_w / 2), 1).normalize(),
+            Vector(mp.tan(fov_h / 2), -mp.tan(fov_w / 2), 1).normalize(),
+            Vector(mp.tan(fov_h / 2), mp.tan(fov_w / 2), 1).normalize()]
+
+    if -120 <= pitch_deg <= -60:
+        pitch = radians(90 - pitch_deg)
+    else:
+        pitch = radians(180 - pitch_deg)
+    if declination is not None:
+        yaw = (mp.pi / 2) - radians(yaw_deg + declination)
+    else:
+        yaw = (mp.pi / 2) - radians(yaw_deg)
+    yaw = yaw % (2 * mp.pi)
+    roll = radians(roll_deg)
+
+    q = quaternion.from_euler_angles(yaw, pitch, roll).normalized()
+    rotated = [Vector(*(q * np.quaternion(0, ray.x, ray.y, ray.z) * q.inverse()).vec) for ray in rays]
+    corners = []
+    for ray in rotated:
+        t = -altitude / ray.z
+        corners.append((float(ray.x * t), float(ray.y * t)))
+    return np.array(corners)
+
+
+def worst_corner_error(poses=500, seed=0) -> float:
+    """Largest corner error of the engine relative to the former implementation, over random poses."""
+    rng = np.random.default_rng(seed)
+    n = poses
+    yaw = rng.uniform(-180, 180, n)
+    # Nadir shots and oblique shots whose rays all still reach the ground.
+    pitch = np.where(rng.random(n) < 0.5, rng.uniform(-95, -85, n), rng.uniform(-70, -50, n))
+    roll = rng.uniform(-3, 3, n)
+    altitude = rng.uniform(20, 150, n)
+    sensor_width, sensor_height = rng.uniform(6, 18, n), rng.uniform(4, 13, n)
+    focal_length = rng.uniform(4, 12, n)
+    lens_fov_w, lens_fov_h = rng.uniform(0.95, 1.05, n), rng.uniform(0.95, 1.05, n)
+    declination = rng.uniform(-20, 20, n)
+
+    fov_w, fov_h = fov_angles(sensor_width, sensor_height, focal_length, lens_fov_w, lens_fov_h)
+    worst = 0.0
+    for correct in (False, True):
+        engine = ground_offsets(yaw, pitch, roll, altitude, fov_w, fov_h, declination if correct else None)
+        for i in range(n):
+            legacy = legacy_offsets(yaw[i], pitch[i], roll[i], altitude[i], sensor_width[i], sensor_height[i],
+                                    focal_length[i], lens_fov_w[i], lens_fov_h[i],
+                                    declination[i] if correct else None)
+            distance = np.linalg.norm(legacy, axis=1)
+            worst = max(worst, float(np.max(np.linalg.norm(engine[i] - legacy, axis=1) / distance)))
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--poses", type=int, default=500, help="Number of random poses.")
+    args = parser.parse_args()
+
+    n = args.poses
+    worst = worst_corner_error(n)
+    print(f"poses: {n} (x2, with and without declination); worst relative corner error: {worst:.2e} "
+          f"(tolerance {TOLERANCE:.0e})")
+    if not worst <= TOLERANCE:
+        print("FAIL: the footprint engine disagrees with the former implementation.")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
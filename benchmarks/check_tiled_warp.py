@@ -0,0 +1,103 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Regression check of the tiled warp (Utils.tiled_warp) against the whole-frame warp (warp_image_to_geotiff).
+
+A synthetic frame is written as TIFF and JPEG and orthorectified onto a rotated, oblique footprint by both paths,
+at every decode scale. The GeoTIFFs must have the same grid and, inside the footprint, the same data coverage and
+no pixel differing by more than TOLERANCE_DN. Uniform noise is the worst case: any sub-pixel misalignment shows as
+large differences. Pixels on the rim of the footprint are only counted: cv.warpPerspective decides them on its
+1/32 pixel fixed-point coordinates, the tiled path on float coordinates.
+
+Usage:
+    python benchmarks/check_tiled_warp.py [--width 2400] [--height 1600]
+
+tests/test_tiled_warp.py runs the same comparison under pytest.
+"""
+
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+import rasterio
+from shapely.geometry import Polygon
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from Utils import config  # noqa: E402
+from Utils.raster_utils import DECODE_SCALES, read_image, warp_image_to_geotiff  # noqa: E402
+from Utils.tiled_warp import warp_file_to_geotiff_tiled  # noqa: E402
+from bench_warp import synthetic_footprint  # noqa: E402
+
+TOLERANCE_DN: int = 1
+EPSG: int = 32612
+
+
+def synthetic_frame(width, height):
+    """Uniform RGB noise, the worst case for sub-pixel misalignment."""
+    return np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+
+
+def compare(image_file, scale, directory):
+    """
+    Warp a frame by both paths.
+
+    Returns:
+    - Tuple of the largest difference inside the footprint, the pixels over tolerance inside it, the pixels
+      covered by one path only inside it, and the pixels that differ on its rim.
+    """
+    coordinate_array = synthetic_footprint(EPSG)
+    polygon = Polygon(coordinate_array)
+    whole_file, tiled_file = Path(directory) / "whole.tif", Path(directory) / "tiled.tif"
+    decoded = cv2.cvtColor(read_image(str(image_file), scale), cv2.COLOR_BGR2RGB)
+    warp_image_to_geotiff(decoded, whole_file, polygon, coordinate_array, scale)
+    # A budget large enough that only the decode scale decimates the source windows.
+    warp_file_to_geotiff_tiled(str(image_file), tiled_file, polygon, coordinate_array, 4096, None, scale)
+    with rasterio.open(whole_file) as whole, rasterio.open(tiled_file) as tiled:
+        if (whole.shape, whole.transform) != (tiled.shape, tiled.transform):
+            raise AssertionError(f"grids differ: {whole.shape} {whole.transform} / {tiled.shape} {tiled.transform}")
+        a, b = whole.read().astype(np.int32), tiled.read().astype(np.int32)
+    covered_a, covered_b = a.any(axis=0), b.any(axis=0)
+    kernel = np.ones((3, 3), np.uint8)
+    inside = cv2.erode((covered_a | covered_b).astype(np.uint8), kernel).astype(bool)
+    difference = np.abs(a - b).max(axis=0)
+    differs = (difference > TOLERANCE_DN) | (covered_a != covered_b)
+    return (int(difference[inside].max()), int((difference > TOLERANCE_DN)[inside].sum()),
+            int((covered_a != covered_b)[inside].sum()), int((differs & ~inside).sum()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=2400, help="Frame width in pixels (a multiple of 8).")
+    parser.add_argument("--height", type=int, default=1600, help="Frame height in pixels (a multiple of 8).")
+    args = parser.parse_args()
+
+    config.update_epsg(EPSG)
+    image = synthetic_frame(args.width, args.height)
+    failed = False
+    print(f"frame: {args.width}x{args.height} RGB noise, tolerance {TOLERANCE_DN} DN")
+    print(f"{'format':<8}{'scale':>6}{'max DN':>8}{'over':>8}{'coverage':>10}{'rim':>6}")
+    with tempfile.TemporaryDirectory() as directory:
+        for suffix in (".tif", ".jpg"):
+            image_file = Path(directory) / f"frame{suffix}"
+            cv2.imwrite(str(image_file), image)
+            for scale in sorted(DECODE_SCALES):
+                config.update_downscale(scale)
+                largest, over, coverage, rim = compare(image_file, scale, directory)
+                print(f"{suffix[1:]:<8}{scale:>6}{largest:>8}{over:>8}{coverage:>10}{rim:>6}")
+                failed |= bool(over or coverage)
+    config.update_downscale(1)
+    if failed:
+        print("FAIL: the tiled and whole-frame warps disagree.")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
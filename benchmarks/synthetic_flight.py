@@ -0,0 +1,295 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Synthetic DJI flights for the benchmarks.
+
+A flight is a lawnmower survey of a DJI Phantom 4 Pro (FC6310 camera) over smooth synthetic terrain, flown north
+and south by default; a heading rotates the survey lines (and the frames with them) and a gimbal pitch above -90
+makes the frames oblique:
+- JPEG or TIFF frames carrying the EXIF (camera, focal length, capture time, GPS) and drone-dji XMP (altitudes,
+  gimbal and flight angles) tags that Drone Footprints reads;
+- a DSM GeoTIFF of the terrain in UTM zone 12N;
+- flight.json, with the parameters of the flight and the metadata of each frame as ExifTool reports it with
+  the arguments of Utils.metadata_stream (group-qualified tag names, numeric values), so that the stages after
+  metadata extraction can run without ExifTool.
+
+A flight directory is reused as long as its parameters are unchanged.
+
+Usage:
+    python benchmarks/synthetic_flight.py OUTPUT_DIR [--count 20] [--width 4000] [--height 3000] [--format jpg]
+        [--heading 0] [--gimbal_pitch -90]
+"""
+
+import argparse
+import datetime
+import json
+import math
+from pathlib import Path
+
+import numpy as np
+
+FLIGHT_FILE_NAME = "flight.json"
+DSM_FILE_NAME = "dsm.tif"
+# UTM zone 12N; its central meridian, 111W, passes through the survey area.
+UTM_EPSG = 32612
+ORIGIN_EASTING, ORIGIN_NORTHING = 500_000.0, 4_983_000.0
+GROUND_ELEVATION = 1400.0
+DSM_RESOLUTION = 0.5
+DSM_MARGIN = 300.0
+START_TIME = datetime.datetime(2023, 6, 1, 10, 0, 0)
+# Camera of the DJI Phantom 4 Pro, as listed in src/drone_sensors.csv.
+CAMERA = dict(make="DJI", model="FC6310", focal_length=8.8, focal_length_35mm=24, max_aperture_value=2.97)
+
+
+def terrain_elevation(eastings, northings):
+    """Elevation of the synthetic terrain in meters: gentle hills of about 15 m."""
+    x = np.asarray(eastings, dtype=np.float64) - ORIGIN_EASTING
+    y = np.asarray(northings, dtype=np.float64) - ORIGIN_NORTHING
+    return GROUND_ELEVATION + 15.0 * np.sin(x / 120.0) * np.cos(y / 90.0) + 0.02 * x
+
+
+def flight_plan(count: int, altitude: float = 100.0, spacing: float = 30.0, line_spacing: float = 60.0,
+                seed: int = 0, heading: float = 0.0, gimbal_pitch: float = -90.0) -> list[dict]:
+    """
+    Positions and attitudes of the frames of a lawnmower survey, flown line by line in alternating directions.
+
+    Parameters:
+    - count (int): Number of frames.
+    - altitude (float): Height above the take-off point in meters.
+    - spacing (float): Distance between frames along a line in meters.
+    - line_spacing (float): Distance between lines in meters.
+    - seed (int): Seed of the small attitude variations.
+    - heading (float): Direction of the survey lines in degrees clockwise from north; frames are yawed with it.
+    - gimbal_pitch (float): Gimbal pitch in degrees, -90 for nadir frames.
+
+    Returns:
+    list[dict]: One dict per frame with its UTM position, altitudes, angles and capture time.
+    """
+    from pyproj import Transformer
+
+    rng = np.random.default_rng(seed)
+    per_line = max(1, round(math.sqrt(count * line_spacing / spacing)))
+    to_wgs84 = Transformer.from_crs(UTM_EPSG, 4326, always_xy=True)
+    take_off = float(terrain_elevation(ORIGIN_EASTING, ORIGIN_NORTHING))
+    # Unit vectors along the survey lines and across them, to the right.
+    along = np.array([math.sin(math.radians(heading)), math.cos(math.radians(heading))])
+    across = np.array([along[1], -along[0]])
+    frames = []
+    for index in range(count):
+        line, position = divmod(index, per_line)
+        forward = line % 2 == 0
+        offset = line * line_spacing * across + (position if forward else per_line - 1 - position) * spacing * along
+        easting, northing = ORIGIN_EASTING + float(offset[0]), ORIGIN_NORTHING + float(offset[1])
+        longitude, latitude = to_wgs84.transform(easting, northing)
+        yaw = math.remainder(heading if forward else heading + 180.0, 360.0)
+        frames.append(dict(
+            file_name=f"DJI_{index + 1:04d}", easting=easting, northing=northing, longitude=longitude,
+            latitude=latitude, relative_altitude=altitude, absolute_altitude=take_off + altitude,
+            gimbal_roll=float(rng.normal(0, 0.5)), gimbal_pitch=gimbal_pitch + float(rng.normal(0, 0.3)),
+            gimbal_yaw=yaw + float(rng.normal(0, 1.0)), flight_roll=float(rng.normal(0, 2.0)),
+            flight_pitch=float(rng.normal(0, 2.0)), flight_yaw=yaw + float(rng.normal(0, 2.0)),
+            datetime_original=(START_TIME + datetime.timedelta(seconds=2 * index)).strftime("%Y:%m:%d %H:%M:%S")))
+    return frames
+
+
+def texture(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """
+    An RGB image that compresses like aerial imagery: smooth fields and edges with some sensor noise.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    fields = ((x // 97 + y // 71) % 5) * 30.0 + 40.0
+    image = np.stack([fields + 20 * np.sin(x / 53.0), fields * 0.8 + 25 * np.cos(y / 41.0),
+                      fields * 0.6 + 10 * np.sin((x + y) / 67.0)], axis=-1)
+    image += rng.normal(0, 4, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def _rational(value: float, denominator: int = 10000):
+    from PIL.TiffImagePlugin import IFDRational
+    return IFDRational(round(value * denominator), denominator)
+
+
+def _dms(value: float) -> tuple:
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = (value - degrees - minutes / 60) * 3600
+    return _rational(degrees, 1), _rational(minutes, 1), _rational(seconds)
+
+
+def exif_tags(frame: dict, width: int, height: int):
+    """EXIF of a frame: camera, exposure, image size, capture time and GPS position."""
+    from PIL import ExifTags, Image
+
+    exif = Image.Exif()
+    exif[ExifTags.Base.Make] = CAMERA["make"]
+    exif[ExifTags.Base.Model] = CAMERA["model"]
+    exif[ExifTags.Base.Software] = "synthetic_flight"
+    exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+    exif_ifd[ExifTags.Base.DateTimeOriginal] = frame["datetime_original"]
+    exif_ifd[ExifTags.Base.FocalLength] = _rational(CAMERA["focal_length"], 100)
+    exif_ifd[ExifTags.Base.FocalLengthIn35mmFilm] = CAMERA["focal_length_35mm"]
+    exif_ifd[ExifTags.Base.MaxApertureValue] = _rational(CAMERA["max_aperture_value"], 100)
+    exif_ifd[ExifTags.Base.ExifImageWidth] = width
+    exif_ifd[ExifTags.Base.ExifImageHeight] = height
+    gps_ifd = exif.get_ifd(ExifTags.IFD.GPSInfo)
+    gps_ifd[ExifTags.GPS.GPSVersionID] = b"\x02\x03\x00\x00"
+    gps_ifd[ExifTags.GPS.GPSLatitudeRef] = "N" if frame["latitude"] >= 0 else "S"
+    gps_ifd[ExifTags.GPS.GPSLatitude] = _dms(frame["latitude"])
+    gps_ifd[ExifTags.GPS.GPSLongitudeRef] = "E" if frame["longitude"] >= 0 else "W"
+    gps_ifd[ExifTags.GPS.GPSLongitude] = _dms(frame["longitude"])
+    gps_ifd[ExifTags.GPS.GPSAltitudeRef] = 0
+    gps_ifd[ExifTags.GPS.GPSAltitude] = _rational(frame["absolute_altitude"], 1000)
+    return exif
+
+
+def xmp_packet(frame: dict) -> bytes:
+    """The drone-dji XMP packet of a frame, with the altitudes and angles written by DJI drones."""
+    values = dict(AbsoluteAltitude=frame["absolute_altitude"], RelativeAltitude=frame["relative_altitude"],
+                  GimbalRollDegree=frame["gimbal_roll"], GimbalYawDegree=frame["gimbal_yaw"],
+                  GimbalPitchDegree=frame["gimbal_pitch"], FlightRollDegree=frame["flight_roll"],
+                  FlightYawDegree=frame["flight_yaw"], FlightPitchDegree=frame["flight_pitch"])
+    attributes = "\n    ".join(f'drone-dji:{name}="{value:+.2f}"' for name, value in values.items())
+    return (f'<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+            f'<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+            f' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+            f'  <rdf:Description rdf:about="DJI Meta Data"\n'
+            f'    xmlns:drone-dji="http://www.dji.com/drone-dji/1.0/"\n'
+            f'    {attributes}/>\n'
+            f' </rdf:RDF>\n'
+            f'</x:xmpmeta>\n'
+            f'<?xpacket end="w"?>').encode()
+
+
+def exiftool_metadata(path: Path, frame: dict, width: int, height: int) -> dict:
+    """Metadata of a frame as ExifTool reports it with -G -n, restricted to imagedrone.METADATA_TAGS."""
+    return {
+        "SourceFile": str(path), "File:FileName": path.name,
+        "EXIF:Model": CAMERA["model"], "EXIF:DateTimeOriginal": frame["datetime_original"],
+        "EXIF:FocalLength": CAMERA["focal_length"], "EXIF:FocalLengthIn35mmFormat": CAMERA["focal_length_35mm"],
+        "EXIF:MaxApertureValue": CAMERA["max_aperture_value"], "EXIF:ExifImageWidth": width,
+        "EXIF:ExifImageHeight": height,
+        "Composite:GPSLatitude": round(frame["latitude"], 8), "Composite:GPSLongitude": round(frame["longitude"], 8),
+        "Composite:GPSAltitude": round(frame["absolute_altitude"], 3),
+        "XMP:AbsoluteAltitude": round(frame["absolute_altitude"], 2),
+        "XMP:RelativeAltitude": round(frame["relative_altitude"], 2),
+        "XMP:GimbalRollDegree": round(frame["gimbal_roll"], 2), "XMP:GimbalYawDegree": round(frame["gimbal_yaw"], 2),
+        "XMP:GimbalPitchDegree": round(frame["gimbal_pitch"], 2),
+        "XMP:FlightRollDegree": round(frame["flight_roll"], 2), "XMP:FlightYawDegree": round(frame["flight_yaw"], 2),
+        "XMP:FlightPitchDegree": round(frame["flight_pitch"], 2),
+    }
+
+
+def write_frame(path: Path, image: np.ndarray, frame: dict):
+    """
+    Write a frame with its EXIF and XMP, as a JPEG (quality 92, like DJI cameras) or an uncompressed TIFF (like
+    multispectral drone cameras).
+    """
+    from PIL import ExifTags, Image
+
+    height, width = image.shape[:2]
+    pil_image = Image.fromarray(image)
+    exif = exif_tags(frame, width, height)
+    if path.suffix.lower() in (".tif", ".tiff"):
+        # The TIFF writer ignores exif=; the EXIF and GPS sub-IFDs are passed as nested tag dictionaries, which
+        # only the uncompressed (non-libtiff) writer supports.
+        tiffinfo = {**exif, ExifTags.IFD.Exif: dict(exif.get_ifd(ExifTags.IFD.Exif)),
+                    ExifTags.IFD.GPSInfo: dict(exif.get_ifd(ExifTags.IFD.GPSInfo)), 700: xmp_packet(frame)}
+        pil_image.save(path, "TIFF", tiffinfo=tiffinfo)
+    else:
+        pil_image.save(path, "JPEG", quality=92, exif=exif, xmp=xmp_packet(frame))
+
+
+def write_dsm(path: Path, frames: list[dict]):
+    """Write a float32 DSM GeoTIFF of the terrain under the flight, with a margin around the footprints."""
+    import rasterio
+    from rasterio.transform import from_origin
+
+    west = min(frame["easting"] for frame in frames) - DSM_MARGIN
+    east = max(frame["easting"] for frame in frames) + DSM_MARGIN
+    south = min(frame["northing"] for frame in frames) - DSM_MARGIN
+    north = max(frame["northing"] for frame in frames) + DSM_MARGIN
+    width = int(math.ceil((east - west) / DSM_RESOLUTION))
+    height = int(math.ceil((north - south) / DSM_RESOLUTION))
+    eastings = west + (np.arange(width) + 0.5) * DSM_RESOLUTION
+    northings = north - (np.arange(height) + 0.5) * DSM_RESOLUTION
+    elevation = terrain_elevation(eastings[np.newaxis, :], northings[:, np.newaxis]).astype(np.float32)
+    with rasterio.open(path, "w", driver="GTiff", width=width, height=height, count=1, dtype="float32",
+                       crs=f"EPSG:{UTM_EPSG}", transform=from_origin(west, north, DSM_RESOLUTION, DSM_RESOLUTION),
+                       nodata=-9999.0, tiled=True, compress="deflate") as dataset:
+        dataset.write(elevation, 1)
+
+
+def generate_flight(directory, count: int = 20, width: int = 4000, height: int = 3000, image_format: str = "jpg",
+                    seed: int = 0, heading: float = 0.0, gimbal_pitch: float = -90.0) -> dict:
+    """
+    Generate a synthetic flight, or reuse the one in the directory if it has the same parameters.
+
+    Parameters:
+    - directory (str or Path): Output directory; frames go to its images subdirectory.
+    - count (int): Number of frames.
+    - width, height (int): Frame size in pixels.
+    - image_format (str): "jpg" or "tif".
+    - seed (int): Seed of the image noise and attitude variations.
+    - heading (float): Direction of the survey lines in degrees clockwise from north (see flight_plan).
+    - gimbal_pitch (float): Gimbal pitch in degrees, -90 for nadir frames.
+
+    Returns:
+    dict: The content of flight.json: parameters, images directory, DSM path and per-frame metadata.
+    """
+    directory = Path(directory).absolute()
+    parameters = dict(count=count, width=width, height=height, format=image_format, seed=seed, heading=heading,
+                      gimbal_pitch=gimbal_pitch)
+    flight_file = directory / FLIGHT_FILE_NAME
+    if flight_file.is_file():
+        flight = json.loads(flight_file.read_text())
+        if flight["parameters"] == parameters and all(Path(data["SourceFile"]).is_file()
+                                                      for data in flight["metadata"]):
+            return flight
+
+    images_dir = directory / "images"
+    images_dir.mkdir(parents=True, exist_ok=True)
+    for stale in images_dir.iterdir():
+        stale.unlink()
+    frames = flight_plan(count, seed=seed, heading=heading, gimbal_pitch=gimbal_pitch)
+    base = texture(width, height, seed)
+    metadata = []
+    for index, frame in enumerate(frames):
+        path = images_dir / f"{frame['file_name']}.{'TIF' if image_format == 'tif' else 'JPG'}"
+        # Shift the texture so that consecutive frames differ like overlapping photographs.
+        write_frame(path, np.roll(base, shift=(index * 37, index * 53), axis=(0, 1)), frame)
+        metadata.append(exiftool_metadata(path, frame, width, height))
+    dsm_path = directory / DSM_FILE_NAME
+    write_dsm(dsm_path, frames)
+
+    flight = dict(parameters=parameters, images_dir=str(images_dir), dsm=str(dsm_path), metadata=metadata)
+    flight_file.write_text(json.dumps(flight, indent=1))
+    return flight
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output_dir", help="Directory of the flight.")
+    parser.add_argument("--count", type=int, default=20, help="Number of frames.")
+    parser.add_argument("--width", type=int, default=4000, help="Frame width in pixels.")
+    parser.add_argument("--height", type=int, default=3000, help="Frame height in pixels.")
+    parser.add_argument("--format", choices=("jpg", "tif"), default="jpg", help="Frame file format.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the image noise and attitude variations.")
+    parser.add_argument("--heading", type=float, default=0.0,
+                        help="Direction of the survey lines in degrees clockwise from north (e.g. 45 for rotated "
+                             "frames).")
+    parser.add_argument("--gimbal_pitch", type=float, default=-90.0,
+                        help="Gimbal pitch in degrees, -90 for nadir frames (e.g. -60 for oblique frames).")
+    args = parser.parse_args()
+
+    flight = generate_flight(args.output_dir, args.count, args.width, args.height, args.format, args.seed,
+                             args.heading, args.gimbal_pitch)
+    print(f"{len(flight['metadata'])} frames in {flight['images_dir']}, DSM {flight['dsm']}")
+
+
+if __name__ == "__main__":
+    main()
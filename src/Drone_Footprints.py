@@ -8,15 +8,16 @@ import sys
 import argparse
 import datetime
 from pathlib import Path
+from time import perf_counter
 import warnings
-import exiftool
-import geojson
-from meta_data import process_metadata
+from contextlib import nullcontext
 from Utils.utils import read_sensor_dimensions_from_csv, Color
 from Utils.logger_config import logger, init_logger
-from Utils.raster_utils import create_mosaic
+from Utils.elevation_cache import default_cache_path
+from Utils.metadata_stream import stream_metadata, chunk_files, DEFAULT_CHUNK_SIZE, EXIFTOOL_COMMON_ARGS
+from Utils.metadata_cache import MetadataCache, file_identity, CACHE_FILE_NAME
+from Utils.run_manifest import RunManifest
 from Utils import config
-from imagedrone import ImageDrone
 
 warnings.filterwarnings("ignore", category=FutureWarning, module="osgeo")
 
@@ -57,19 +58,13 @@ def get_image_files(directory: str) -> list[Path]:
     )
 
 
-def get_metadata(files: list[Path]) -> list[dict]:
+def get_exiftool_helper():
     """
-    Extract metadata from a list of image files using ExifTool.
-
-    Args:
-        files (list[Path]): Paths to the image files from which to extract metadata.
-
-    Returns:
-        list[dict]: A list of metadata dictionaries for each file.
+    Create the ExifTool helper used for metadata extraction, or exit when ExifTool is not installed.
     """
-    exif_array = []
+    import exiftool
     try:
-        et_helper = exiftool.ExifToolHelper()
+        return exiftool.ExifToolHelper(common_args=EXIFTOOL_COMMON_ARGS)
     except FileNotFoundError:
         logger.critical(
             "ExifTool executable not found. Please install ExifTool and ensure it is "
@@ -79,13 +74,63 @@ def get_metadata(files: list[Path]) -> list[dict]:
             "  - Linux:   sudo apt-get install libimage-exiftool-perl"
         )
         sys.exit(1)
-    with et_helper as et:
-        metadata = iter(et.get_metadata(files))
-        exif_array.extend(iter(metadata))
-    if exif_array is not None and exif_array:
-        return exif_array
-    logger.critical("Failed to extract metadata from image files.")
-    sys.exit()
+
+
+def get_metadata(files: list[Path], chunk_size: int = DEFAULT_CHUNK_SIZE, cache_path: Path = None):
+    """
+    Extract metadata from a list of image files using ExifTool, chunk by chunk.
+
+    Only the tags read by ImageDrone are extracted, as numbers. ExifTool reads the next chunks in a background
+    thread while the caller processes the current one. With a metadata cache, files whose path, size and
+    modification time are unchanged are served from the cache and only new or changed files are read.
+
+    Args:
+        files (list[Path]): Paths to the image files from which to extract metadata.
+        chunk_size (int): Number of files read per ExifTool call.
+        cache_path (Path): SQLite metadata cache, or None to always read every file.
+
+    Yields:
+        list[dict]: The metadata dictionaries of each chunk of files.
+    """
+    from imagedrone import METADATA_TAGS
+    cache = MetadataCache(cache_path, METADATA_TAGS, EXIFTOOL_COMMON_ARGS) if cache_path else None
+    file_chunks = chunk_files(files, chunk_size)
+    identity_chunks = [[file_identity(file) for file in chunk] for chunk in file_chunks]
+    # Only which files are cached is known up front; their metadata is loaded chunk by chunk below.
+    cached = set()
+    if cache:
+        cached = cache.contains_many([identity for identities in identity_chunks for identity in identities])
+    missing_chunks = [[file for file, identity in zip(chunk, identities) if identity not in cached]
+                      for chunk, identities in zip(file_chunks, identity_chunks)]
+
+    if any(missing_chunks):
+        read_chunks = stream_metadata(get_exiftool_helper(), missing_chunks, METADATA_TAGS)
+    else:
+        read_chunks = [[] for _ in file_chunks]
+    extracted = 0
+    for index, read in enumerate(read_chunks):
+        read_by_path = {os.path.normpath(data["SourceFile"]): data for data in read}
+        new = {identity: read_by_path[os.path.normpath(file)]
+               for file, identity in zip(file_chunks[index], identity_chunks[index])
+               if os.path.normpath(file) in read_by_path}
+        known = cache.get_many(identity_chunks[index]) if cache else {}
+        lost = sum(identity in cached and identity not in known for identity in identity_chunks[index])
+        if lost:
+            logger.warning(f"{lost} files left the metadata cache during the run and are skipped.")
+        if cache:
+            cache.put_many(new)
+        known.update(new)
+        chunk = [known[identity] for identity in identity_chunks[index] if identity in known]
+        extracted += len(chunk)
+        yield chunk
+
+    served = f", {cache.hits} served from the metadata cache" if cache else ""
+    logger.info(f"Metadata gathered for {Color.PURPLE}{extracted} of {len(files)} image files{Color.END}{served}.")
+    if cache:
+        cache.close()
+    if not extracted:
+        logger.critical("Failed to extract metadata from image files.")
+        sys.exit()
 
 
 def find_mtk(some_dir):
@@ -108,6 +153,7 @@ def write_geojson_file(geojson_file, geojson_dir, feature_collection):
         geojson_dir (Path): The directory where the GeoJSON file should be saved.
         feature_collection (dict): The GeoJSON feature collection to be written.
     """
+    import geojson
     file_path = Path(geojson_dir) / geojson_file
     try:
         with open(file_path, "w") as file:
@@ -116,6 +162,60 @@ def write_geojson_file(geojson_file, geojson_dir, feature_collection):
         logger.critical(f"Error writing GeoJSON file: {e}")
 
 
+def open_footprint_sinks(geojson_dir, name: str):
+    """
+    The GeoJSONSeq/GeoParquet/FlatGeobuf footprint outputs of config.vector_formats (see Utils.footprint_sinks), or a no-op
+    context when only GeoJSON is written.
+    """
+    if not set(config.vector_formats) - {"geojson"}:
+        return nullcontext()
+    from Utils.footprint_sinks import FootprintSinks
+    return FootprintSinks(config.vector_formats, geojson_dir, name)
+
+
+def rebuild_geojson(manifest: RunManifest, outdir: str, indir: str = None):
+    """
+    Write the mission GeoJSON, the footprint index and the mission VRT of the GeoTIFFs from the records of a run
+    manifest, without processing any image.
+
+    The records are those of the images in the input directory when one is given, otherwise those of the last
+    completed run, in capture order.
+
+    Args:
+        manifest (RunManifest): The run manifest of the output directory.
+        outdir (str): The output directory.
+        indir (str): The input directory, or None.
+    """
+    from meta_data import mission_feature_collection
+    from Utils.footprint_index import write_index
+    if indir:
+        paths = {str(file.absolute()) for file in get_image_files(indir)}
+        records = [record for record in manifest.records.values() if record["path"] in paths]
+    else:
+        records = manifest.latest_run_records()
+    records.sort(key=lambda record: record.get("datetime_original") or "")
+    if not records:
+        logger.critical(f"No run manifest records found in {manifest.path}.")
+        sys.exit()
+    geojson_dir = Path(outdir) / "geojsons"
+    geojson_dir.mkdir(parents=True, exist_ok=True)
+    geojson_file = f"M_{now.strftime('%Y-%m-%d_%H-%M')}.json"
+    feature_collection = mission_feature_collection(records)
+    if "geojson" in config.vector_formats:
+        write_geojson_file(geojson_file, geojson_dir, feature_collection)
+    with open_footprint_sinks(geojson_dir, Path(geojson_file).stem) as sinks:
+        if sinks is not None:
+            for record in records:
+                sinks.write(record)
+            sinks.write_flight_line(feature_collection["features"][0])
+    write_index(records, outdir)
+    if any(record.get("geotiff") for record in records):
+        from Utils.mission_vrt import write_mission_index
+        write_mission_index(records, Path(outdir) / "geotiffs", Path(geojson_file).stem, config.vrt_order,
+                            config.tile_index)
+    logger.success(f"GeoJSON file rebuilt from {len(records)} run manifest records.")
+
+
 @logger.catch
 def main():
     """
@@ -125,8 +225,8 @@ def main():
     parser.add_argument("-o", "--output_directory", help="Path to the output directory for GeoJSON and GeoTIFFs.",
                         required=True)
     parser.add_argument("-i", "--input_directory", type=is_valid_directory,
-                        help="Path to the input directory with images.",
-                        required=True)
+                        help="Path to the input directory with images (required unless --rebuild_geojson).",
+                        required=False)
     parser.add_argument("-w", "--sensorWidth", type=float, help="Sensor width in millimeters (optional).",
                         required=False)
     parser.add_argument("-t", "--sensorHeight", type=float, help="Sensor height in millimeters (optional).",
@@ -147,8 +247,60 @@ def main():
                              "AbsoluteAltitude - absolute_ground.")
     parser.add_argument("-n", "--nodejs", action='store_true', required=False,
                         help="Experimental Nodejs graphical interface (optional).")
+    parser.add_argument("-j", "--workers", type=int, default=1, required=False,
+                        help="Number of worker processes for the per-image pipeline (optional). "
+                             "Use 0 for one worker per CPU core.")
+    parser.add_argument("--footprints_only", "--footprints-only", action='store_true', required=False,
+                        help="Only compute the footprints and the GeoJSON; no GeoTIFF is created and no image is "
+                             "decoded (optional).")
+    parser.add_argument("--memory_budget", type=int, default=config.memory_budget, required=False,
+                        help="Memory budget in MB for warping one image; larger frames are warped block by block "
+                             "(optional). Use 0 to always warp whole frames.")
+    parser.add_argument("--metadata_chunk", type=int, default=DEFAULT_CHUNK_SIZE, required=False,
+                        help="Number of images per ExifTool call; processing starts after the first chunk "
+                             "(optional).")
+    parser.add_argument("--no_metadata_cache", action='store_true', required=False,
+                        help="Read the metadata of every image with ExifTool instead of reusing the metadata "
+                             "cache of the output directory (optional).")
+    parser.add_argument("--no_resume", action='store_true', required=False,
+                        help="Reprocess every image, even those the run manifest of the output directory records "
+                             "as complete (optional).")
+    parser.add_argument("--rebuild_geojson", action='store_true', required=False,
+                        help="Only rebuild the mission GeoJSON from the run manifest of the output directory "
+                             "(optional).")
+    parser.add_argument("--profile", action='store_true', required=False,
+                        help="Time each processing stage and write a performance report to the output directory "
+                             "(optional).")
+    parser.add_argument("--mosaic", choices=config.MOSAIC_RULES, default=None, required=False,
+                        help="Composite the GeoTIFFs into one mission mosaic, keeping the first or last capture "
+                             "or the image whose nadir is closest where images overlap (optional).")
+    parser.add_argument("--vrt_order", choices=config.VRT_ORDERS, default=config.vrt_order, required=False,
+                        help="Stacking order of the GeoTIFFs in the mission VRT: latest capture or closest to "
+                             "nadir on top (optional).")
+    parser.add_argument("--tile_index", action='store_true', required=False,
+                        help="Also write a GDAL GTI tile index of the GeoTIFFs next to the mission VRT "
+                             "(optional).")
+    parser.add_argument("--vector_formats", nargs="+", choices=config.VECTOR_FORMATS,
+                        default=list(config.vector_formats), required=False,
+                        help="Footprint output formats (optional). GeoJSONSeq is appended as images finish and "
+                             "can be tailed; GeoParquet and FlatGeobuf store one row per image.")
+    parser.add_argument("--elevation_url", type=str, default=config.elevation_url, required=False,
+                        help="Open-Elevation compatible lookup endpoint used with -m (optional).")
+    parser.add_argument("--elevation_cache", type=str, default=str(default_cache_path()), required=False,
+                        help="Persistent cache of elevation service results used with -m; with the cache, points "
+                             "are looked up at the centre of their ~11 m cache cell (optional).")
+    parser.add_argument("--no_elevation_cache", action='store_true', required=False,
+                        help="Do not read or write the persistent elevation cache, and look up the exact points "
+                             "(optional).")
 
     # Add mutually exclusive arguments
+    resolution = parser.add_mutually_exclusive_group()
+    resolution.add_argument("--target_gsd", type=float, default=None, required=False,
+                            help="Target ground sampling distance of the GeoTIFFs in cm/px; images are decoded at "
+                                 "the cheapest reduced scale (1/2, 1/4, 1/8) that still meets it (optional).")
+    resolution.add_argument("--downscale", type=int, default=1, required=False,
+                            help="Reduce the resolution of the GeoTIFFs by this factor, decoding images at the "
+                                 "largest reduced scale (1/2, 1/4, 1/8) not above it (optional).")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-v", "--DSMPATH", type=is_valid_file, help="Path to DSM file (optional).",
                        default="", required=False)
@@ -156,7 +308,21 @@ def main():
                        help="Use elevation services APIs (optional).")
 
     args = parser.parse_args()
-
+    if args.input_directory is None and not args.rebuild_geojson:
+        parser.error("the following arguments are required: -i/--input_directory")
+    if args.target_gsd is not None and args.target_gsd <= 0:
+        parser.error("--target_gsd must be positive")
+    if args.downscale < 1:
+        parser.error("--downscale must be at least 1")
+    if args.mosaic and args.footprints_only:
+        parser.error("--mosaic needs the GeoTIFFs and cannot be combined with --footprints_only")
+    if "flatgeobuf" in args.vector_formats:
+        from Utils.footprint_sinks import flatgeobuf_unavailable
+        missing = flatgeobuf_unavailable()
+        if missing:
+            parser.error(f"--vector_formats flatgeobuf {missing}")
+
+    start_time = perf_counter()
     outer_path = args.output_directory
     log_file = f"L_M_{now.strftime('%Y-%m-%d_%H-%M')}.log"
     log_path = Path(outer_path) / "logfiles" / log_file
@@ -185,7 +351,23 @@ def main():
     config.update_equalize(args.image_equalize)
     config.update_lense(args.lense_correction)
     config.update_elevation(args.elevation_service)
+    config.update_elevation_url(args.elevation_url)
+    config.update_elevation_cache("" if args.no_elevation_cache else args.elevation_cache)
     config.update_absolute_ground(args.absolute_ground)
+    config.update_workers(args.workers)
+    config.update_memory_budget(args.memory_budget)
+    config.update_footprints_only(args.footprints_only)
+    config.update_profile(args.profile)
+    config.update_target_gsd(args.target_gsd / 100 if args.target_gsd else None)
+    config.update_downscale(args.downscale)
+    config.update_mosaic(args.mosaic)
+    config.update_vrt_order(args.vrt_order)
+    config.update_tile_index(args.tile_index)
+    config.update_vector_formats(args.vector_formats)
+    manifest = RunManifest(outdir)
+    if args.rebuild_geojson:
+        rebuild_geojson(manifest, outdir, indir)
+        return
     rtk_rtn = find_mtk(indir)
     if rtk_rtn:
         config.update_rtk(True)
@@ -196,8 +378,8 @@ def main():
     if files is None or len(files) == 0:
         logger.critical("No image files found in the specified directory.")
         sys.exit()
-    metadata = get_metadata(files)
-    logger.info(f"Metadata Gathered for {Color.PURPLE}{len(files)} image files{Color.END}.")
+    metadata_cache = None if args.no_metadata_cache else Path(outdir) / CACHE_FILE_NAME
+    metadata = get_metadata(files, args.metadata_chunk, metadata_cache)
     try:
         geojson_dir = Path(outdir) / "geojsons"
         geotiff_dir = Path(outdir) / "geotiffs"
@@ -215,12 +397,33 @@ def main():
         logger.critical("Error reading sensor dimensions from CSV.")
         sys.exit()
 
+    # The processing stack (numpy, pyproj, the footprint engine and, for GeoTIFFs, the raster libraries) is only
+    # imported once the arguments are valid and there are images to process.
+    from meta_data import process_metadata
     images_array = []
-    feature_collection, images_array= process_metadata(metadata, indir, geotiff_dir, sensor_dimensions)
-
     geojson_file = f"M_{now.strftime('%Y-%m-%d_%H-%M')}.json"
-    write_geojson_file(geojson_file, geojson_dir, feature_collection)
+    with open_footprint_sinks(geojson_dir, Path(geojson_file).stem) as sinks:
+        feature_collection, images_array= process_metadata(metadata, indir, geotiff_dir, sensor_dimensions,
+                                                             total=len(files), manifest=manifest,
+                                                             resume=not args.no_resume, sinks=sinks)
+        if sinks is not None:
+            sinks.write_flight_line(feature_collection["features"][0])
+
+    if "geojson" in config.vector_formats:
+        write_geojson_file(geojson_file, geojson_dir, feature_collection)
+    if not config.footprints_only:
+        from Utils.mission_vrt import write_mission_index
+        write_mission_index(manifest.run_records(), geotiff_dir, Path(geojson_file).stem, config.vrt_order,
+                            config.tile_index)
+    if config.mosaic:
+        from Utils.mosaic import build_mosaic
+        mosaic_file = Path(outdir) / "mosaic" / f"M_{now.strftime('%Y-%m-%d_%H-%M')}.tif"
+        build_mosaic(feature_collection, geotiff_dir, mosaic_file, config.mosaic)
+    if config.profile:
+        from Utils.perf import write_report
+        write_report(images_array, perf_counter() - start_time, outdir)
     if args.nodejs:
+        from Utils.raster_utils import create_mosaic
         mosaic_path = Path(outdir) / "mosaic"
         mosaic_path.mkdir(parents=True, exist_ok=True)
         create_mosaic(indir, mosaic_path)
@@ -230,7 +433,10 @@ def main():
     else:
         geo_type = "standard"
 
-    logger.success(f"Process Complete. {len(images_array)} {geo_type} GeoTIFFs and a GeoJSON file were created.")
+    if config.footprints_only:
+        logger.success(f"Process Complete. {len(images_array)} footprints and a GeoJSON file were created.")
+    else:
+        logger.success(f"Process Complete. {len(images_array)} {geo_type} GeoTIFFs and a GeoJSON file were created.")
     logger.remove()  # Remove existing handlers
 
 
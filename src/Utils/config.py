@@ -13,23 +13,37 @@ hemisphere = ""
 cog = False
 dtm_path = ""
 global_elevation = False
+elevation_url = "https://api.open-elevation.com/api/v1/lookup"
+elevation_cache = ""
 global_target_delta = 0.0
 image_equalize = False
-im_file_name = ""
-relative_altitude = 0.0
-absolute_altitude = 0.0
 absolute_ground = None
 dsm = None
 drone_properties = None
 lense_correction = True
-center_distance = 0.0
 nodejs_graphical_interface = False
+workers = 1
+memory_budget = 1024
+footprints_only = False
+profile = False
+target_gsd = None
+downscale = 1
+mosaic = None
+vrt_order = "time"
+tile_index = False
+vector_formats = ("geojson",)
 pbar = tqdm(total=0, position=1, bar_format='{desc}')
+# Selection rules of the mission mosaic (see Utils.mosaic).
+MOSAIC_RULES = ("first", "last", "nadir")
+# Stacking orders of the mission VRT (see Utils.mission_vrt).
+VRT_ORDERS = ("time", "nadir")
+# Footprint output formats (see Utils.footprint_sinks).
+VECTOR_FORMATS = ("geojson", "geojsonseq", "geoparquet", "flatgeobuf")
 crs_utm = f"+proj=utm +zone={utm_zone} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
 
 
 def init():
-    global epsg_code, rtk, correct_magnetic_declinaison, utm_zone, hemisphere, cog, dtm_path, global_elevation, crs_utm, global_target_delta, pbar, image_equalize, im_file_name, relative_altitude, absolute_altitude, absolute_ground, dsm, drone_properties, center_distance, lense_correction, nodejgraphical_interface
+    global epsg_code, rtk, correct_magnetic_declinaison, utm_zone, hemisphere, cog, dtm_path, global_elevation, elevation_url, elevation_cache, crs_utm, global_target_delta, pbar, image_equalize, absolute_ground, dsm, drone_properties, lense_correction, nodejgraphical_interface, workers, memory_budget, footprints_only, profile, target_gsd, downscale, mosaic, vrt_order, tile_index, vector_formats
     correct_magnetic_declinaison = False
     epsg_code = 4326
     utm_zone = ""
@@ -37,18 +51,26 @@ def init():
     rtk = False
     cog = False
     dtm_path = ""
-    center_distance = 0.0
     global_elevation = False
+    elevation_url = "https://api.open-elevation.com/api/v1/lookup"
+    elevation_cache = ""
     global_target_delta = 0.0
     image_equalize = False
-    im_file_name = ""
-    relative_altitude = 0.0
-    absolute_altitude = 0.0
     absolute_ground = None
     dsm = None
     drone_properties = None
     lense_correction = True
     nodejgraphical_interface = False
+    workers = 1
+    memory_budget = 1024
+    footprints_only = False
+    profile = False
+    target_gsd = None
+    downscale = 1
+    mosaic = None
+    vrt_order = "time"
+    tile_index = False
+    vector_formats = ("geojson",)
     pbar = tqdm(total=0, position=1, bar_format='{desc}')
     crs_utm = f"+proj=utm +zone={utm_zone} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
 
@@ -58,11 +80,6 @@ def update_epsg(a):
     epsg_code = a
 
 
-def update_center_distance(a):
-    global center_distance
-    center_distance = a
-
-
 def update_nodejs_graphical_interface(n):
     global nodejgraphical_interface
     nodejgraphical_interface = n
@@ -108,24 +125,19 @@ def update_equalize(u):
     image_equalize = u
 
 
-def update_file_name(q):
-    global im_file_name
-    im_file_name = q
-
-
-def update_rel_altitude(q):
-    global relative_altitude
-    relative_altitude = q
-
-
 def update_lense(v):
     global lense_correction
     lense_correction = v
 
 
-def update_abso_altitude(q):
-    global absolute_altitude
-    absolute_altitude = q
+def update_elevation_url(e):
+    global elevation_url
+    elevation_url = e
+
+
+def update_elevation_cache(f):
+    global elevation_cache
+    elevation_cache = f
 
 
 def update_absolute_ground(q):
@@ -138,6 +150,56 @@ def update_drone_properties(s):
     drone_properties = s
 
 
+def update_workers(w):
+    global workers
+    workers = w
+
+
+def update_memory_budget(m):
+    global memory_budget
+    memory_budget = m
+
+
+def update_footprints_only(f):
+    global footprints_only
+    footprints_only = f
+
+
+def update_profile(p):
+    global profile
+    profile = p
+
+
+def update_target_gsd(g):
+    global target_gsd
+    target_gsd = g
+
+
+def update_downscale(d):
+    global downscale
+    downscale = d
+
+
+def update_mosaic(m):
+    global mosaic
+    mosaic = m
+
+
+def update_vrt_order(o):
+    global vrt_order
+    vrt_order = o
+
+
+def update_tile_index(t):
+    global tile_index
+    tile_index = t
+
+
+def update_vector_formats(f):
+    global vector_formats
+    vector_formats = tuple(f)
+
+
 def update_utm_data(c, d):
     global utm_zone, hemisphere, crs_utm
     if not c or not d:
@@ -147,4 +209,21 @@ def update_utm_data(c, d):
     crs_utm = f"+proj=utm +zone={utm_zone} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
 
 
+# Mission-wide settings that worker processes need to reproduce the parent's configuration.
+MISSION_SETTINGS = ("epsg_code", "rtk", "correct_magnetic_declinaison", "cog", "dtm_path", "global_elevation",
+                    "elevation_url", "elevation_cache", "image_equalize", "lense_correction", "absolute_ground",
+                    "nodejgraphical_interface", "memory_budget", "footprints_only", "profile",
+                    "target_gsd", "downscale", "workers")
+
+
+def get_settings():
+    """Return a picklable snapshot of the mission-wide settings."""
+    return {name: globals()[name] for name in MISSION_SETTINGS}
+
+
+def apply_settings(settings):
+    """Restore mission-wide settings captured with get_settings(), e.g. inside a worker process."""
+    globals().update({name: value for name, value in settings.items() if name in MISSION_SETTINGS})
+
+
 init()
@@ -0,0 +1,104 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+from datetime import date, datetime
+from loguru import logger
+
+# Declination changes by a fraction of a degree across tens of kilometres and over months, so values are
+# cached per grid cell of this size (degrees) and per calendar month.
+GRID_DEGREES: float = 0.1
+
+
+class DeclinationProvider:
+    """
+    Offline magnetic declination lookups for a mission.
+
+    Uses the World Magnetic Model coefficients bundled with magnetismi; a model is loaded once per process and
+    results are cached on a coarse (latitude, longitude, month) grid. No network access is ever made: dates
+    outside the bundled models are clamped to the nearest covered date.
+    """
+
+    def __init__(self, grid_degrees: float = GRID_DEGREES):
+        # magnetismi is only loaded once a declination is needed, not by the modules importing this one.
+        import magnetismi.magnetismi as api
+        self.grid_degrees = grid_degrees
+        self.first_date = date(min(api.YEARS_COVERED), 1, 1)
+        self.last_date = date(max(api.YEARS_COVERED), 12, 31)
+        self._models = {}
+        self._cache = {}
+        self._clamp_warned = False
+        self.hits = 0
+        self.misses = 0
+
+    def _model(self, year: int):
+        import magnetismi.magnetismi as api
+        model_id = api.MODEL_FROM_YEAR[year]
+        if model_id not in self._models:
+            self._models[model_id] = api.Model(year)
+        return self._models[model_id]
+
+    def _model_date(self, capture_date: date) -> date:
+        if self.first_date <= capture_date <= self.last_date:
+            return capture_date
+        clamped = min(max(capture_date, self.first_date), self.last_date)
+        if not self._clamp_warned:
+            logger.warning(f"No offline magnetic model covers {capture_date}; using the declination of {clamped} "
+                           f"(the secular change is typically a few tenths of a degree per year).")
+            self._clamp_warned = True
+        return clamped
+
+    def declination(self, latitude: float, longitude: float, capture_date: date) -> float:
+        """
+        Magnetic declination in degrees at a location and date.
+
+        Parameters:
+        - latitude (float): Latitude in decimal degrees.
+        - longitude (float): Longitude in decimal degrees.
+        - capture_date (date): Date of capture.
+
+        Returns:
+        float: Declination in degrees (positive east), evaluated at the centre of the cached grid cell.
+        """
+        key = (round(latitude / self.grid_degrees), round(longitude / self.grid_degrees),
+               capture_date.year, capture_date.month)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        model_date = self._model_date(date(capture_date.year, capture_date.month, 15))
+        field_point = self._model(model_date.year).at(lat_dd=key[0] * self.grid_degrees,
+                                                      lon_dd=key[1] * self.grid_degrees,
+                                                      alt_ft=0.0, date=model_date)
+        self._cache[key] = field_point.dec
+        return field_point.dec
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses)
+
+
+_provider: DeclinationProvider = None
+
+
+def get_declination_provider() -> DeclinationProvider:
+    """Return the process-wide DeclinationProvider."""
+    global _provider
+    if _provider is None:
+        _provider = DeclinationProvider()
+    return _provider
+
+
+def find_declination(latitude: float, longitude: float, datetime_original: str) -> float:
+    """
+    Magnetic declination for an image from its position and EXIF DateTimeOriginal ('%Y:%m:%d %H:%M:%S').
+    """
+    capture_date = datetime.strptime(datetime_original, '%Y:%m:%d %H:%M:%S').date()
+    return get_declination_provider().declination(latitude, longitude, capture_date)
+
+
+def declination_stats() -> dict:
+    """Counters of the process-wide DeclinationProvider, empty when no declination was computed."""
+    return _provider.stats() if _provider is not None else {}
@@ -0,0 +1,121 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from loguru import logger
+
+# Size of a cache cell in degrees (about 11 m), well below the ~30 m resolution of the SRTM data behind
+# Open-Elevation. With the cache, every point is looked up at the centre of its cell, so its elevation can differ
+# from the one of the exact point requested without the cache (--no_elevation_cache).
+QUANTUM_DEGREES: float = 1e-4
+MAX_ENTRIES: int = 2_000_000
+
+
+def default_cache_path() -> Path:
+    """Per-user location of the persistent elevation cache."""
+    if sys.platform == "win32":
+        base = Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local"))
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    return base / "drone_footprints" / "elevations.sqlite"
+
+
+class ElevationCache:
+    """
+    Persistent terrain elevation cache in SQLite, keyed by quantized latitude/longitude.
+
+    Each cell holds the elevation at its centre, which stands for every point of the cell.
+
+    Every lookup refreshes the entry's last-used time; when the cache grows beyond max_entries the least
+    recently used entries are evicted. The database can be shared by concurrent runs and worker processes.
+    """
+
+    def __init__(self, path, max_entries: int = MAX_ENTRIES, quantum: float = QUANTUM_DEGREES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.quantum = quantum
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared with forked processes; each process opens its own.
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS elevations ("
+                                     "lat_q INTEGER NOT NULL, lon_q INTEGER NOT NULL, elevation REAL NOT NULL, "
+                                     "last_used REAL NOT NULL, PRIMARY KEY (lat_q, lon_q)) WITHOUT ROWID")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS elevations_last_used ON elevations (last_used)")
+            self._pid = os.getpid()
+        return self._connection
+
+    def cell(self, latitude: float, longitude: float) -> tuple:
+        """Quantized (latitude, longitude) cell containing a point."""
+        return round(latitude / self.quantum), round(longitude / self.quantum)
+
+    def cell_centre(self, cell: tuple) -> tuple:
+        """(latitude, longitude) at which the elevation of a cell is requested."""
+        return round(cell[0] * self.quantum, 7), round(cell[1] * self.quantum, 7)
+
+    def get_many(self, cells) -> dict:
+        """
+        Cached elevations of the given cells.
+
+        Returns:
+            dict: Elevation in meters keyed by cell, for the cells found in the cache.
+        """
+        cells = list(dict.fromkeys(cells))
+        found = {}
+        try:
+            with self.connection as connection:
+                for cell in cells:
+                    row = connection.execute("SELECT elevation FROM elevations WHERE lat_q = ? AND lon_q = ?",
+                                             cell).fetchone()
+                    if row is not None:
+                        found[cell] = row[0]
+                now = time.time()
+                connection.executemany("UPDATE elevations SET last_used = ? WHERE lat_q = ? AND lon_q = ?",
+                                       [(now, *cell) for cell in found])
+        except sqlite3.Error as err:
+            logger.warning(f"Elevation cache {self.path} is unusable: {err}")
+        self.hits += len(found)
+        self.misses += len(cells) - len(found)
+        return found
+
+    def put_many(self, elevations: dict):
+        """
+        Store elevations keyed by cell and evict the least recently used entries beyond max_entries.
+        """
+        if not elevations:
+            return
+        now = time.time()
+        try:
+            with self.connection as connection:
+                connection.executemany("INSERT OR REPLACE INTO elevations VALUES (?, ?, ?, ?)",
+                                       [(*cell, elevation, now) for cell, elevation in elevations.items()])
+                excess = connection.execute("SELECT COUNT(*) FROM elevations").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    connection.execute("DELETE FROM elevations WHERE (lat_q, lon_q) IN (SELECT lat_q, lon_q "
+                                       "FROM elevations ORDER BY last_used LIMIT ?)", (excess,))
+        except sqlite3.Error as err:
+            logger.warning(f"Elevation cache {self.path} is unusable: {err}")
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    def stats(self) -> dict:
+        return dict(cache_hits=self.hits, cache_misses=self.misses)
@@ -0,0 +1,149 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+import asyncio
+import http.client
+import json
+import random
+from urllib.parse import urlsplit
+from loguru import logger
+
+DEFAULT_ELEVATION_URL = "https://api.open-elevation.com/api/v1/lookup"
+# Coordinates are deduplicated after rounding to this many decimals (about 10 cm).
+COORDINATE_DECIMALS: int = 6
+
+
+class ElevationServiceError(Exception):
+    """Raised when the elevation service cannot answer a request after all retries."""
+
+
+class OpenElevationClient:
+    """
+    Batched client for the Open-Elevation lookup API.
+
+    Points are deduplicated and sent in large POST requests. Requests run concurrently from asyncio over a
+    small pool of persistent (keep-alive) HTTP connections, with bounded concurrency and exponential backoff
+    with jitter between retries.
+    """
+
+    def __init__(self, url: str = DEFAULT_ELEVATION_URL, batch_size: int = 1000, concurrency: int = 4,
+                 max_retries: int = 5, backoff: float = 0.5, max_backoff: float = 30.0, timeout: float = 60.0):
+        parts = urlsplit(url)
+        self.url = url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or "/api/v1/lookup"
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.requests = 0
+        self.failures = 0
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _post(self, connection: http.client.HTTPConnection, batch: list[tuple]) -> list[float]:
+        body = json.dumps({"locations": [{"latitude": lat, "longitude": lon} for lat, lon in batch]})
+        connection.request("POST", self.path, body=body,
+                           headers={"Content-Type": "application/json", "Accept": "application/json"})
+        response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise ElevationServiceError(f"HTTP {response.status} {response.reason}")
+        results = json.loads(data)["results"]
+        if len(results) != len(batch):
+            raise ElevationServiceError(f"Expected {len(batch)} elevations, received {len(results)}")
+        return [float(result["elevation"]) for result in results]
+
+    async def _lookup_batch(self, pool: asyncio.Queue, batch: list[tuple]) -> list[float]:
+        for attempt in range(self.max_retries + 1):
+            connection = await pool.get()
+            try:
+                self.requests += 1
+                return await asyncio.to_thread(self._post, connection, batch)
+            except (OSError, http.client.HTTPException, ValueError, KeyError, ElevationServiceError) as error:
+                self.failures += 1
+                # Drop the socket; http.client reconnects on the next request.
+                connection.close()
+                if attempt == self.max_retries:
+                    raise ElevationServiceError(
+                        f"{self.url} failed {attempt + 1} times for a batch of {len(batch)} points: {error}")
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                logger.warning(f"Elevation service error ({error}); retrying in {delay:.1f}s.")
+            finally:
+                pool.put_nowait(connection)
+            await asyncio.sleep(delay)
+
+    async def lookup_async(self, points: list[tuple]) -> list:
+        """
+        Look up terrain elevations for unique (latitude, longitude) points.
+
+        Batches are independent: a batch that still fails after all retries leaves its points unanswered
+        without discarding the others.
+
+        Returns:
+            list: Elevations in meters in the order of the points, None for the points of failed batches.
+
+        Raises:
+            ElevationServiceError: If every batch failed.
+        """
+        pool = asyncio.Queue()
+        connections = [self._connect() for _ in range(max(1, self.concurrency))]
+        for connection in connections:
+            pool.put_nowait(connection)
+        batches = [points[i:i + self.batch_size] for i in range(0, len(points), self.batch_size)]
+        tasks = [asyncio.create_task(self._lookup_batch(pool, batch)) for batch in batches]
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # On cancellation, stop the batches still running before their connections are closed.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for connection in connections:
+                connection.close()
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for error in errors:
+            if not isinstance(error, ElevationServiceError):
+                raise error
+        if errors and len(errors) == len(batches):
+            raise errors[0]
+        for error in errors:
+            logger.error(f"Elevation service error: {error}. These points have no terrain elevation.")
+        elevations = []
+        for batch, result in zip(batches, results):
+            elevations.extend([None] * len(batch) if isinstance(result, BaseException) else result)
+        return elevations
+
+    def lookup(self, points: list[tuple]) -> dict:
+        """
+        Look up terrain elevations for (latitude, longitude) points, sending each distinct point once.
+
+        Returns:
+            dict: Elevation in meters keyed by the rounded (latitude, longitude) of each point
+            (see elevation_key); points of batches that failed after all retries are left out.
+
+        Raises:
+            ElevationServiceError: If every batch failed.
+        """
+        unique_points = list(dict.fromkeys(elevation_key(lat, lon) for lat, lon in points))
+        if not unique_points:
+            return {}
+        elevations = asyncio.run(self.lookup_async(unique_points))
+        return {point: elevation for point, elevation in zip(unique_points, elevations) if elevation is not None}
+
+    def stats(self) -> dict:
+        return dict(requests=self.requests, failures=self.failures)
+
+
+def elevation_key(latitude: float, longitude: float) -> tuple:
+    """Rounded (latitude, longitude) used to deduplicate and cache elevation lookups."""
+    return round(float(latitude), COORDINATE_DECIMALS), round(float(longitude), COORDINATE_DECIMALS)
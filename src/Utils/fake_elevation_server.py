@@ -0,0 +1,145 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Local stand-in for the Open-Elevation lookup API.
+
+Answers GET /api/v1/lookup?locations=lat,lon|lat,lon and POST /api/v1/lookup {"locations": [...]} like
+api.open-elevation.com, with elevations from a smooth synthetic terrain. Used to test and benchmark the
+elevation client without network access:
+
+    python Utils/fake_elevation_server.py --port 8080
+    python Drone_Footprints.py -i ... -o ... -m --elevation_url http://127.0.0.1:8080/api/v1/lookup
+
+or from Python:
+
+    with FakeElevationServer() as server:
+        ...  # use server.url
+"""
+
+import argparse
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+LOOKUP_PATH = "/api/v1/lookup"
+
+
+def synthetic_elevation(latitude: float, longitude: float, base: float = 1000.0) -> float:
+    """Smooth synthetic terrain: gentle hills of +/- 50 m with a wavelength of about a kilometre."""
+    return base + 50.0 * math.sin(math.radians(latitude) * 6000) * math.cos(math.radians(longitude) * 6000)
+
+
+class FakeElevationHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        locations = parse_qs(parts.query).get("locations", [""])[0]
+        points = []
+        for location in filter(None, locations.split("|")):
+            lat, lon = location.split(",")
+            points.append((float(lat), float(lon)))
+        self._answer(parts.path, points)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            points = [(float(location["latitude"]), float(location["longitude"]))
+                      for location in json.loads(body)["locations"]]
+        except (ValueError, KeyError, TypeError):
+            self._send(400, {"error": "Invalid JSON."})
+            return
+        self._answer(urlsplit(self.path).path, points)
+
+    def _answer(self, path, points):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            request_number = server.requests
+            server.points += len(points)
+        if path != LOOKUP_PATH:
+            self._send(404, {"error": "Not found."})
+        elif server.fail_every and request_number % server.fail_every == 0:
+            self._send(503, {"error": "Simulated failure."})
+        else:
+            results = [dict(latitude=lat, longitude=lon, elevation=synthetic_elevation(lat, lon, server.base))
+                       for lat, lon in points]
+            self._send(200, {"results": results})
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FakeElevationServer(ThreadingHTTPServer):
+    """
+    Threaded fake elevation server; port 0 picks a free port. Counts requests and points served.
+
+    Parameters:
+    - host (str): Interface to bind.
+    - port (int): Port to bind, 0 for any free port.
+    - base (float): Mean elevation of the synthetic terrain in meters.
+    - fail_every (int): Answer every Nth request with HTTP 503 to exercise retries (0 disables).
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, base: float = 1000.0, fail_every: int = 0,
+                 verbose: bool = False):
+        super().__init__((host, port), FakeElevationHandler)
+        self.base = base
+        self.fail_every = fail_every
+        self.verbose = verbose
+        self.requests = 0
+        self.points = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{LOOKUP_PATH}"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Open-Elevation lookup API.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default: 8080).")
+    parser.add_argument("--base", type=float, default=1000.0, help="Mean terrain elevation in meters.")
+    parser.add_argument("--fail_every", type=int, default=0,
+                        help="Answer every Nth request with HTTP 503 to exercise client retries.")
+    args = parser.parse_args()
+
+    server = FakeElevationServer(args.host, args.port, args.base, args.fail_every, verbose=True)
+    print(f"Serving fake elevations on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
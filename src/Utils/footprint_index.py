@@ -0,0 +1,186 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Persisted spatial index of the mission footprints and the queries it answers.
+
+process_metadata writes footprint_index.npz to the output directory from the run manifest records: for each
+image its footprint corners in WGS84 (in the order of the image corners) and the homography from ground coordinates
+to source image pixels. For images with a GeoTIFF, the homography is the inverse of the perspective transform of
+their warp (raster_utils.pixel_homography), in the output CRS; for the others (--footprints_only, records of earlier
+versions), it is fitted to the WGS84 footprint corners. FootprintIndex loads the arrays and answers which images
+cover a point or a bounding box, through a shapely STRtree of the footprints built once per load; a point query also
+returns the source pixel of the point in each covering image.
+"""
+
+from pathlib import Path
+import numpy as np
+from loguru import logger
+
+INDEX_FILE_NAME: str = "footprint_index.npz"
+
+
+def ground_to_pixel_homographies(corners: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    Homographies from WGS84 coordinates, relative to the first footprint corner, to source image pixels, fitted
+    to the footprint corners. Used for images that were not warped; all images are solved in one batch.
+
+    Parameters:
+    - corners (numpy.ndarray): Footprint corners (longitude, latitude) of N images, shape (N, 4, 2), in the order
+      of the image corners (top-left, top-right, bottom-right, bottom-left).
+    - sizes (numpy.ndarray): Width and height of the source images in pixels, shape (N, 2).
+
+    Returns:
+    - numpy.ndarray: The 3x3 matrices, shape (N, 3, 3); NaN for footprints without four distinct corners.
+    """
+    count = len(corners)
+    homographies = np.full((count, 3, 3), np.nan)
+    ground = corners - corners[:, :1]
+    # Solve in normalized coordinates for a well conditioned system, then fold the scale back in.
+    scale = np.abs(ground).max(axis=(1, 2))
+    usable = np.isfinite(scale) & (scale > 0) & (sizes > 0).all(axis=1)
+    if not usable.any():
+        return homographies
+    ground, scale, sizes = ground[usable] / scale[usable, None, None], scale[usable], sizes[usable]
+    width, height = sizes[:, 0], sizes[:, 1]
+    zero = np.zeros_like(width)
+    pixels = np.stack([np.stack([zero, zero], 1), np.stack([width, zero], 1), np.stack([width, height], 1),
+                       np.stack([zero, height], 1)], axis=1)
+    x, y, u, v = ground[..., 0], ground[..., 1], pixels[..., 0], pixels[..., 1]
+    one, nil = np.ones_like(x), np.zeros_like(x)
+    rows_u = np.stack([x, y, one, nil, nil, nil, -u * x, -u * y], axis=-1)
+    rows_v = np.stack([nil, nil, nil, x, y, one, -v * x, -v * y], axis=-1)
+    system = np.stack([rows_u, rows_v], axis=2).reshape(-1, 8, 8)
+    values = np.stack([u, v], axis=2).reshape(-1, 8)
+    solvable = np.abs(np.linalg.det(system)) > 1e-12
+    solved = np.full((len(system), 9), np.nan)
+    solved[solvable, :8] = np.linalg.solve(system[solvable], values[solvable][..., None])[..., 0]
+    solved[solvable, 8] = 1.0
+    solved = solved.reshape(-1, 3, 3)
+    solved[:, :, :2] /= scale[:, None, None]
+    homographies[usable] = solved
+    return homographies
+
+
+def write_index(records: list[dict], output_directory) -> Path:
+    """
+    Write the footprint index of a mission from its run manifest records (see run_manifest.image_record).
+
+    The pixel homography of an image comes from the grid of its GeoTIFF (see raster_utils.raster_grid), in the
+    output CRS relative to the upper-left corner of the grid; without one it is fitted in WGS84, relative to the
+    first footprint corner. Records written by earlier versions, without footprint corners, are indexed by their
+    GeoJSON polygon and answer queries without a source pixel.
+
+    Returns:
+    - Path: The index file, or None when it could not be written.
+    """
+    count = len(records)
+    corners = np.full((count, 4, 2), np.nan)
+    sizes = np.zeros((count, 2))
+    for i, record in enumerate(records):
+        footprint = record.get("corners")
+        if footprint and len(footprint) == 4:
+            corners[i] = footprint
+            sizes[i] = [value or 0 for value in record.get("image_size") or (0, 0)]
+        else:
+            ring = record["polygon"]["geometry"]["coordinates"][0]
+            corners[i] = ring[:4] if len(ring) >= 5 else np.nan
+    homographies = ground_to_pixel_homographies(corners, sizes)
+    origins = corners[:, 0].copy()
+    epsgs = np.full(count, 4326)
+    for i, record in enumerate(records):
+        raster = record.get("raster") or {}
+        if record.get("geotiff") and raster.get("pixel_homography"):
+            homographies[i] = raster["pixel_homography"]
+            origins[i] = raster["transform"][2], raster["transform"][5]
+            epsgs[i] = record.get("epsg") or 4326
+    path = Path(output_directory) / INDEX_FILE_NAME
+    try:
+        with open(path, "wb") as file:
+            np.savez(file, corners=corners, homographies=homographies, origins=origins, epsgs=epsgs,
+                     file_names=np.array([record["file_name"] for record in records], dtype=str),
+                     geotiffs=np.array([record.get("geotiff") or "" for record in records], dtype=str),
+                     datetimes=np.array([record.get("datetime_original") or "" for record in records], dtype=str))
+    except OSError as e:
+        logger.warning(f"Could not write the footprint index: {e}")
+        return None
+    logger.debug(f"Footprint index of {count} images written to {path}.")
+    return path
+
+
+class FootprintIndex:
+    """
+    Footprint index of a mission, loaded from footprint_index.npz.
+
+    Coordinates are WGS84 longitude and latitude, like the mission GeoJSON. Source pixels are (column, row) in
+    the full-resolution image, from its top-left corner; a point is projected to the CRS of the homography of each
+    image first.
+    """
+
+    def __init__(self, path):
+        path = Path(path)
+        if path.is_dir():
+            path = path / INDEX_FILE_NAME
+        with np.load(path) as arrays:
+            self.corners = arrays["corners"]
+            self.homographies = arrays["homographies"]
+            self.file_names = arrays["file_names"]
+            self.geotiffs = arrays["geotiffs"]
+            self.datetimes = arrays["datetimes"]
+            # Indexes written by earlier versions only hold homographies fitted in WGS84.
+            self.origins = arrays["origins"] if "origins" in arrays else self.corners[:, 0]
+            self.epsgs = arrays["epsgs"] if "epsgs" in arrays else np.full(len(self.corners), 4326)
+        self.path = path
+        self._transformers = {}
+        valid = ~np.isnan(self.corners).any(axis=(1, 2))
+        self._ids = np.flatnonzero(valid)
+        # shapely is only loaded to query an index, not by process_metadata, which writes it.
+        import shapely
+        self._tree = shapely.STRtree(shapely.polygons(self.corners[valid]))
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def _project(self, epsg, longitude, latitude) -> tuple:
+        """A WGS84 point in the CRS of a pixel homography."""
+        if epsg == 4326:
+            return longitude, latitude
+        if epsg not in self._transformers:
+            from pyproj import Transformer
+            self._transformers[epsg] = Transformer.from_crs(4326, epsg, always_xy=True)
+        return self._transformers[epsg].transform(longitude, latitude)
+
+    def _match(self, i, pixel=None) -> dict:
+        match = dict(file_name=str(self.file_names[i]), geotiff=str(self.geotiffs[i]) or None,
+                     datetime_original=str(self.datetimes[i]) or None)
+        if pixel is not None:
+            match["pixel"] = pixel
+        return match
+
+    def query_bbox(self, min_longitude, min_latitude, max_longitude, max_latitude) -> list[dict]:
+        """Images whose footprint intersects a bounding box, in mission order."""
+        import shapely
+        hits = self._tree.query(shapely.box(min_longitude, min_latitude, max_longitude, max_latitude),
+                                predicate="intersects")
+        return [self._match(i) for i in np.sort(self._ids[hits])]
+
+    def query_point(self, longitude, latitude) -> list[dict]:
+        """
+        Images whose footprint covers a point, in mission order, with the source pixel of the point in each
+        ([column, row], or None when the image has no pixel mapping).
+        """
+        import shapely
+        hits = np.sort(self._ids[self._tree.query(shapely.Point(longitude, latitude), predicate="intersects")])
+        if not len(hits):
+            return []
+        points = np.empty((len(hits), 2))
+        for epsg in np.unique(self.epsgs[hits]):
+            selected = self.epsgs[hits] == epsg
+            points[selected] = self._project(int(epsg), longitude, latitude)
+        ground = np.column_stack([points - self.origins[hits], np.ones(len(hits))])
+        projected = np.einsum("nij,nj->ni", self.homographies[hits], ground)
+        pixels = projected[:, :2] / projected[:, 2:]
+        return [self._match(i, None if np.isnan(pixel).any() else [round(float(value), 2) for value in pixel])
+                for i, pixel in zip(hits, pixels)]
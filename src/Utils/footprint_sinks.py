@@ -0,0 +1,233 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Streamed, columnar and indexed footprint outputs, written as images finish.
+
+- GeoJSONSeq (RFC 8142): the Point and Polygon features of each image are appended and flushed as soon as the
+  image is complete, and the flight line once the mission is, so the file can be tailed during processing.
+
+For the columnar outputs, each image is one row: its footprint polygon (WGS84) and its properties, stored once, with the drone position
+as Longitude and Latitude columns instead of a second Point feature.
+- GeoParquet: rows are buffered and written as Parquet row groups, with the GeoParquet 1.1 "geo" metadata and
+  a bbox covering column for spatial filtering.
+- FlatGeobuf: its packed Hilbert R-tree precedes the features in the file, so it can only be completed once
+  every footprint is known. Rows are spooled to the GeoParquet file (a temporary one if GeoParquet was not
+  requested) and streamed into the GDAL FlatGeobuf writer (through pyogrio) batch by batch when the sink is
+  closed.
+"""
+
+import json
+import os
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from loguru import logger
+
+ROW_GROUP_SIZE: int = 1024
+# Image properties (see ImageDrone.create_properties) and their column types.
+PROPERTY_TYPES: dict = {
+    "File_Name": pa.string(), "Focal_Length": pa.float64(), "Image_Width": pa.int64(), "Image_Height": pa.int64(),
+    "Sensor_Model": pa.string(), "Sensor_index": pa.string(), "Sensor_Make": pa.string(),
+    "RelativeAltitude": pa.float64(), "AbsoluteAltitude": pa.float64(), "EffectiveAltitude": pa.float64(),
+    "FlightYawDegree": pa.float64(), "FlightPitchDegree": pa.float64(), "FlightRollDegree": pa.float64(),
+    "DateTimeOriginal": pa.string(), "GimbalPitchDegree": pa.float64(), "GimbalYawDegree": pa.float64(),
+    "GimbalRollDegree": pa.float64(), "Longitude": pa.float64(), "Latitude": pa.float64(),
+    "Sensor_Width": pa.float64(), "Sensor_Height": pa.float64(), "CameraMake": pa.string(),
+    "Drone_Make": pa.string(), "Drone_Model": pa.string(), "MaxApertureValue": pa.float64(),
+    "lens_FOV1h": pa.float64(), "lens_FOVw1": pa.float64(), "GSD": pa.float64(), "epsgCode": pa.int64(),
+}
+BBOX_TYPE = pa.struct([("xmin", pa.float64()), ("ymin", pa.float64()), ("xmax", pa.float64()),
+                       ("ymax", pa.float64())])
+SCHEMA = pa.schema([(name, value_type) for name, value_type in PROPERTY_TYPES.items()]
+                   + [("bbox", BBOX_TYPE), ("geometry", pa.binary())])
+GEO_METADATA: dict = {
+    "version": "1.1.0",
+    "primary_column": "geometry",
+    "columns": {"geometry": {
+        "encoding": "WKB", "geometry_types": ["Polygon"], "edges": "planar",
+        "covering": {"bbox": {"xmin": ["bbox", "xmin"], "ymin": ["bbox", "ymin"], "xmax": ["bbox", "xmax"],
+                              "ymax": ["bbox", "ymax"]}},
+    }},
+}
+FILE_SUFFIXES: dict = {"geojsonseq": ".geojsons", "geoparquet": ".parquet", "flatgeobuf": ".fgb"}
+# RFC 8142 record separator, written before each feature.
+RECORD_SEPARATOR: str = "\x1e"
+
+
+def _value(value, value_type):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if pa.types.is_string(value_type):
+        return str(value)
+    if pa.types.is_integer(value_type):
+        return int(value)
+    return float(value)
+
+
+def record_row(record: dict) -> dict:
+    """One row of the footprint table from a run manifest record (see run_manifest.image_record)."""
+    properties = dict(record["polygon"]["properties"])
+    longitude, latitude = properties.pop("DroneCoordinates", None) or (record.get("longitude"),
+                                                                        record.get("latitude"))
+    properties.update(Longitude=longitude, Latitude=latitude)
+    row = {name: _value(properties.get(name), value_type) for name, value_type in PROPERTY_TYPES.items()}
+    row["ring"] = record["polygon"]["geometry"]["coordinates"][0]
+    return row
+
+
+def rows_to_batch(rows: list[dict]) -> pa.RecordBatch:
+    """A record batch of footprint rows, with the WKB polygons and their bounding boxes."""
+    polygons = [shapely.Polygon(row["ring"]) for row in rows]
+    bounds = shapely.bounds(polygons)
+    columns = [pa.array([row[name] for row in rows], type=value_type) for name, value_type in PROPERTY_TYPES.items()]
+    columns.append(pa.StructArray.from_arrays([pa.array(bounds[:, i]) for i in range(4)],
+                                              fields=list(BBOX_TYPE)))
+    columns.append(pa.array(shapely.to_wkb(polygons), type=pa.binary()))
+    return pa.RecordBatch.from_arrays(columns, schema=SCHEMA)
+
+
+class FootprintSinks:
+    """
+    Footprint outputs of a mission, fed one manifest record at a time as images finish.
+
+    Parameters:
+    - formats (list[str]): Output formats among "geojsonseq", "geoparquet" and "flatgeobuf"; other formats are
+      ignored.
+    - directory (str or Path): Output directory of the files.
+    - name (str): Base name of the files (e.g. M_2024-02-06_11-16).
+    """
+
+    def __init__(self, formats, directory, name: str):
+        self.directory = Path(directory)
+        self.geojsonseq_file = self.directory / f"{name}{FILE_SUFFIXES['geojsonseq']}" \
+            if "geojsonseq" in formats else None
+        self.parquet_file = self.directory / f"{name}{FILE_SUFFIXES['geoparquet']}"
+        self.flatgeobuf_file = self.directory / f"{name}{FILE_SUFFIXES['flatgeobuf']}" \
+            if "flatgeobuf" in formats else None
+        self.keep_parquet = "geoparquet" in formats
+        if not self.keep_parquet:
+            self.parquet_file = self.directory / f".{name}.spool.parquet"
+        self.spool = self.keep_parquet or self.flatgeobuf_file is not None
+        self.enabled = self.spool or self.geojsonseq_file is not None
+        self.rows = []
+        self.count = 0
+        self.features = 0
+        self._writer = None
+        self._sequence = None
+
+    def write(self, record: dict):
+        """
+        Add the footprint of an image: its features are appended to the GeoJSONSeq file at once, and a row group
+        is written every ROW_GROUP_SIZE images.
+        """
+        if not self.enabled or not record.get("polygon"):
+            return
+        if self.geojsonseq_file is not None:
+            self._append_features([record["point"], record["polygon"]])
+        if self.spool:
+            self.rows.append(record_row(record))
+            if len(self.rows) >= ROW_GROUP_SIZE:
+                self._flush()
+
+    def write_flight_line(self, feature: dict):
+        """Append the flight line of the mission (see meta_data.mission_feature_collection) to the GeoJSONSeq file."""
+        if self.geojsonseq_file is not None and feature:
+            self._append_features([feature])
+
+    def _append_features(self, features: list[dict]):
+        if self._sequence is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._sequence = open(self.geojsonseq_file, "w", encoding="utf-8")
+        self._sequence.write("".join(f"{RECORD_SEPARATOR}{json.dumps(feature)}\n" for feature in features))
+        # Readers tailing the file see every image as soon as it is complete.
+        self._sequence.flush()
+        self.features += len(features)
+
+    def _flush(self):
+        if not self.rows:
+            return
+        if self._writer is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            schema = SCHEMA.with_metadata({"geo": json.dumps(GEO_METADATA)})
+            self._writer = pq.ParquetWriter(self.parquet_file, schema, compression="zstd")
+        self._writer.write_batch(rows_to_batch(self.rows))
+        self.count += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        """Write the last row group, complete the files and remove the spool file."""
+        if not self.enabled:
+            return
+        if self._sequence is not None:
+            self._sequence.close()
+            self._sequence = None
+            logger.info(f"GeoJSONSeq of {self.features} features written to {self.geojsonseq_file}.")
+        try:
+            self._flush()
+        finally:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        if not self.count:
+            return
+        try:
+            if self.flatgeobuf_file is not None:
+                write_flatgeobuf(self.parquet_file, self.flatgeobuf_file)
+        finally:
+            if not self.keep_parquet and self.parquet_file.exists():
+                os.remove(self.parquet_file)
+        if self.keep_parquet:
+            logger.info(f"GeoParquet footprints of {self.count} images written to {self.parquet_file}.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def flatgeobuf_unavailable():
+    """
+    Why FlatGeobuf footprints cannot be written in this environment.
+
+    Returns:
+    - str: What is missing, or None when pyogrio 0.8 and GDAL 3.8 or later are available.
+    """
+    try:
+        import pyogrio
+        from pyogrio.raw import write_arrow  # noqa: F401
+    except ImportError:
+        return "needs pyogrio 0.8 or later (pip install pyogrio)"
+    if pyogrio.__gdal_version__ < (3, 8, 0):
+        return f"needs GDAL 3.8 or later, pyogrio uses GDAL {pyogrio.__gdal_version_string__}"
+    return None
+
+
+def write_flatgeobuf(parquet_file: Path, flatgeobuf_file: Path):
+    """
+    Convert a footprint GeoParquet file to a spatially indexed FlatGeobuf file, one row group at a time.
+
+    Needs pyogrio 0.8 and GDAL 3.8 or later (see flatgeobuf_unavailable).
+    """
+    try:
+        from pyogrio.raw import write_arrow
+    except ImportError:
+        logger.warning("FlatGeobuf output needs pyogrio; it was not written.")
+        return
+    source = pq.ParquetFile(parquet_file)
+    schema = SCHEMA.remove(SCHEMA.get_field_index("bbox"))
+    batches = (batch.drop_columns(["bbox"]) for batch in source.iter_batches(batch_size=ROW_GROUP_SIZE))
+    try:
+        write_arrow(pa.RecordBatchReader.from_batches(schema, batches), str(flatgeobuf_file), driver="FlatGeobuf",
+                    geometry_name="geometry", geometry_type="Polygon", crs="EPSG:4326",
+                    layer_options={"SPATIAL_INDEX": "YES"})
+    except Exception as e:
+        logger.opt(exception=True).warning(f"Could not write the FlatGeobuf footprints: {e}")
+        return
+    logger.info(f"FlatGeobuf footprints of {source.metadata.num_rows} images written to {flatgeobuf_file}.")
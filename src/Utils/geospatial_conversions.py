@@ -4,11 +4,49 @@
 #  __version__ = "1.0"
 
 import math
+from functools import lru_cache
+import numpy as np
 import utm
 from pyproj import Transformer, CRS, Geod
 import Utils.config as config
 from loguru import logger
 
+WGS84_LATLONG = "+proj=latlong +datum=WGS84"
+
+
+@lru_cache(maxsize=None)
+def get_transformer(source_crs, target_crs) -> Transformer:
+    """
+    Return the shared always_xy Transformer between two coordinate reference systems.
+
+    Transformers are built once per (source CRS, target CRS) pair and reused for every image of a mission,
+    which almost always stays within one UTM zone and one output EPSG code.
+
+    Parameters:
+    - source_crs, target_crs (str or int): Any CRS definition accepted by pyproj (EPSG code, "epsg:XXXX" or PROJ
+      string). Use the same spelling for the same CRS to share a transformer.
+
+    Returns:
+    Transformer: A transformer object for coordinate conversion.
+    """
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def utm_crs(longitude, latitude) -> str:
+    """
+    PROJ definition of the WGS84 UTM zone containing a point.
+
+    Parameters:
+    - longitude (float): Longitude in decimal degrees.
+    - latitude (float): Latitude in decimal degrees.
+
+    Returns:
+    str: PROJ string of the UTM zone.
+    """
+    utm_zone = int((longitude + 180) / 6) + 1
+    hemisphere = "north" if latitude >= 0 else "south"
+    return f"+proj=utm +zone={utm_zone} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
+
 
 def decimal_degrees_to_utm(latitude, longitude):
     """
@@ -32,23 +70,39 @@ def longitude_to_utm_zone(longitude):
 
 
 def gps_to_utm(latitude, longitude):
-    zone_number = longitude_to_utm_zone(longitude)
-    hemisphere = "north" if latitude >= 0 else "south"
-    is_southern = latitude < 0
-    utm_crs = CRS(proj="utm", zone=zone_number, ellps="WGS84", datum="WGS84", south=is_southern)
-    wgs84_crs = CRS(proj="latlong", datum="WGS84")
-    transformer = Transformer.from_crs(wgs84_crs, utm_crs, always_xy=True)
-    x, y = transformer.transform(longitude, latitude)  # Corrected order
-    return float(x), float(y), zone_number, hemisphere
+    """
+    Convert WGS84 coordinates to UTM in the zone of each point.
+
+    Parameters:
+    - latitude (float or array): Latitude in decimal degrees.
+    - longitude (float or array): Longitude in decimal degrees.
+
+    Returns:
+    tuple: Easting, northing, zone number and hemisphere ("north"/"south"). For array input each element is an
+    array and points are transformed with one bulk call per UTM zone.
+    """
+    if np.ndim(latitude) == 0 and np.ndim(longitude) == 0:
+        zone_number = longitude_to_utm_zone(longitude)
+        hemisphere = "north" if latitude >= 0 else "south"
+        x, y = get_transformer(WGS84_LATLONG, utm_crs(longitude, latitude)).transform(longitude, latitude)
+        return float(x), float(y), zone_number, hemisphere
+
+    latitude, longitude = np.broadcast_arrays(np.asarray(latitude, dtype=np.float64),
+                                              np.asarray(longitude, dtype=np.float64))
+    zone_numbers = ((longitude + 180) / 6).astype(int) + 1
+    hemispheres = np.where(latitude >= 0, "north", "south")
+    x = np.empty(latitude.shape)
+    y = np.empty(latitude.shape)
+    for zone_number, hemisphere in set(zip(zone_numbers.ravel().tolist(), hemispheres.ravel().tolist())):
+        mask = (zone_numbers == zone_number) & (hemispheres == hemisphere)
+        first = np.flatnonzero(mask.ravel())[0]
+        crs = utm_crs(longitude.ravel()[first], latitude.ravel()[first])
+        x[mask], y[mask] = get_transformer(WGS84_LATLONG, crs).transform(longitude[mask], latitude[mask])
+    return x, y, zone_numbers, hemispheres
 
 
 def get_utm_transformer(latitude, longitude):
-    zone_number = longitude_to_utm_zone(longitude)
-    is_southern = latitude < 0
-    utm_crs = CRS(proj="utm", zone=zone_number, ellps="WGS84", datum="WGS84", south=is_southern)
-    wgs84_crs = CRS(proj="latlong", datum="WGS84")
-    transformer = Transformer.from_crs(wgs84_crs, utm_crs, always_xy=True)
-    return transformer
+    return get_transformer(WGS84_LATLONG, utm_crs(longitude, latitude))
 
 
 def find_epsg_code(utm_x, utm_y):
@@ -122,12 +176,11 @@ def proj_stuff(center_latitude, zone_number):
     Returns:
     Transformer: A transformer object for coordinate conversion.
     """
-    is_southern = center_latitude < 0
+    hemisphere = "south" if center_latitude < 0 else "north"
+    crs_utm = f"+proj=utm +zone={zone_number} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
 
     try:
-        utm_crs = CRS(proj="utm", zone=zone_number, ellps="WGS84", datum="WGS84", south=is_southern)
-        wgs84_crs = CRS(proj="latlong", datum="WGS84")
-        transformer = Transformer.from_crs(utm_crs, wgs84_crs, always_xy=True)
+        transformer = get_transformer(crs_utm, WGS84_LATLONG)
     except Exception as e:
         logger.opt(exception=True).warning(f"Error initializing transformer: {e}")
     return transformer
@@ -146,8 +199,7 @@ def proj_stuff2(zone_number, hemisphere):
     """
     south_flag = "+south" if hemisphere == "S" else ""
     proj_utm = f"+proj=utm +zone={zone_number} {south_flag} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
-    transformer = Transformer.from_proj(proj_utm, "epsg:3857", always_xy=True)
-    return transformer
+    return get_transformer(proj_utm, "epsg:3857")
 
 
 def calculate_geographic_offset(latitude, longitude, distance_meters, bearing_degrees):
@@ -176,52 +228,45 @@ def translate_to_wgs84(bbox, drone_lon, drone_lat):
     Translates a bounding box to geographic coordinates based on the drone's location.
 
     Parameters:
-    - bbox (list): List of bounding box coordinates in UTM.
+    - bbox (list or array): Bounding box coordinates in UTM, as (easting, northing) pairs.
     - drone_lon (float): Drone's longitude in decimal degrees.
     - drone_lat (float): Drone's latitude in decimal degrees.
 
     Returns:
-    List of tuples containing translated bounding box points in geographic coordinates.
+    tuple: Lists of (x, y) points in the output EPSG (config.epsg_code) and in WGS84 decimal degrees.
     """
-    # Determine UTM zone and hemisphere from drone's coordinates
-    crs_geo_outDD = "epsg:4326"
-    crs_geo_out = f"epsg:{config.epsg_code}"
-    # crs_utm = f"+proj=utm +zone={utm_zone} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
-    # utm_crs_code = find_epsg_code(bbox[0][0], bbox[0][1])
-    utm_zone = int((drone_lon + 180) / 6) + 1
-    hemisphere = "north" if drone_lat >= 0 else "south"
-    crs_geo_outDD = "epsg:4326"
-    # crs_geo_out = config.epsg_code
-    crs_utm = f"+proj=utm +zone={utm_zone} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
-
-    # Initialize transformers for coordinate conversion
-    # transformer_to_utm = Transformer.from_crs(crs_geo_in, crs_utm, always_xy=True)
-    transformer_to_geo = Transformer.from_crs(crs_utm, crs_geo_out, always_xy=True)
-    transformer_to_decdree = Transformer.from_crs(crs_utm, crs_geo_outDD, always_xy=True)
-
-    # Convert drone's location to UTM coordinates
-    # drone_easting, drone_northing = transformer_to_utm.transform(drone_lon, drone_lat)
-    translated_bbox = []
-    polybox = []
-    for point in bbox:
-        # Unpack the point tuple into x and y
-        x, y = point
-        # Translate bounding box points
-        # point_easting, point_northing = drone_easting + x, drone_northing + y
-
-        # Convert points back to geographic coordinates
-        point_lat, point_lon = transformer_to_geo.transform(x, y)
-        dd_lat, dd_lon = transformer_to_decdree.transform(x, y)
-        # print("\nEPSG code:", config.epsg_code)
-        # print("UTM CRS:", crs_utm)
-        # print("Input UTM coordinates:", point_lon, point_lat)
-        # print("Output geographic coordinates:", point_lon, point_lat)
-        # exit()
-        translated_bbox.append((point_lat, point_lon))
-        polybox.append((dd_lat, dd_lon))
+    crs_utm = utm_crs(drone_lon, drone_lat)
+    eastings, northings = np.asarray(bbox, dtype=np.float64).reshape(-1, 2).T
+
+    # One bulk transform per target CRS; the default output EPSG is already WGS84.
+    dd_x, dd_y = get_transformer(crs_utm, "epsg:4326").transform(eastings, northings)
+    if int(config.epsg_code) == 4326:
+        geo_x, geo_y = dd_x, dd_y
+    else:
+        geo_x, geo_y = get_transformer(crs_utm, f"epsg:{config.epsg_code}").transform(eastings, northings)
+
+    translated_bbox = list(zip(geo_x.tolist(), geo_y.tolist()))
+    polybox = list(zip(dd_x.tolist(), dd_y.tolist()))
     return translated_bbox, polybox
 
 
+def utm_points_to_latlon(bbox, drone_lon, drone_lat):
+    """
+    Converts UTM points in the zone of the drone to geographic coordinates.
+
+    Parameters:
+    - bbox (list or array): (easting, northing) pairs in the UTM zone of the drone.
+    - drone_lon (float): Drone's longitude in decimal degrees.
+    - drone_lat (float): Drone's latitude in decimal degrees.
+
+    Returns:
+    List of (latitude, longitude) tuples in decimal degrees.
+    """
+    eastings, northings = np.asarray(bbox, dtype=np.float64).reshape(-1, 2).T
+    lons, lats = get_transformer(utm_crs(drone_lon, drone_lat), "epsg:4326").transform(eastings, northings)
+    return list(zip(lats.tolist(), lons.tolist()))
+
+
 def translate_points_to_utm(bbox, drone_lon, drone_lat):
     """
     Translates a bounding box to geographic coordinates based on the drone's location.
@@ -234,26 +279,12 @@ def translate_points_to_utm(bbox, drone_lon, drone_lat):
     Returns:
     List of tuples containing translated bounding box points in geographic coordinates.
     """
-    # Determine UTM zone and hemisphere from drone's coordinates
-    utm_zone = int((drone_lon + 180) / 6) + 1
-    hemisphere = "north" if drone_lat >= 0 else "south"
-    crs_geo = "epsg:4326"
-    # crs_geo_out = config.epsg_code
-    crs_utm = f"+proj=utm +zone={utm_zone} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
-
-    # Initialize transformers for coordinate conversion
-    transformer_to_utm = Transformer.from_crs(crs_geo, crs_utm, always_xy=True)
-
     # Convert drone's location to UTM coordinates
+    transformer_to_utm = get_transformer("epsg:4326", utm_crs(drone_lon, drone_lat))
     drone_easting, drone_northing = transformer_to_utm.transform(drone_lon, drone_lat)
 
-    translated_bbox = []
-    for point in bbox:
-        # Translate bounding box points based on drone's UTM coordinates
-        point_easting, point_northing = drone_easting + point[0], drone_northing + point[1]
-        translated_bbox.append((point_easting, point_northing))
-
-    return translated_bbox
+    offsets = np.asarray(bbox, dtype=np.float64).reshape(-1, 2)
+    return list(zip((drone_easting + offsets[:, 0]).tolist(), (drone_northing + offsets[:, 1]).tolist()))
 
 
 def geographic_to_utm(lon, lat):
@@ -264,66 +295,35 @@ def geographic_to_utm(lon, lat):
     hemisphere_prefix = 326 if lat >= 0 else 327
     epsg_code = int(f"{hemisphere_prefix}{utm_zone}")
     # print(epsg_code)
-    crs_utm = CRS.from_epsg(epsg_code)
-    transformer = Transformer.from_crs(crs_utm, config.epsg_code, always_xy=True)
+    transformer = get_transformer(epsg_code, config.epsg_code)
     easting, northing = transformer.transform(lon, lat)
     return easting, northing, epsg_code, hemisphere
 
 
 def find_geodetic_intersections(bbox, drone_lon, drone_lat):
     """
-    Translates a bounding box to geographic coordinates based on the drone's location.
+    Translates footprint offsets around the drone into UTM coordinates.
 
     Parameters:
-    - bbox (list): List of bounding box coordinates in UTM.
+    - bbox (list or array): (east, north) offsets in meters from the drone position.
     - drone_lon (float): Drone's longitude in decimal degrees.
     - drone_lat (float): Drone's latitude in decimal degrees.
 
     Returns:
-    List of tuples containing translated bounding box points in geographic coordinates.
+    List of (easting, northing) tuples in the UTM zone of the drone.
     """
-    # Determine UTM zone and hemisphere from drone's coordinates
-    utm_zone = int((drone_lon + 180) / 6) + 1
-    hemisphere = "north" if drone_lat >= 0 else "south"
-    crs_geo_in = "epsg:4326"
-    crs_utm = f"+proj=utm +zone={utm_zone} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
-
-    # Initialize transformers for coordinate conversion
-    transformer_to_utm = Transformer.from_crs(crs_geo_in, crs_utm, always_xy=True)
-    transformer_to_geo = Transformer.from_crs(crs_utm, config.epsg_code, always_xy=True)
-
-    # Convert drone's location to UTM coordinates
-    drone_easting, drone_northing = transformer_to_utm.transform(drone_lon, drone_lat)
-
-    translated_bbox = []
-    for point in bbox:
-        # Translate and rotate bounding box points
-        point_easting, point_northing = drone_easting + point.x, drone_northing + point.y
-
-        # Convert points back to geographic coordinates
-        point_lon, point_lat = transformer_to_geo.transform(point_easting, point_northing)
-        translated_bbox.append((point_easting, point_northing))
-
-    return translated_bbox
+    return translate_points_to_utm(bbox, drone_lon, drone_lat)
 
 
 def translate_to_geo_tgt(intersection, drone_lon, drone_lat):
-    # Determine UTM zone and hemisphere from drone's coordinates
-    utm_zone = int((drone_lon + 180) / 6) + 1
-    hemisphere = "north" if drone_lat >= 0 else "south"
-    crs_geo_in = "epsg:4326"
-    crs_utm = f"+proj=utm +zone={utm_zone} +{hemisphere} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
-
-    # Initialize transformers for coordinate conversion
-    transformer_to_utm = Transformer.from_crs(crs_geo_in, crs_utm, always_xy=True)
-    transformer_to_geo = Transformer.from_crs(crs_utm, crs_geo_in, always_xy=True)
+    crs_utm = utm_crs(drone_lon, drone_lat)
 
     # Convert drone's location to UTM coordinates
-    drone_easting, drone_northing = transformer_to_utm.transform(drone_lon, drone_lat)
+    drone_easting, drone_northing = get_transformer("epsg:4326", crs_utm).transform(drone_lon, drone_lat)
 
     # Translate and rotate intersection point
     point_easting, point_northing = drone_easting + intersection.x, drone_northing + intersection.y
 
     # Convert points back to geographic coordinates
-    lon, lat = transformer_to_geo.transform(point_easting, point_northing)
+    lon, lat = get_transformer(crs_utm, "epsg:4326").transform(point_easting, point_northing)
     return lat, lon
@@ -0,0 +1,158 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+import math
+from collections import OrderedDict
+from functools import lru_cache
+import cv2
+import lensfunpy
+import numpy as np
+from loguru import logger
+
+# Full-resolution maps of a 20 MP frame take about 120 MB in fixed-point form; a mission rarely uses more
+# than one or two (camera, lens, focal length) combinations.
+MAX_CACHED_MAPS: int = 4
+# Focus distance only affects vignetting in lensfun, so it is quantized to quarter octaves (about 19 %).
+DISTANCE_STEPS_PER_OCTAVE: int = 4
+
+
+@lru_cache(maxsize=1)
+def get_lens_database() -> lensfunpy.Database:
+    """Return the process-wide lensfun database, parsed on first use."""
+    return lensfunpy.Database()
+
+
+@lru_cache(maxsize=None)
+def find_camera_and_lens(cam_maker: str, cam_model: str):
+    """
+    Look up a camera and its lens in the lensfun database.
+
+    Returns:
+        tuple: (lensfunpy.Camera, lensfunpy.Lens), or None when the camera is not in the database.
+    """
+    db = get_lens_database()
+    try:
+        cam = db.find_cameras(cam_maker, cam_model, True)[0]
+        lens = db.find_lenses(cam, cam_maker, cam_model, True)[0]
+    except IndexError:
+        logger.info(f"Cannot correct lens distortion for {cam_maker} {cam_model}. "
+                    f"Camera properties not found in database.")
+        return None
+    return cam, lens
+
+
+def quantize_distance(distance: float) -> float:
+    """Focus distance rounded to DISTANCE_STEPS_PER_OCTAVE steps per doubling."""
+    if not distance or distance <= 0:
+        return 1000.0
+    return 2 ** (round(math.log2(distance) * DISTANCE_STEPS_PER_OCTAVE) / DISTANCE_STEPS_PER_OCTAVE)
+
+
+class UndistortionMapCache:
+    """
+    LRU cache of lensfun modifiers and full-resolution undistortion maps.
+
+    Entries are keyed by (camera maker, camera model, width, height, focal length, aperture, quantized focus
+    distance). Maps are stored in the fixed-point form of cv2.convertMaps (CV_16SC2), which takes 6 bytes per
+    pixel instead of 8 and lets cv2.remap skip the conversion of float maps on every call.
+    """
+
+    def __init__(self, max_entries: int = MAX_CACHED_MAPS):
+        self.max_entries = max_entries
+        self._maps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(image, width: int, height: int) -> tuple:
+        return (image.camera_make, image.sensor_model, width, height, image.focal_length,
+                image.max_aperture_value, quantize_distance(image.center_distance))
+
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def modifier(key: tuple):
+        """
+        Initialized lensfunpy.Modifier for a cache key, or None when the camera is not in the database.
+        """
+        cam_maker, cam_model, width, height, focal_length, aperture, distance = key
+        camera_and_lens = find_camera_and_lens(cam_maker, cam_model)
+        if camera_and_lens is None:
+            return None
+        cam, lens = camera_and_lens
+        mod = lensfunpy.Modifier(lens, cam.crop_factor, width, height)
+        # The pixel format only matters for vignetting correction, not for the geometry maps.
+        mod.initialize(focal_length, aperture, distance, pixel_format=np.uint8)
+        return mod
+
+    def maps(self, image, width: int, height: int):
+        """
+        Undistortion maps of an image, computed once per key.
+
+        Returns:
+            tuple: (map1, map2) for cv2.remap, or None when the camera is not in the database.
+        """
+        key = self.key(image, width, height)
+        if key in self._maps:
+            self.hits += 1
+            self._maps.move_to_end(key)
+            return self._maps[key]
+
+        self.misses += 1
+        mod = self.modifier(key)
+        maps = None
+        if mod is not None:
+            # Apply geometry distortion correction and obtain distortion maps
+            geometry = mod.apply_geometry_distortion()
+            maps = cv2.convertMaps(geometry[:, :, 0], geometry[:, :, 1], cv2.CV_16SC2)
+        self._maps[key] = maps
+        if len(self._maps) > self.max_entries:
+            self._maps.popitem(last=False)
+        return maps
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses)
+
+
+_map_cache: UndistortionMapCache = None
+
+
+def get_undistortion_map_cache() -> UndistortionMapCache:
+    """Return the process-wide UndistortionMapCache."""
+    global _map_cache
+    if _map_cache is None:
+        _map_cache = UndistortionMapCache()
+    return _map_cache
+
+
+def undistort_image(image, img_array):
+    """
+    Correct the lens distortion of a full image array.
+
+    Parameters:
+    - image (ImageDrone): The image, for its camera, lens and exposure properties.
+    - img_array (numpy.ndarray): The decoded image.
+
+    Returns:
+    numpy.ndarray: The undistorted image, or img_array itself when the camera is not in the database.
+    """
+    height, width = img_array.shape[:2]
+    maps = get_undistortion_map_cache().maps(image, width, height)
+    if maps is None:
+        return img_array
+    return cv2.remap(img_array, maps[0], maps[1], interpolation=cv2.INTER_LANCZOS4)
+
+
+def lens_modifier(image, width: int, height: int):
+    """
+    Initialized lensfunpy.Modifier of an image, shared by images with the same cache key.
+
+    Used by the tiled warp, which evaluates the distortion map window by window instead of caching the full map.
+    """
+    return UndistortionMapCache.modifier(UndistortionMapCache.key(image, width, height))
+
+
+def lens_stats() -> dict:
+    """Counters of the process-wide UndistortionMapCache, empty when no image was undistorted."""
+    return _map_cache.stats() if _map_cache is not None else {}
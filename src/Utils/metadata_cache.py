@@ -0,0 +1,120 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+import hashlib
+import json
+import os
+import sqlite3
+from pathlib import Path
+from loguru import logger
+
+CACHE_FILE_NAME: str = "metadata_cache.sqlite"
+
+
+def file_identity(file) -> tuple:
+    """
+    Cache key of an image file: (absolute path, size in bytes, modification time in nanoseconds).
+    """
+    stat = os.stat(file)
+    return str(Path(file).absolute()), stat.st_size, stat.st_mtime_ns
+
+
+class MetadataCache:
+    """
+    Persistent image metadata cache in SQLite, keyed by file identity (path, size and modification time).
+
+    A file that was replaced or edited gets a new identity and is read again. The cache remembers the tags and
+    ExifTool arguments it was filled with and starts empty when they change.
+    """
+
+    def __init__(self, path, tags: list, exiftool_args: list):
+        self.path = Path(path)
+        self.signature = hashlib.sha1(json.dumps([tags, exiftool_args]).encode()).hexdigest()
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS metadata ("
+                                     "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                                     "data TEXT NOT NULL)")
+            with self._connection as connection:
+                row = connection.execute("SELECT value FROM settings WHERE key = 'signature'").fetchone()
+                if row is None or row[0] != self.signature:
+                    connection.execute("DELETE FROM metadata")
+                    connection.execute("INSERT OR REPLACE INTO settings VALUES ('signature', ?)", (self.signature,))
+        return self._connection
+
+    def contains_many(self, identities: list) -> set:
+        """
+        Identities of the files found in the cache, without loading their metadata.
+
+        Parameters:
+        - identities (list): File identities from file_identity().
+
+        Returns:
+        - set: The identities present in the cache.
+        """
+        found = set()
+        try:
+            connection = self.connection
+            for identity in identities:
+                if connection.execute("SELECT 1 FROM metadata WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                      identity).fetchone() is not None:
+                    found.add(identity)
+        except sqlite3.Error as err:
+            logger.warning(f"Metadata cache {self.path} is unusable: {err}")
+        return found
+
+    def get_many(self, identities: list) -> dict:
+        """
+        Cached metadata of files whose path, size and modification time are unchanged.
+
+        Parameters:
+        - identities (list): File identities from file_identity().
+
+        Returns:
+        - dict: Metadata dictionaries keyed by file identity, for the files found in the cache.
+        """
+        found = {}
+        try:
+            connection = self.connection
+            for identity in identities:
+                row = connection.execute("SELECT data FROM metadata WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                         identity).fetchone()
+                if row is not None:
+                    found[identity] = json.loads(row[0])
+        except sqlite3.Error as err:
+            logger.warning(f"Metadata cache {self.path} is unusable: {err}")
+        self.hits += len(found)
+        self.misses += len(identities) - len(found)
+        return found
+
+    def put_many(self, metadata: dict):
+        """
+        Store metadata dictionaries keyed by file identity, replacing older entries of the same paths.
+        """
+        if not metadata:
+            return
+        try:
+            with self.connection as connection:
+                connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+                                       [(*identity, json.dumps(data)) for identity, data in metadata.items()])
+        except sqlite3.Error as err:
+            logger.warning(f"Metadata cache {self.path} is unusable: {err}")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+        self._connection = None
+
+    def stats(self) -> dict:
+        return dict(cache_hits=self.hits, cache_misses=self.misses)
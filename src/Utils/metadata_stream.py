@@ -0,0 +1,108 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Streaming metadata extraction with ExifTool.
+
+Files are read in chunks by a background thread that feeds a bounded queue, so the images of the first chunk
+can be processed while ExifTool is still reading the next ones, and only a few chunks of metadata are held in
+memory at any time.
+"""
+
+import queue
+import threading
+from loguru import logger
+from exiftool.exceptions import ExifToolExecuteError
+from Utils import perf
+
+DEFAULT_CHUNK_SIZE: int = 200
+# Chunks extracted ahead of the consumer.
+QUEUE_CHUNKS: int = 2
+# Numeric values with group-qualified tag names; -fast skips the scan for trailers at the end of JPEG files.
+EXIFTOOL_COMMON_ARGS: list = ["-G", "-n", "-fast"]
+
+_END = object()
+
+
+def _read_chunk(et, files: list, tags: list) -> list[dict]:
+    """
+    Read the tags of a chunk of files in one ExifTool call.
+
+    When ExifTool fails on the chunk, its files are read one by one so that a single unreadable file does not
+    discard the metadata of the others.
+    """
+    if not files:
+        return []
+    try:
+        return et.get_tags(files, tags)
+    except ExifToolExecuteError:
+        if len(files) == 1:
+            logger.warning(f"Could not read metadata from {files[0]}.")
+            return []
+    metadata = []
+    for file in files:
+        metadata.extend(_read_chunk(et, [file], tags))
+    return metadata
+
+
+def _put(chunks: queue.Queue, item, stop: threading.Event) -> bool:
+    """Put an item on the queue unless the consumer has stopped; returns False when it has."""
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _extract(et, file_chunks: list, tags: list, chunks: queue.Queue, stop: threading.Event):
+    """Producer thread: put the metadata of each chunk of files on the queue, then _END (or the error raised)."""
+    try:
+        with et:
+            for files in file_chunks:
+                with perf.span("exiftool"):
+                    metadata = _read_chunk(et, files, tags)
+                if not _put(chunks, metadata, stop):
+                    return
+    except Exception as error:
+        _put(chunks, error, stop)
+        return
+    _put(chunks, _END, stop)
+
+
+def chunk_files(files: list, chunk_size: int = DEFAULT_CHUNK_SIZE) -> list[list]:
+    """Split a list of files into chunks of chunk_size files."""
+    chunk_size = max(1, chunk_size)
+    return [files[start:start + chunk_size] for start in range(0, len(files), chunk_size)]
+
+
+def stream_metadata(et, file_chunks: list[list], tags: list):
+    """
+    Extract metadata chunk by chunk while the caller processes the previous chunks.
+
+    Parameters:
+    - et (exiftool.ExifToolHelper): A helper that is used, and terminated, by the background thread.
+    - file_chunks (list[list]): Paths of the image files, in chunks (see chunk_files). Empty chunks are
+      yielded as empty lists without calling ExifTool.
+    - tags (list): Tags to extract, e.g. imagedrone.METADATA_TAGS.
+
+    Yields:
+    list[dict]: The metadata of each chunk of files, in the order of the files. Files that ExifTool could not
+    read are left out.
+    """
+    chunks = queue.Queue(maxsize=QUEUE_CHUNKS)
+    stop = threading.Event()
+    thread = threading.Thread(target=_extract, args=(et, file_chunks, tags, chunks, stop), name="exiftool-reader",
+                              daemon=True)
+    thread.start()
+    try:
+        while (chunk := chunks.get()) is not _END:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
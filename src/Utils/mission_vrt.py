@@ -0,0 +1,201 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Mission index over the per-image GeoTIFFs: a GDAL VRT and, optionally, a GTI tile index.
+
+Both reference the GeoTIFFs of a run without copying pixels, so GIS clients open the whole mission as one
+layer. They are built from the run manifest records, which keep the grid of each GeoTIFF (see
+raster_utils.raster_grid), so no raster is opened. Images are stacked in capture order (the latest on top) or by
+distance from nadir (the image whose footprint centre is closest to the drone position on top).
+"""
+
+import json
+import math
+import os
+from pathlib import Path
+from xml.etree import ElementTree
+import numpy as np
+from loguru import logger
+import Utils.config as config
+from Utils.raster_utils import METERS_PER_DEGREE
+
+GDAL_DATA_TYPES = {"uint8": "Byte", "int8": "Int8", "uint16": "UInt16", "int16": "Int16", "uint32": "UInt32",
+                   "int32": "Int32", "float32": "Float32", "float64": "Float64"}
+COLOR_NAMES = {1: ["Gray"], 3: ["Red", "Green", "Blue"], 4: ["Red", "Green", "Blue", "Alpha"]}
+
+
+def nadir_distance(record: dict) -> float:
+    """Distance in meters from the drone position to the centre of the footprint of a manifest record."""
+    ring = record["polygon"]["geometry"]["coordinates"][0][:-1]
+    longitude = sum(point[0] for point in ring) / len(ring)
+    latitude = sum(point[1] for point in ring) / len(ring)
+    dx = (longitude - record["longitude"]) * math.cos(math.radians(latitude))
+    return math.hypot(dx, latitude - record["latitude"]) * METERS_PER_DEGREE
+
+
+def ordered_rasters(records: list[dict], order: str = "time") -> list[dict]:
+    """
+    The records whose GeoTIFF grid is known, in stacking order: the record drawn last ends up on top.
+
+    Parameters:
+    - records (list[dict]): Run manifest records (see run_manifest.image_record).
+    - order (str): "time" for capture order, "nadir" for decreasing distance from nadir.
+    """
+    rasters = [record for record in records if record.get("geotiff") and record.get("raster")]
+    missing = sum(1 for record in records if record.get("geotiff") and not record.get("raster"))
+    if missing:
+        logger.warning(f"{missing} GeoTIFFs recorded by an earlier version have no grid in the run manifest and are "
+                       f"left out of the mission index; rerun with --no_resume to include them.")
+    if order == "nadir":
+        return sorted(rasters, key=nadir_distance, reverse=True)
+    return sorted(rasters, key=lambda record: record.get("datetime_original") or "")
+
+
+def mission_grid(rasters: list[dict]) -> tuple:
+    """
+    Grid covering the GeoTIFFs: square pixels of their median resolution over the union of their extents.
+
+    Returns:
+    - Tuple of (min x, max y, resolution, width, height).
+    """
+    resolution = float(np.median([abs(record["raster"]["transform"][0]) for record in rasters]))
+    extents = [raster_extent(record["raster"]) for record in rasters]
+    minx, miny = min(extent[0] for extent in extents), min(extent[1] for extent in extents)
+    maxx, maxy = max(extent[2] for extent in extents), max(extent[3] for extent in extents)
+    return minx, maxy, resolution, max(1, math.ceil((maxx - minx) / resolution)), \
+        max(1, math.ceil((maxy - miny) / resolution))
+
+
+def raster_extent(raster: dict) -> tuple:
+    """Bounds (min x, min y, max x, max y) of a GeoTIFF grid from raster_utils.raster_grid."""
+    a, _, c, _, e, f = raster["transform"]
+    x0, x1 = c, c + raster["width"] * a
+    y0, y1 = f, f + raster["height"] * e
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def build_vrt(rasters: list[dict], vrt_file: Path) -> ElementTree.ElementTree:
+    """
+    VRT stacking the GeoTIFFs of the records in order; pixels at the nodata value (0) let lower images show.
+
+    Parameters:
+    - rasters (list[dict]): Records from ordered_rasters, all with the same band count and data type.
+    - vrt_file (Path): Destination of the VRT; GeoTIFF paths are written relative to it.
+    """
+    minx, maxy, resolution, width, height = mission_grid(rasters)
+    count, dtype = rasters[0]["raster"]["count"], rasters[0]["raster"]["dtype"]
+    data_type = GDAL_DATA_TYPES[dtype]
+    root = ElementTree.Element("VRTDataset", rasterXSize=str(width), rasterYSize=str(height))
+    ElementTree.SubElement(root, "SRS").text = f"EPSG:{config.epsg_code}"
+    ElementTree.SubElement(root, "GeoTransform").text = f"{minx!r}, {resolution!r}, 0, {maxy!r}, 0, {-resolution!r}"
+    for band in range(1, count + 1):
+        band_element = ElementTree.SubElement(root, "VRTRasterBand", dataType=data_type, band=str(band))
+        ElementTree.SubElement(band_element, "NoDataValue").text = "0"
+        if count in COLOR_NAMES:
+            ElementTree.SubElement(band_element, "ColorInterp").text = COLOR_NAMES[count][band - 1]
+        for record in rasters:
+            raster = record["raster"]
+            a, _, c, _, e, f = raster["transform"]
+            source = ElementTree.SubElement(band_element, "ComplexSource")
+            ElementTree.SubElement(source, "SourceFilename", relativeToVRT="1").text = \
+                Path(os.path.relpath(record["geotiff"], vrt_file.parent)).as_posix()
+            ElementTree.SubElement(source, "SourceBand").text = str(band)
+            ElementTree.SubElement(source, "SourceProperties", RasterXSize=str(raster["width"]),
+                                   RasterYSize=str(raster["height"]), DataType=data_type)
+            ElementTree.SubElement(source, "SrcRect", xOff="0", yOff="0", xSize=str(raster["width"]),
+                                   ySize=str(raster["height"]))
+            ElementTree.SubElement(source, "DstRect", xOff=repr((c - minx) / resolution),
+                                   yOff=repr((maxy - f) / resolution),
+                                   xSize=repr(raster["width"] * a / resolution),
+                                   ySize=repr(raster["height"] * -e / resolution))
+            ElementTree.SubElement(source, "NODATA").text = "0"
+    ElementTree.indent(root)
+    return ElementTree.ElementTree(root)
+
+
+def write_tile_index(rasters: list[dict], index_file: Path, gti_file: Path):
+    """
+    Write a GTI tile index: a GeoJSON layer of the GeoTIFF extents and the GDAL GTI dataset that reads it.
+
+    The layer has the location of each GeoTIFF (relative to the layer), its capture time, distance from nadir and
+    its rank in the stacking order, by which GTI composites the tiles. The GTI dataset refers to the layer by its
+    path relative to the GTI file.
+    """
+    features = []
+    for priority, record in enumerate(rasters):
+        minx, miny, maxx, maxy = raster_extent(record["raster"])
+        geometry = dict(type="Polygon", coordinates=[[[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy],
+                                                      [minx, miny]]])
+        properties = dict(location=Path(os.path.relpath(record["geotiff"], index_file.parent)).as_posix(),
+                          file_name=record["file_name"], datetime_original=record.get("datetime_original"),
+                          nadir_distance=round(nadir_distance(record), 3), priority=priority)
+        features.append(dict(type="Feature", geometry=geometry, properties=properties))
+    layer = dict(type="FeatureCollection", name=index_file.stem,
+                 crs=dict(type="name", properties=dict(name=f"urn:ogc:def:crs:EPSG::{config.epsg_code}")),
+                 features=features)
+    index_file.write_text(json.dumps(layer))
+
+    minx, maxy, resolution, width, height = mission_grid(rasters)
+    count, dtype = rasters[0]["raster"]["count"], rasters[0]["raster"]["dtype"]
+    root = ElementTree.Element("GDALTileIndexDataset")
+    # Like the VRT sources, the index dataset is written relative to the GTI file, so the output directory can be
+    # moved. GDAL resolves it from the working directory, which is the directory of the GTI when it is opened there.
+    ElementTree.SubElement(root, "IndexDataset").text = Path(os.path.relpath(index_file, gti_file.parent)).as_posix()
+    ElementTree.SubElement(root, "LocationField").text = "location"
+    ElementTree.SubElement(root, "SortField").text = "priority"
+    ElementTree.SubElement(root, "SortFieldAsc").text = "true"
+    ElementTree.SubElement(root, "SRS").text = f"EPSG:{config.epsg_code}"
+    ElementTree.SubElement(root, "ResX").text = repr(resolution)
+    ElementTree.SubElement(root, "ResY").text = repr(resolution)
+    ElementTree.SubElement(root, "MinX").text = repr(minx)
+    ElementTree.SubElement(root, "MinY").text = repr(maxy - height * resolution)
+    ElementTree.SubElement(root, "MaxX").text = repr(minx + width * resolution)
+    ElementTree.SubElement(root, "MaxY").text = repr(maxy)
+    for band in range(1, count + 1):
+        band_element = ElementTree.SubElement(root, "Band", band=str(band), dataType=GDAL_DATA_TYPES[dtype])
+        ElementTree.SubElement(band_element, "NoDataValue").text = "0"
+        if count in COLOR_NAMES:
+            ElementTree.SubElement(band_element, "ColorInterp").text = COLOR_NAMES[count][band - 1]
+    ElementTree.indent(root)
+    ElementTree.ElementTree(root).write(gti_file, encoding="utf-8")
+
+
+def write_mission_index(records: list[dict], geotiff_dir, name: str, order: str = "time",
+                        tile_index: bool = False):
+    """
+    Write the mission VRT (and with tile_index, the GTI tile index) next to the GeoTIFFs.
+
+    Parameters:
+    - records (list[dict]): Run manifest records of the mission.
+    - geotiff_dir (str or Path): Directory of the GeoTIFFs, where the index files are written.
+    - name (str): Base name of the index files (e.g. M_2024-02-06_11-16).
+    - order (str): Stacking order, one of config.VRT_ORDERS.
+    - tile_index (bool): Also write <name>_index.geojson and <name>.gti.
+
+    Returns:
+    - Path: The VRT file, or None when no GeoTIFF grid is known.
+    """
+    rasters = ordered_rasters(records, order)
+    if not rasters:
+        logger.warning("No GeoTIFFs to index in a mission VRT.")
+        return None
+    # GeoTIFFs with another band layout than the first (e.g. mixed RGB and multispectral) are left out.
+    layout = (rasters[0]["raster"]["count"], rasters[0]["raster"]["dtype"])
+    kept = [record for record in rasters if (record["raster"]["count"], record["raster"]["dtype"]) == layout]
+    if len(kept) < len(rasters):
+        logger.warning(f"{len(rasters) - len(kept)} GeoTIFFs do not have {layout[0]} {layout[1]} bands and are left "
+                       f"out of the mission VRT.")
+    geotiff_dir = Path(geotiff_dir)
+    vrt_file = geotiff_dir / f"{name}.vrt"
+    try:
+        build_vrt(kept, vrt_file).write(vrt_file, encoding="utf-8")
+        if tile_index:
+            write_tile_index(kept, geotiff_dir / f"{name}_index.geojson", geotiff_dir / f"{name}.gti")
+    except OSError as e:
+        logger.warning(f"Could not write the mission VRT: {e}")
+        return None
+    logger.info(f"Mission VRT of {len(kept)} GeoTIFFs ({order} order) written to {vrt_file}.")
+    return vrt_file
@@ -0,0 +1,257 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Streaming mission mosaic of the per-image GeoTIFFs.
+
+The footprint polygons of the mission GeoJSON locate every image on the mosaic grid. The mosaic is written
+block by block: for each output block, only the images whose footprint intersects it are read, each only for
+the source window covering the block, resampled onto the mosaic grid, and composited with a selection rule:
+- first: the earliest capture wins where images overlap,
+- last: the latest capture wins,
+- nadir: each pixel comes from the image whose nadir (drone position) is closest to it.
+
+Memory is bounded by the block size, the number of sources kept open and the GDAL block cache (left at its
+default size: overriding GDAL_CACHEMAX around the reads made COG sources tens of times slower to read), whatever
+the size of the mission.
+"""
+
+import math
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.warp import transform as transform_coordinates, transform_geom
+from rasterio.windows import Window, bounds as window_bounds, from_bounds
+from shapely import STRtree, box
+from shapely.geometry import shape
+from loguru import logger
+import Utils.config as config
+from Utils.config import MOSAIC_RULES
+from Utils import perf
+from Utils.raster_utils import COLOR_INTERPRETATIONS, geotiff_writer
+from Utils.tiled_warp import TILE_SIZE
+
+# Sources kept open between blocks; blocks are visited row by row, so neighbouring images are reused.
+MAX_OPEN_SOURCES: int = 32
+# Tolerance in pixels on the edges of a source extent.
+EPSILON: float = 1e-6
+
+
+@dataclass
+class MosaicSource:
+    """A per-image GeoTIFF placed on the mosaic."""
+    geotiff_file: Path
+    footprint: object
+    nadir: tuple
+    order: int
+    count: int = 0
+    dtype: str = ""
+    resolution: float = 0.0
+
+
+def mosaic_sources(feature_collection: dict, geotiff_dir, crs) -> list[MosaicSource]:
+    """
+    The GeoTIFFs of the footprint polygons of a mission GeoJSON, in capture order.
+
+    Parameters:
+    - feature_collection (dict): Mission GeoJSON (see meta_data.mission_feature_collection).
+    - geotiff_dir (str or Path): Directory of the per-image GeoTIFFs.
+    - crs (rasterio.crs.CRS): CRS of the GeoTIFFs.
+
+    Returns:
+    - list[MosaicSource]: The images whose GeoTIFF exists, ordered by DateTimeOriginal, then mission order.
+    """
+    polygons = [feature for feature in feature_collection.get("features", [])
+                if feature["geometry"]["type"] == "Polygon" and "File_Name" in feature["properties"]]
+    polygons.sort(key=lambda feature: feature["properties"].get("DateTimeOriginal") or "")
+    sources = []
+    for order, feature in enumerate(polygons):
+        properties = feature["properties"]
+        geotiff_file = Path(geotiff_dir) / f"{Path(properties['File_Name']).stem}.tif"
+        if not geotiff_file.is_file():
+            logger.debug(f"No GeoTIFF for {properties['File_Name']}, left out of the mosaic.")
+            continue
+        footprint = shape(transform_geom("EPSG:4326", crs, feature["geometry"]))
+        longitude, latitude = properties.get("DroneCoordinates") or footprint.centroid.coords[0]
+        xs, ys = transform_coordinates("EPSG:4326", crs, [longitude], [latitude])
+        with rasterio.open(geotiff_file) as src:
+            resolution = math.sqrt(abs(src.res[0] * src.res[1]))
+            sources.append(MosaicSource(geotiff_file, footprint, (xs[0], ys[0]), order, src.count, src.dtypes[0],
+                                        resolution))
+    return sources
+
+
+def mosaic_grid(sources: list[MosaicSource]) -> tuple:
+    """
+    Grid of the mosaic: square pixels of the median source resolution over the union of the footprints.
+
+    Returns:
+    - Tuple of the affine transform, width and height of the mosaic.
+    """
+    resolution = float(np.median([source.resolution for source in sources]))
+    minx = min(source.footprint.bounds[0] for source in sources)
+    miny = min(source.footprint.bounds[1] for source in sources)
+    maxx = max(source.footprint.bounds[2] for source in sources)
+    maxy = max(source.footprint.bounds[3] for source in sources)
+    width = max(1, math.ceil((maxx - minx) / resolution))
+    height = max(1, math.ceil((maxy - miny) / resolution))
+    return from_origin(minx, maxy, resolution, resolution), width, height
+
+
+class _OpenSources:
+    """The source GeoTIFFs, kept open in least recently used order."""
+
+    def __init__(self):
+        self.open = OrderedDict()
+
+    def get(self, source: MosaicSource):
+        src = self.open.pop(source.geotiff_file, None)
+        if src is None:
+            src = rasterio.open(source.geotiff_file)
+            if len(self.open) >= MAX_OPEN_SOURCES:
+                self.open.popitem(last=False)[1].close()
+        self.open[source.geotiff_file] = src
+        return src
+
+    def close(self):
+        for src in self.open.values():
+            src.close()
+        self.open.clear()
+
+
+def read_onto_grid(src, window, grid_transform):
+    """
+    Read the part of a source GeoTIFF that falls in a block of the mosaic, resampled onto the mosaic grid.
+
+    Only mosaic pixels wholly inside the source extent are read; the source and the mosaic share the CRS, so the
+    source window is a scaled and shifted copy of the block.
+
+    Returns:
+    - Tuple of the (row, column) slices of the block, the bands and the validity mask, or None when the source
+      does not cover any pixel of the block.
+    """
+    left, bottom, right, top = window_bounds(window, grid_transform)
+    resolution = grid_transform.a
+    extent = src.bounds
+    first_column = max(0, math.ceil((extent.left - left) / resolution - EPSILON))
+    last_column = min(window.width, math.floor((extent.right - left) / resolution + EPSILON))
+    first_row = max(0, math.ceil((top - extent.top) / resolution - EPSILON))
+    last_row = min(window.height, math.floor((top - extent.bottom) / resolution + EPSILON))
+    if last_column <= first_column or last_row <= first_row:
+        return None
+    source_window = from_bounds(left + first_column * resolution, top - last_row * resolution,
+                                left + last_column * resolution, top - first_row * resolution, src.transform)
+    source_window = source_window.intersection(Window(0, 0, src.width, src.height))
+    size = (last_row - first_row, last_column - first_column)
+    data = src.read(window=source_window, out_shape=(src.count, *size), resampling=Resampling.bilinear)
+    valid = src.read_masks(1, window=source_window, out_shape=size, resampling=Resampling.nearest) > 0
+    return (slice(first_row, last_row), slice(first_column, last_column)), data, valid
+
+
+def _nadir_distance(window, grid_transform, nadir, geographic):
+    """Squared ground distance of the pixel centres of a window to a nadir point (degrees scaled for longitude)."""
+    columns = np.arange(window.col_off, window.col_off + window.width) + 0.5
+    rows = np.arange(window.row_off, window.row_off + window.height) + 0.5
+    xs = grid_transform.c + columns * grid_transform.a
+    ys = grid_transform.f + rows * grid_transform.e
+    dx = xs - nadir[0]
+    if geographic:
+        dx = dx * math.cos(math.radians(nadir[1]))
+    dy = ys - nadir[1]
+    return (dy[:, None] ** 2 + dx[None, :] ** 2).astype(np.float32)
+
+
+def composite_window(window, candidates: list[MosaicSource], open_sources: _OpenSources, grid_transform,
+                     rule: str, bands: int, dtype: str, geographic: bool):
+    """
+    Composite one block of the mosaic from the sources that overlap it.
+
+    Returns:
+    - numpy.ndarray of shape (bands, height, width), or None when no source has data in the block.
+    """
+    tile = np.zeros((bands, window.height, window.width), dtype=dtype)
+    filled = np.zeros((window.height, window.width), dtype=bool)
+    best = None
+    if rule == "last":
+        candidates = candidates[::-1]
+    for source in candidates:
+        part = read_onto_grid(open_sources.get(source), window, grid_transform)
+        if part is None:
+            continue
+        (rows, columns), data, valid = part
+        if rule == "nadir":
+            distance = _nadir_distance(window, grid_transform, source.nadir, geographic)[rows, columns]
+            if best is None:
+                best = np.full((window.height, window.width), np.inf, dtype=np.float32)
+            take = valid & (distance < best[rows, columns])
+            best[rows, columns][take] = distance[take]
+        else:
+            take = valid & ~filled[rows, columns]
+        tile[:, rows, columns][:, take] = data[:, take]
+        filled[rows, columns] |= take
+        if rule != "nadir" and filled.all():
+            break
+    return tile if filled.any() else None
+
+
+def build_mosaic(feature_collection: dict, geotiff_dir, mosaic_file, rule: str = "nadir"):
+    """
+    Composite the per-image GeoTIFFs of a mission into one GeoTIFF, block by block.
+
+    Parameters:
+    - feature_collection (dict): Mission GeoJSON, whose footprint polygons locate the images.
+    - geotiff_dir (str or Path): Directory of the per-image GeoTIFFs.
+    - mosaic_file (str or Path): Destination path of the mosaic (a COG with config.cog).
+    - rule (str): Selection rule where images overlap, one of MOSAIC_RULES.
+
+    Returns:
+    - Path: The mosaic file, or None when there is nothing to composite.
+    """
+    if rule not in MOSAIC_RULES:
+        raise ValueError(f"Unknown mosaic rule {rule!r}, expected one of {', '.join(MOSAIC_RULES)}.")
+    crs = CRS.from_epsg(config.epsg_code)
+    with perf.span("mosaic"):
+        sources = mosaic_sources(feature_collection, geotiff_dir, crs)
+        if not sources:
+            logger.warning("No GeoTIFFs to mosaic.")
+            return None
+        # Images with another band layout than the first (e.g. mixed RGB and multispectral) are left out.
+        bands, dtype = sources[0].count, sources[0].dtype
+        skipped = [source for source in sources if (source.count, source.dtype) != (bands, dtype)]
+        if skipped:
+            logger.warning(f"{len(skipped)} GeoTIFFs do not have {bands} {dtype} bands and are left out of the "
+                           f"mosaic.")
+            sources = [source for source in sources if (source.count, source.dtype) == (bands, dtype)]
+
+        grid_transform, width, height = mosaic_grid(sources)
+        profile = dict(width=width, height=height, count=bands, dtype=dtype, crs=crs, transform=grid_transform,
+                       nodata=0, tiled=True, blockxsize=TILE_SIZE, blockysize=TILE_SIZE)
+        index = STRtree([source.footprint for source in sources])
+        open_sources = _OpenSources()
+        mosaic_file = Path(mosaic_file)
+        mosaic_file.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with geotiff_writer(mosaic_file, in_memory=False, **profile) as dst:
+                for _, window in dst.block_windows(1):
+                    hits = index.query(box(*window_bounds(window, grid_transform)), predicate="intersects")
+                    if not len(hits):
+                        continue
+                    candidates = [sources[i] for i in sorted(hits, key=lambda i: sources[i].order)]
+                    tile = composite_window(window, candidates, open_sources, grid_transform, rule, bands, dtype,
+                                            crs.is_geographic)
+                    # Blocks without data are left unwritten and read back as nodata.
+                    if tile is not None:
+                        dst.write(tile, window=window)
+                if bands in COLOR_INTERPRETATIONS:
+                    dst.colorinterp = COLOR_INTERPRETATIONS[bands]
+        finally:
+            open_sources.close()
+    logger.info(f"Mosaic of {len(sources)} images ({width}x{height}, rule {rule}) written to {mosaic_file}.")
+    return mosaic_file
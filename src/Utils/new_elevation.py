@@ -3,21 +3,21 @@
 #  __license__ = "AGPL"
 #  __version__ = "1.0"
 
-from rasterio import rasterio
-from rasterio.transform import rowcol
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
 from pyproj import Transformer
-from scipy.ndimage import map_coordinates
-from urllib.request import urlopen
-from urllib.error import HTTPError
-import json
 # from Utils.logger_config import logging_process as logger
 from loguru import logger
 import Utils.config as config
-from numpy import random
-from time import sleep
+from Utils.elevation_client import OpenElevationClient, ElevationServiceError, elevation_key
+from Utils.elevation_cache import ElevationCache
+from time import perf_counter
 
 
-ATTEMPS_NUMBERS:int= 10
+# DSMs larger than this are staged once into a .npy file and memory-mapped instead of held in RAM.
+MEMMAP_THRESHOLD_BYTES:int = 256 * 1024 * 1024
 
 class ElevationAdjuster:
     def __init__(self, elevation_data, crs, affine_transform):
@@ -26,28 +26,130 @@ class ElevationAdjuster:
         self.affine_transform = affine_transform
 
     def terrain_adjustment(self, col, row):
+        from scipy.ndimage import map_coordinates
         try:
             row_f, col_f = float(row), float(col)
             interpolated_elevation = map_coordinates(self.elevation_data, [[row_f], [col_f]], order=1, mode='nearest')[
                 0]
             return interpolated_elevation
         except Exception as e:
-            logger.info(
-                f"Error calculating interpolated elevation: {e} for {config.im_file_name}. Switching to Default Altitudes.")
-            return config.absolute_altitude
+            logger.info(f"Error calculating interpolated elevation: {e}. Switching to Default Altitudes.")
+            return None
+
+
+class ElevationSource:
+    """
+    Mission-scoped DSM reader.
+
+    The DSM is opened once; band 1 and its affine transform stay resident (or memory-mapped for large
+    rasters) and every point query is answered from memory. Counters record how many queries were served
+    and how much time was spent loading and sampling.
+    """
+
+    def __init__(self, dtm_path):
+        self.dtm_path = str(dtm_path)
+        self.hits = 0
+        self.out_of_bounds = 0
+        self.sample_time = 0.0
+        self.pid = os.getpid()
+        start = perf_counter()
+        # Imported here so that runs without a DSM (e.g. footprints only) never load the raster stack.
+        import rasterio
+        with rasterio.open(self.dtm_path) as src:
+            self.crs = src.crs
+            self.affine_transform = src.transform
+            self.nodata = src.nodata
+            nbytes = src.width * src.height * np.dtype(src.dtypes[0]).itemsize
+            if nbytes > MEMMAP_THRESHOLD_BYTES:
+                self.elevation_data = self._memory_map_band(src)
+                self.memory_mapped = True
+            else:
+                self.elevation_data = src.read(1)
+                self.memory_mapped = False
+        self.inverse_transform = ~self.affine_transform
+        self.height, self.width = self.elevation_data.shape
+        self.load_time = perf_counter() - start
+
+    def _memory_map_band(self, src):
+        """
+        Stage band 1 into a .npy file keyed by the DSM identity and memory-map it read-only.
+
+        The file is written block by block, so staging never holds the full band in memory, and it is reused
+        by later runs and by every worker process of the current run.
+        """
+        stat = os.stat(self.dtm_path)
+        cache_dir = Path(tempfile.gettempdir()) / "drone_footprints"
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_file = cache_dir / f"{Path(self.dtm_path).stem}_{stat.st_size}_{stat.st_mtime_ns}.npy"
+        if not cache_file.exists():
+            tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            band = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=src.dtypes[0],
+                                             shape=(src.height, src.width))
+            for _, window in src.block_windows(1):
+                band[window.row_off:window.row_off + window.height,
+                     window.col_off:window.col_off + window.width] = src.read(1, window=window)
+            band.flush()
+            del band
+            os.replace(tmp_file, cache_file)
+        return np.load(cache_file, mmap_mode="r")
+
+    def sample(self, xs, ys):
+        """
+        Sample DSM elevations at coordinates expressed in the DSM CRS.
+
+        Parameters:
+        - xs, ys (float or array-like): Coordinates of the query points.
+
+        Returns:
+        numpy.ndarray: Elevations, NaN for points outside the DSM.
+        """
+        start = perf_counter()
+        xs = np.atleast_1d(np.asarray(xs, dtype=np.float64))
+        ys = np.atleast_1d(np.asarray(ys, dtype=np.float64))
+        cols, rows = self.inverse_transform * (xs, ys)
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        elevations = np.full(xs.shape, np.nan)
+        elevations[inside] = self.elevation_data[rows[inside], cols[inside]]
+        nb_inside = int(np.count_nonzero(inside))
+        self.hits += nb_inside
+        self.out_of_bounds += xs.size - nb_inside
+        self.sample_time += perf_counter() - start
+        return elevations
+
+    def stats(self) -> dict:
+        # A source inherited through fork was loaded by the parent process, not by this one.
+        loaded_here = self.pid == os.getpid()
+        return dict(loads=int(loaded_here), load_time=self.load_time if loaded_here else 0.0, hits=self.hits,
+                    out_of_bounds=self.out_of_bounds, sample_time=self.sample_time)
+
+
+_elevation_source:ElevationSource = None
+
+
+def get_elevation_source() -> ElevationSource:
+    """
+    Return the process-wide ElevationSource for config.dtm_path, opening the DSM on first use.
+    """
+    global _elevation_source
+    if _elevation_source is None or _elevation_source.dtm_path != str(config.dtm_path):
+        _elevation_source = ElevationSource(config.dtm_path)
+        logger.info(f"Loaded DSM {config.dtm_path} ({_elevation_source.width}x{_elevation_source.height}, "
+                    f"{'memory-mapped' if _elevation_source.memory_mapped else 'in memory'}) "
+                    f"in {_elevation_source.load_time:.2f}s")
+    return _elevation_source
+
+
+def elevation_stats() -> dict:
+    """Counters of the process-wide ElevationSource, empty when no DSM was used."""
+    return _elevation_source.stats() if _elevation_source is not None else {}
 
 
 def load_elevation_data_and_crs():
-    if config.dtm_path is not None:
-        dsm = ''
-        crs = ''
-        src = ''
-        affine_transform = ''
-        with rasterio.open(config.dtm_path) as src:
-            dsm = src.read(1)
-            crs = src.crs  # Get the CRS directly
-            affine_transform = src.transform  # Get the affine transform
-        return dsm, crs, src, affine_transform
+    if config.dtm_path:
+        source = get_elevation_source()
+        return source.elevation_data, source.crs, None, source.affine_transform
 
 
 def translate_geo_to_utm(drone_longitude, drone_latitude):
@@ -63,76 +165,166 @@ def translate_geo_to_utm(drone_longitude, drone_latitude):
     return utm_x, utm_y, adjuster
 
 
-def get_altitude_at_point(x, y):
-    elevation_data, _, _, affine_transform = load_elevation_data_and_crs()
-    row, col = rowcol(affine_transform, x, y)
-    if 0 <= row < elevation_data.shape[0] and 0 <= col < elevation_data.shape[1]:
-        elevation = elevation_data[row, col]
-        return config.absolute_altitude - elevation
+def get_altitude_at_point(x, y, absolute_altitude:float, file_name:str=""):
+    """
+        Get the drone height above the DSM surface at UTM point (x, y).
+        Returns corrected altitude, or None when the point is outside the DSM.
+    """
+    elevation = get_elevation_source().sample(x, y)[0]
+    if not np.isnan(elevation):
+        return absolute_altitude - elevation
 
     logger.warning(
-        f"Point ({x}, {y}) is outside the elevation data bounds for file {config.im_file_name}. Switching to default elevation.")
+        f"Point ({x}, {y}) is outside the elevation data bounds for file {file_name}. Switching to default elevation.")
     return None
 
 
-def get_altitude_from_open(lat:float, long:float)->float:
+class OpenElevationTable:
     """
-        Get GPS terrain altitude from open-elevation.com using input lat and long
-        Returns corrected altitude.
+    Mission-scoped terrain elevations from the Open-Elevation API.
+
+    Every image centre and predicted footprint corner of a mission is prefetched with one batched
+    OpenElevationClient run; per-image queries are then answered from the table. With a persistent
+    ElevationCache, points are quantized to the centres of their cache cells, looked up on disk, and only the
+    remaining cell centres go to the network; without it, the exact points are requested. Points of a
+    batch that fails after all retries are left unanswered; when every batch fails, the service is considered
+    unreachable, the failure is logged once and later queries fall back to the drone altitude without further
+    network calls.
     """
 
-    nb_of_failed_connection = 0
-    while nb_of_failed_connection < ATTEMPS_NUMBERS:
+    def __init__(self, url:str, cache_path=None):
+        self.url = url
+        self.cache_path = cache_path
+        self.client = OpenElevationClient(url)
+        self.cache = ElevationCache(cache_path) if cache_path else None
+        self.elevations = {}
+        self.available = True
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, latlon_tupples:list[tuple]):
+        """
+        Fetch the elevations of the points that are not in the table yet.
+        """
+        missing = [key for key in dict.fromkeys(elevation_key(*point) for point in latlon_tupples)
+                   if key not in self.elevations]
+        if not missing:
+            return
+        if self.cache is None:
+            self.elevations.update(self._fetch(missing))
+            return
+
+        cells = {point: self.cache.cell(*point) for point in missing}
+        elevations = self.cache.get_many(cells.values())
+        remaining = [cell for cell in dict.fromkeys(cells.values()) if cell not in elevations]
+        fetched = self._fetch([self.cache.cell_centre(cell) for cell in remaining])
+        new_elevations = {cell: fetched[elevation_key(*self.cache.cell_centre(cell))] for cell in remaining
+                          if elevation_key(*self.cache.cell_centre(cell)) in fetched}
+        self.cache.put_many(new_elevations)
+        elevations.update(new_elevations)
+        self.elevations.update({point: elevations[cell] for point, cell in cells.items() if cell in elevations})
+
+    def _fetch(self, latlon_tupples:list[tuple]) -> dict:
+        if not latlon_tupples or not self.available:
+            return {}
         try:
-            url = f"https://api.open-elevation.com/api/v1/lookup?locations={lat},{long}"
-            with urlopen(url) as response:
-                data = response.read().decode('utf-8')
-            elevation = json.loads(data)['results'][0]['elevation']
-            logger.info(f"Successfull connection to OpenElevation for file{config.im_file_name} with coordinates {lat},{long}")
-            return config.absolute_altitude - elevation
-        except HTTPError as err:
-            logger.warning(f"Connexion error for OpenElevation file:{config.im_file_name} coordinates {lat},{long}. Error: {err}")
-            nb_of_failed_connection += 1
-            # Sleep random time before next try
-            sleep(nb_of_failed_connection)
-    logger.info(f"Too many failures for file {config.im_file_name}. Switching to default elevation.")
-    config.update_elevation(False)
-    return None
+            elevations = self.client.lookup(latlon_tupples)
+            logger.info(f"Fetched {len(elevations)} terrain elevations from {self.url}.")
+            missing = len(set(elevation_key(*point) for point in latlon_tupples)) - len(elevations)
+            if missing:
+                logger.warning(f"{missing} points have no terrain elevation; images using them will fall back to "
+                               f"the drone altitude.")
+            return elevations
+        except ElevationServiceError as err:
+            self.available = False
+            logger.error(f"Elevation service unavailable: {err}. "
+                         f"Images without a known terrain elevation will use the drone altitude.")
+            return {}
+
+    def lookup(self, latlon_tupples:list[tuple]) -> list:
+        """
+        Terrain elevations of (lat, lon) points, None for points the service could not answer.
+        """
+        self.prefetch(latlon_tupples)
+        elevations = [self.elevations.get(elevation_key(*point)) for point in latlon_tupples]
+        answered = sum(elevation is not None for elevation in elevations)
+        self.hits += answered
+        self.misses += len(elevations) - answered
+        return elevations
+
+    def stats(self) -> dict:
+        stats = dict(self.client.stats(), hits=self.hits, misses=self.misses)
+        if self.cache is not None:
+            stats.update(self.cache.stats())
+        return stats
+
 
-def get_altitudes_from_open(latlon_tupples:list[tuple])->list[float]:
+_open_elevation_table:OpenElevationTable = None
+
+
+def get_open_elevation_table() -> OpenElevationTable:
     """
-        Get GPS terrain altitude from open-elevation.com from a list of latlon tupples [(lat1,lon1),(lat2,lon2),...]
-        Returns list of corrected altitude.
+    Return the process-wide OpenElevationTable for config.elevation_url and config.elevation_cache.
     """
-    url_coordinates=""
-    nb_of_coordinates=0
-    #Prepare url values
-    for coordinates in latlon_tupples:
-        url_coordinates+=f'{coordinates[0]},{coordinates[1]}|'
-        nb_of_coordinates+=1
-    #remove last |
-    url_coordinates=url_coordinates.rstrip('|')
-
-
-    nb_of_failed_connection = 0
-    while nb_of_failed_connection < ATTEMPS_NUMBERS:
-        try:
-            url = f"https://api.open-elevation.com/api/v1/lookup?locations={url_coordinates}"
-            with urlopen(url) as response:
-                data = response.read().decode('utf-8')
-
-            logger.info(f"Successfull connection to OpenElevation for file {config.im_file_name} with coordinates {latlon_tupples}")
-            # Extract altitude corrections
-            alitude_list=[]
-            for result in json.loads(data)['results']:
-                alitude_list.append(config.absolute_altitude-result['elevation'])
-            return alitude_list
-        except HTTPError as err:
-            logger.warning(f"Unable to Connect to OpenElevation for file {config.im_file_name} with coordinates {latlon_tupples}. Error: {err}")
-            nb_of_failed_connection += 1
-            # Sleep random time before next try
-            sleep(nb_of_failed_connection)
-
-    logger.info(f"Too many failures for file {config.im_file_name}. Switching to default elevation.")
-    config.update_elevation(False)
-    return None
+    global _open_elevation_table
+    if (_open_elevation_table is None or _open_elevation_table.url != config.elevation_url
+            or _open_elevation_table.cache_path != config.elevation_cache):
+        _open_elevation_table = OpenElevationTable(config.elevation_url, config.elevation_cache)
+    return _open_elevation_table
+
+
+def open_elevation_snapshot() -> dict:
+    """Picklable copy of the prefetched elevations for worker processes, None when the service is not used."""
+    if _open_elevation_table is None:
+        return None
+    return dict(url=_open_elevation_table.url, cache_path=_open_elevation_table.cache_path,
+                elevations=_open_elevation_table.elevations, available=_open_elevation_table.available)
+
+
+def restore_open_elevations(snapshot:dict):
+    """Start this process' OpenElevationTable from a snapshot taken with open_elevation_snapshot()."""
+    global _open_elevation_table
+    _open_elevation_table = OpenElevationTable(snapshot["url"], snapshot["cache_path"])
+    _open_elevation_table.elevations.update(snapshot["elevations"])
+    _open_elevation_table.available = snapshot["available"]
+
+
+def open_elevation_subset(latlon_tupples:list[tuple]) -> dict:
+    """Picklable copy of the known elevations of some points, for the worker process that will query them."""
+    if _open_elevation_table is None:
+        return None
+    keys = (elevation_key(*point) for point in latlon_tupples)
+    return {key: _open_elevation_table.elevations[key] for key in keys if key in _open_elevation_table.elevations}
+
+
+def add_open_elevations(elevations:dict):
+    """Add elevations taken with open_elevation_subset() to this process' OpenElevationTable."""
+    if elevations:
+        get_open_elevation_table().elevations.update(elevations)
+
+
+def open_elevation_stats() -> dict:
+    """Counters of the process-wide OpenElevationTable, empty when the elevation service was not used."""
+    return _open_elevation_table.stats() if _open_elevation_table is not None else {}
+
+
+def get_altitude_from_open(lat:float, long:float, absolute_altitude:float, file_name:str="")->float:
+    """
+        Get GPS terrain altitude from the elevation service using input lat and long
+        Returns corrected altitude, or None when the elevation is unknown.
+    """
+    elevation = get_open_elevation_table().lookup([(lat, long)])[0]
+    if elevation is None:
+        return None
+    return absolute_altitude - elevation
+
+
+def get_altitudes_from_open(latlon_tupples:list[tuple], absolute_altitude:float, file_name:str="")->list[float]:
+    """
+        Get GPS terrain altitude from the elevation service from a list of latlon tupples [(lat1,lon1),(lat2,lon2),...]
+        Returns list of corrected altitude, or None when any elevation is unknown.
+    """
+    elevations = get_open_elevation_table().lookup(latlon_tupples)
+    if None in elevations:
+        return None
+    return [absolute_altitude - elevation for elevation in elevations]
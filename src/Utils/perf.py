@@ -0,0 +1,179 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Timing spans of the pipeline stages and the performance report of a run (--profile).
+
+Stages are wrapped in `with perf.span("stage"):`. A span records its own time, excluding the spans nested in
+it, into the timings of the image being processed (see collect) or, outside any image, into the totals of the
+process (e.g. the ExifTool reader thread). Per-image timings travel with the ImageDrone, so they come back from
+worker processes with the image.
+
+When profiling is disabled, span() and collect() return a shared no-op context manager.
+"""
+
+import json
+import threading
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+from loguru import logger
+from Utils import config
+
+REPORT_FILE_NAME: str = "performance_report"
+SLOWEST_IMAGES: int = 10
+
+_state = threading.local()
+# Stage totals of the spans recorded outside any image, from every thread of the process.
+_process_totals: dict = {}
+_totals_lock = threading.Lock()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("stage", "start", "children", "parent")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.parent = getattr(_state, "span", None)
+        _state.span = self
+        self.children = 0.0
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = perf_counter() - self.start
+        _state.span = self.parent
+        if self.parent is not None:
+            self.parent.children += elapsed
+        record(self.stage, elapsed - self.children)
+        return False
+
+
+class _Collect:
+    __slots__ = ("timings", "previous")
+
+    def __init__(self, timings: dict):
+        self.timings = timings
+
+    def __enter__(self):
+        self.previous = getattr(_state, "timings", None)
+        _state.timings = self.timings
+        return self
+
+    def __exit__(self, *exc):
+        _state.timings = self.previous
+        return False
+
+
+def span(stage: str):
+    """Context manager timing a stage; a no-op unless config.profile is set."""
+    return _Span(stage) if config.profile else _NULL_SPAN
+
+
+def collect(timings: dict):
+    """Context manager attributing the spans of the current thread to a per-image timings dict."""
+    return _Collect(timings) if config.profile else _NULL_SPAN
+
+
+def record(stage: str, seconds: float):
+    """Add the time of a stage to the image being processed, or to the process totals outside any image."""
+    timings = getattr(_state, "timings", None)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+        return
+    with _totals_lock:
+        _process_totals[stage] = _process_totals.get(stage, 0.0) + seconds
+
+
+def process_totals() -> dict:
+    """Stage totals recorded outside any image in this process."""
+    with _totals_lock:
+        return dict(_process_totals)
+
+
+def build_report(image_timings: dict, mission_totals: dict, wall_seconds: float) -> dict:
+    """
+    Performance report of a run.
+
+    Parameters:
+    - image_timings (dict): Stage timings of each processed image, keyed by file name.
+    - mission_totals (dict): Stage totals recorded outside the images (e.g. ExifTool, batched lookups).
+    - wall_seconds (float): Wall time of the run.
+
+    Returns:
+    dict: Wall time, per-stage totals and p50/p95/max per image, and the slowest images.
+    """
+    stages = {}
+    for stage in sorted({stage for timings in image_timings.values() for stage in timings}):
+        values = np.array([timings[stage] for timings in image_timings.values() if stage in timings])
+        stages[stage] = dict(total=float(values.sum()), images=int(values.size),
+                             p50=float(np.percentile(values, 50)), p95=float(np.percentile(values, 95)),
+                             max=float(values.max()))
+    for stage, seconds in mission_totals.items():
+        stages.setdefault(stage, dict(total=0.0, images=0, p50=None, p95=None, max=None))["total"] += seconds
+    image_totals = {file_name: sum(timings.values()) for file_name, timings in image_timings.items()}
+    slowest = sorted(image_totals, key=image_totals.get, reverse=True)[:SLOWEST_IMAGES]
+    return dict(wall_seconds=wall_seconds, images=len(image_timings),
+                stages=dict(sorted(stages.items(), key=lambda item: item[1]["total"], reverse=True)),
+                slowest_images=[dict(file_name=file_name, total=image_totals[file_name],
+                                     stages=image_timings[file_name]) for file_name in slowest])
+
+
+def format_report(report: dict) -> str:
+    """The report as a text table of the stages followed by the slowest images."""
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.1f}"
+
+    staged = sum(stage["total"] for stage in report["stages"].values())
+    lines = [f"Wall time {report['wall_seconds']:.2f}s, {report['images']} images processed, "
+             f"{staged:.2f}s in timed stages (summed over processes).", "",
+             f"{'stage':<20}{'total s':>10}{'share':>8}{'images':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+    for name, stage in report["stages"].items():
+        share = stage["total"] / staged if staged else 0.0
+        lines.append(f"{name:<20}{stage['total']:>10.3f}{share:>8.1%}{stage['images']:>8}"
+                     f"{ms(stage['p50']):>10}{ms(stage['p95']):>10}{ms(stage['max']):>10}")
+    if report["slowest_images"]:
+        lines += ["", f"{'slowest images':<30}{'total ms':>10}  slowest stage"]
+        for image in report["slowest_images"]:
+            stage = max(image["stages"], key=image["stages"].get)
+            lines.append(f"{image['file_name']:<30}{image['total'] * 1000:>10.1f}  "
+                         f"{stage} ({image['stages'][stage] * 1000:.1f} ms)")
+    return "\n".join(lines)
+
+
+def write_report(images: list, wall_seconds: float, output_directory) -> dict:
+    """
+    Write the performance report of a run as JSON and as a text table to the output directory and log the table.
+
+    Parameters:
+    - images (list[ImageDrone]): The images processed in the run, with their timings.
+    - wall_seconds (float): Wall time of the run.
+    - output_directory (str or Path): Output directory of the run.
+    """
+    report = build_report({image.file_name: image.timings for image in images}, process_totals(), wall_seconds)
+    table = format_report(report)
+    path = Path(output_directory) / REPORT_FILE_NAME
+    try:
+        path.with_suffix(".json").write_text(json.dumps(report, indent=1))
+        path.with_suffix(".txt").write_text(table + "\n")
+    except OSError as e:
+        logger.warning(f"Could not write the performance report: {e}")
+    logger.info(f"Performance report ({path.with_suffix('.json')}):\n{table}")
+    return report
@@ -3,19 +3,16 @@
 #  License: AGPL
 #  Version: 1.0
 import os
-import sys
 from contextlib import contextmanager
 import rasterio
-from rasterio.transform import from_bounds
+from rasterio.transform import from_origin
 from rasterio.enums import ColorInterp
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-from rio_cogeo.cogeo import cog_translate
-from rio_cogeo.profiles import cog_profiles
+import rasterio.shutil
 import numpy as np
 import cv2 as cv
-from shapely.wkt import loads
 from loguru import logger
 import Utils.config as config
+from Utils import perf
 from skimage.exposure import equalize_adapthist
 from PIL import Image, ImageOps
 from pathlib import Path
@@ -23,221 +20,295 @@ import math
 
 
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".tif", ".tiff"}
+# Creation options of the GDAL COG driver: DEFLATE-compressed 512x512 tiles and internal overviews, built with
+# all CPU cores (shared among the worker processes, see cog_options).
+COG_OPTIONS = dict(COMPRESS="DEFLATE", BLOCKSIZE=512, OVERVIEW_RESAMPLING="NEAREST",
+                   NUM_THREADS="ALL_CPUS", BIGTIFF="IF_SAFER")
+# Length of a degree of latitude in meters, to express a target GSD in a geographic output CRS.
+METERS_PER_DEGREE = 111_320.0
+# Reduced decode scales, from the cheapest. JPEGs are decoded at these scales by libjpeg's DCT scaling.
+DECODE_SCALES = (8, 4, 2, 1)
+# OpenCV flags of the reduced JPEG decodes, by scale: (single band, colour).
+REDUCED_DECODE_FLAGS = {2: (cv.IMREAD_REDUCED_GRAYSCALE_2, cv.IMREAD_REDUCED_COLOR_2),
+                        4: (cv.IMREAD_REDUCED_GRAYSCALE_4, cv.IMREAD_REDUCED_COLOR_4),
+                        8: (cv.IMREAD_REDUCED_GRAYSCALE_8, cv.IMREAD_REDUCED_COLOR_8)}
+
+
+COLOR_INTERPRETATIONS = {
+    1: [ColorInterp.gray],
+    3: [ColorInterp.red, ColorInterp.green, ColorInterp.blue],
+    4: [ColorInterp.red, ColorInterp.green, ColorInterp.blue, ColorInterp.alpha],
+}
+
+
+def grid_resolution(polygon, width, height, scale=1):
+    """
+    Pixel size of the output grid of a footprint, in output CRS units; pixels are square.
+
+    With config.target_gsd, the target expressed in the output CRS (for a geographic CRS, in degrees of latitude,
+    so pixels are at least as fine as the target in both directions). Otherwise the pixel size that gives the grid
+    over the footprint bounds as many pixels as the full-resolution image, times config.downscale: the canvas of a
+    rotated or oblique frame is no larger than the image, as when the grid took the image dimensions.
 
+    Parameters:
+    - polygon: The footprint polygon in the output CRS.
+    - width, height: Dimensions of the decoded image in pixels.
+    - scale: Decode scale of the image (see read_image).
 
-def warp_image_to_polygon(img_arry, polygon, coordinate_array):
+    Returns:
+    - float: The pixel size.
     """
-    Warps an image array to fit within a specified polygon using coordinates mapping
-    after applying auto-leveling for color, brightness, and contrast adjustments.
+    if config.target_gsd:
+        crs = rasterio.crs.CRS.from_epsg(config.epsg_code)
+        if crs.is_geographic:
+            return config.target_gsd / METERS_PER_DEGREE
+        return config.target_gsd / crs.linear_units_factor[1]
+    minx, miny, maxx, maxy = polygon.bounds
+    resolution = math.sqrt((maxx - minx) * (maxy - miny) / (width * height)) / scale * (config.downscale or 1)
+    if not resolution > 0 or not polygon.area > 0:
+        raise ValueError("The footprint polygon has no area.")
+    return resolution
 
-    Parameters:
-    - img_arry: The image array to be auto-leveled and then warped.
-    - polygon: The polygon to which the image should be warped.
-    - coordinate_array: Array of coordinates defining the mapping from image to polygon.
+
+def raster_grid(width, height, count, dtype, transform, pixel_homography=None):
+    """
+    Description of the grid of a written GeoTIFF, kept with its image so mission indexes (see Utils.mission_vrt
+    and Utils.footprint_index) can reference the file without opening it.
 
     Returns:
-    - The auto-leveled and then warped image array.
+    - dict: Width, height, band count, data type name, the six affine transform coefficients and, when given,
+      the 3x3 pixel homography of the warp (see pixel_homography).
     """
+    grid = dict(width=int(width), height=int(height), count=int(count), dtype=str(np.dtype(dtype)),
+                transform=[float(value) for value in transform[:6]])
+    if pixel_homography is not None:
+        grid["pixel_homography"] = [[float(value) for value in row] for row in pixel_homography]
+    return grid
 
-    if config.image_equalize is True:
-        img_arry_equalized = equalize_adapthist(img_arry, clip_limit=0.03)
-    else:
-        img_arry_equalized = img_arry
 
-    # Continue with warping as before
-    src_points = np.float32([
-        [0, 0],
-        [img_arry_equalized.shape[1], 0],
-        [img_arry_equalized.shape[1], img_arry_equalized.shape[0]],
-        [0, img_arry_equalized.shape[0]]
-    ])
+def image_to_grid_homography(width, height, polygon, coordinate_array, resolution):
+    """
+    Computes the homography from image pixels to the pixel grid of the output GeoTIFF.
 
-    # Calculate bounds, resolution, and destination points as before
+    The output grid has square pixels of the given size and tightly covers the bounds of the footprint polygon
+    in the output CRS; corner positions are kept at sub-pixel precision.
 
+    Parameters:
+    - width, height: Dimensions of the source image in pixels.
+    - polygon: The footprint polygon in the output CRS.
+    - coordinate_array: Footprint corners in the output CRS, in the order of the image corners
+      (top-left, top-right, bottom-right, bottom-left).
+    - resolution: Pixel size of the output grid in output CRS units (see grid_resolution).
+
+    Returns:
+    - Tuple of the 3x3 homography matrix, the affine transform of the output grid and its (width, height).
+    """
     minx, miny, maxx, maxy = polygon.bounds
-    resolution_x = (maxx - minx) / img_arry_equalized.shape[1]
-    resolution_y = (maxy - miny) / img_arry_equalized.shape[0]
+    grid_size = (max(1, math.ceil((maxx - minx) / resolution)), max(1, math.ceil((maxy - miny) / resolution)))
+
+    src_points = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    dst_points = np.float32([((x - minx) / resolution, (maxy - y) / resolution) for x, y in coordinate_array])
+    h_matrix = cv.getPerspectiveTransform(src_points, dst_points)
+    return h_matrix, from_origin(minx, maxy, resolution, resolution), grid_size
 
-    dst_points = np.float32([gps_to_pixel(coord, minx, maxy, resolution_x, resolution_y) for coord in coordinate_array])
 
-    # Apply warping to the CLAHE-processed image
-    try:
-        h_matrix, _ = cv.findHomography(src_points, dst_points, cv.RANSAC, 5)
-        georef_image_array = cv.warpPerspective(img_arry_equalized, h_matrix,
-                                                (img_arry_equalized.shape[1], img_arry_equalized.shape[0]),
-                                                borderMode=cv.BORDER_CONSTANT, borderValue=(0, 0, 0))
-    except Exception as e:
-        logger.opt(exception=True).warning(f"Error warping image to polygon: {e}")
-        return None
+def pixel_homography(h_matrix, transform, scale=1):
+    """
+    Inverse of the perspective transform of a warp: from output CRS coordinates, relative to the upper-left
+    corner of the grid, to pixels of the full-resolution source image, from its top-left corner.
 
-    return georef_image_array
+    Parameters:
+    - h_matrix: Homography from source image pixels to the output grid (see image_to_grid_homography).
+    - transform: Affine transform of the output grid.
+    - scale: Decode scale of the image the homography was computed for.
+    """
+    a, b, _, d, e, _ = transform[:6]
+    image_to_ground = np.array([[a, b, 0.0], [d, e, 0.0], [0.0, 0.0, 1.0]]) @ np.asarray(h_matrix, dtype=float)
+    return np.diag([scale, scale, 1.0]) @ np.linalg.inv(image_to_ground)
 
 
-def equalize_images(image_array):
+def cog_options():
     """
-    Equalizes the brightness and contrast of an image array.
+    COG_OPTIONS for this process. With several worker processes (config.workers, 0 for one per core), each
+    compresses with its share of the CPU cores instead of all of them.
+    """
+    cpus = os.cpu_count() or 1
+    workers = config.workers if config.workers > 0 else cpus
+    if workers <= 1:
+        return COG_OPTIONS
+    return dict(COG_OPTIONS, NUM_THREADS=str(max(1, cpus // workers)))
 
-    Parameters:
-    - image_array: The image array to be equalized.
 
-    Returns:
-    - The equalized image array.
+def write_cog(dataset, geotiff_file):
     """
-    # Normalize the image if necessary
-    if image_array.dtype == np.float32:  # Assuming the image is in float32 format
-        image_array_normalized = image_array / 255
-    else:  # Assuming the image is in uint8 format
-        image_array_normalized = image_array.astype(np.float32) / 255
+    Writes a dataset as a Cloud Optimized GeoTIFF with the GDAL COG driver (see cog_options).
+    """
+    with perf.span("cog"):
+        rasterio.shutil.copy(dataset, geotiff_file, driver="COG", **cog_options())
 
-    # Apply CLAHE
-    image_array_equalized = equalize_adapthist(image_array_normalized) * 255
-    if image_array.dtype == np.uint8:
-        image_array_equalized = image_array_equalized.astype(np.uint8)
 
-    return image_array_equalized
+@contextmanager
+def geotiff_writer(geotiff_file, in_memory=True, **profile):
+    """
+    Opens the destination GeoTIFF of a warp for writing.
 
+    Without config.cog the GeoTIFF is written in place. With config.cog the bands go to an uncompressed
+    staging GTiff, which the GDAL COG driver writes out once as a tiled, compressed COG with internal
+    overviews.
 
-def gps_to_pixel(gps_coord, x_min, y_max, resolution_x, resolution_y):
+    Parameters:
+    - geotiff_file: Destination path for the output GeoTIFF file.
+    - in_memory: Stage COG data in memory; otherwise in a temporary file next to the destination, which keeps
+      memory bounded for the tiled warp.
+    - profile: Creation parameters of the dataset (width, height, count, dtype, crs, transform, ...).
+
+    Yields:
+    - A rasterio dataset open for writing.
     """
-    Converts GPS coordinates to pixel coordinates based on image resolution and bounds.
+    if not config.cog:
+        with rasterio.open(geotiff_file, 'w', driver='GTiff', **profile) as dst:
+            yield dst
+    elif in_memory:
+        with rasterio.MemoryFile() as memfile:
+            with memfile.open(driver='GTiff', **profile) as dst:
+                yield dst
+            with memfile.open() as src:
+                write_cog(src, geotiff_file)
+    else:
+        staging_file = f"{geotiff_file}.staging.tif"
+        try:
+            with rasterio.open(staging_file, 'w', driver='GTiff', **profile) as dst:
+                yield dst
+            with rasterio.open(staging_file) as src:
+                write_cog(src, geotiff_file)
+        finally:
+            if os.path.exists(staging_file):
+                os.remove(staging_file)
+
+
+def warp_image_to_geotiff(img_arry, geotiff_file, polygon, coordinate_array, scale=1):
+    """
+    Orthorectifies an image array straight onto the output CRS grid and writes the GeoTIFF once.
+
+    A single perspective warp maps the image to the grid of the output file, which avoids the intermediate
+    in-memory dataset and the second resampling of the former path (see benchmarks/bench_warp.py).
+    The grid has square pixels sized by grid_resolution and covers only the bounds of the footprint.
 
     Parameters:
-    - gps_coord: Tuple of GPS coordinates (longitude, latitude).
-    - x_min, y_max: Minimum X and maximum Y bounds of the target area.
-    - resolution_x, resolution_y: X and Y resolutions of the target image.
+    - img_arry: The image array (RGB, RGBA or single band) to be warped.
+    - geotiff_file: Destination path for the output GeoTIFF file.
+    - polygon: The footprint polygon in the output CRS.
+    - coordinate_array: Footprint corners in the output CRS, in the order of the image corners.
+    - scale: Decode scale of the image array (see read_image).
 
     Returns:
-    - Tuple of pixel coordinates (x, y).
+    - dict: The grid of the GeoTIFF (see raster_grid).
     """
-    lon, lat = gps_coord
-    try:
-        Px = (lon - x_min) / resolution_x
-        Py = (y_max - lat) / resolution_y
-    except Exception as e:
-        logger.opt(exception=True).warning(f"Error converting GPS to pixel: {e}")
-    return int(Px), int(Py)
+    if config.image_equalize is True:
+        with perf.span("equalize"):
+            img_arry = equalize_adapthist(img_arry, clip_limit=0.03)
+
+    # The warp maps the image straight onto the output CRS grid, so it includes the reprojection.
+    with perf.span("warp"):
+        height, width = img_arry.shape[:2]
+        bands = 1 if img_arry.ndim == 2 else img_arry.shape[2]
+        resolution = grid_resolution(polygon, width, height, scale)
+        h_matrix, transform, (grid_width, grid_height) = image_to_grid_homography(width, height, polygon,
+                                                                                  coordinate_array, resolution)
+        inverse = pixel_homography(h_matrix, transform, scale)
+        if scale > 1:
+            # Pixel r of the reduced image averages source pixels r*scale to (r+1)*scale - 1, so its centre is
+            # at r + 0.5 - 0.5/scale in reduced units, as in the source windows of the tiled warp.
+            offset = 0.5 - 0.5 / scale
+            h_matrix = h_matrix @ np.array([[1.0, 0.0, offset], [0.0, 1.0, offset], [0.0, 0.0, 1.0]])
+        georef_image_array = cv.warpPerspective(img_arry, h_matrix, (grid_width, grid_height),
+                                                flags=cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT, borderValue=0)
+        if bands == 1:
+            georef_image_array = georef_image_array[np.newaxis]
+        else:
+            georef_image_array = georef_image_array.transpose(2, 0, 1)
+
+    with perf.span("write"), geotiff_writer(geotiff_file, width=grid_width, height=grid_height, count=bands,
+                                            dtype=georef_image_array.dtype,
+                                            crs=rasterio.crs.CRS.from_epsg(config.epsg_code), transform=transform,
+                                            nodata=0) as dst:
+        dst.write(georef_image_array)
+        if bands in COLOR_INTERPRETATIONS:
+            dst.colorinterp = COLOR_INTERPRETATIONS[bands]
+    return raster_grid(grid_width, grid_height, bands, georef_image_array.dtype, transform, inverse)
 
 
-def array2ds(cv2_array, polygon_wkt):
+def decode_scale(gsd):
     """
-    Converts an OpenCV image array to a rasterio dataset with geospatial data.
+    Cheapest decode scale (1, 2, 4 or 8) for the output resolution of the run.
+
+    With config.target_gsd, the largest scale whose pixels are still at least as fine as the target; with
+    config.downscale, the largest scale not above the factor.
 
     Parameters:
-    - cv2_array: The OpenCV image array to convert.
-    - polygon_wkt: Well-Known Text (WKT) representation of the polygon for spatial reference.
-    - epsg_code: EPSG code for the spatial reference system (default: 4326 for WGS84).
+    - gsd: Ground sampling distance of the full-resolution image in meters per pixel (ImageDrone.gsd).
 
     Returns:
-    - rasterio dataset object with the image and geospatial data.
+    - int: The decode scale.
     """
-    # Check input parameters
-    if not isinstance(cv2_array, np.ndarray):
-        logger.opt(exception=True).warning(f"cv2_array must be a numpy array.")
-    if not isinstance(polygon_wkt, str):
-        logger.opt(exception=True).warning(f"polygon_wkt must be a string.")
-    if not isinstance(config.epsg_code, int):
-        logger.opt(exception=True).warning(f"epsg_code must be an integer.")
-
-    polygon = loads(polygon_wkt)
-    minx, miny, maxx, maxy = polygon.bounds
+    factor = config.downscale or 1
+    if config.target_gsd and gsd and gsd > 0:
+        factor = config.target_gsd / gsd
+    return next((scale for scale in DECODE_SCALES if scale <= factor), 1)
 
-    # Image dimensions and bands
-    if len(cv2_array.shape) == 3:  # For color images
-        height, width, bands = cv2_array.shape
-    else:  # For grayscale images
-        height, width = cv2_array.shape
-        bands = 1
-
-    # Determine rasterio data type based on cv2_array data type
-    if cv2_array.dtype == np.uint8:
-        dtype = rasterio.uint8
-    elif cv2_array.dtype == np.uint16:
-        dtype = rasterio.uint16
-    elif cv2_array.dtype == np.int32:
-        dtype = rasterio.int32
-    elif cv2_array.dtype == np.float32:
-        dtype = rasterio.float32
-    elif cv2_array.dtype == np.float64:
-        dtype = rasterio.float64
-    else:
-        logger.opt(exception=True).warning(f"Unsupported data type: {str(cv2_array.dtype)}")
-
-    # Create and configure the rasterio dataset
-    transform = from_bounds(minx, miny, maxx, maxy, width, height)
-    crs = rasterio.crs.CRS.from_epsg(config.epsg_code)
-
-    with rasterio.MemoryFile() as memfile:
-        with memfile.open(driver='GTiff', height=height, width=width, count=bands, dtype=dtype, crs=crs,
-                          transform=transform) as dst:
-            if len(cv2_array.shape) == 3:  # For color images
-                for i in range(1, bands + 1):
-                    dst.write(cv2_array[:, :, i - 1], i)
-                    # Set color interpretation for each band if applicable
-                    if bands == 3:
-                        color_interpretations = [ColorInterp.red, ColorInterp.green, ColorInterp.blue]
-                        dst.colorinterp = color_interpretations[:bands]
-                    elif bands == 4:
-                        color_interpretations = [ColorInterp.red, ColorInterp.green, ColorInterp.blue,
-                                                 ColorInterp.alpha]
-                        dst.colorinterp = color_interpretations[:bands]
-            else:  # For grayscale images
-                dst.write(cv2_array, 1)
-                color_interpretations = [ColorInterp.gray]
-                dst.colorinterp = color_interpretations[:bands]
-        return memfile.open()
 
+def is_jpeg(image_path):
+    return Path(image_path).suffix.lower() in (".jpg", ".jpeg")
 
-@contextmanager
-def suppress_stdout_stderr():
-    """A context manager that redirects stdout and stderr to devnull"""
-    with open(os.devnull, 'w') as null:
-        old_stdout, old_stderr = sys.stdout, sys.stderr
-        sys.stdout, sys.stderr = null, null
-        try:
-            yield
-        finally:
-            sys.stdout, sys.stderr = old_stdout, old_stderr
 
-def warp_to_geotiff_file(geotiff_file:str, dataset):
+def read_image(image_path, scale=1):
     """
-    Warps a georeferenced image array into a GeoTIFF file.
+    Decodes an image at 1/scale of its size, keeping its bands and bit depth as cv.IMREAD_UNCHANGED does.
+
+    JPEGs are decoded straight to the reduced size by libjpeg (DCT scaling), which is several times faster
+    and needs a fraction of the memory; other formats are decoded in full and reduced by pixel-area averaging.
 
     Parameters:
-    - dst_utf8_path: Destination path for the output GeoTIFF file.
-    - ds: rasterio dataset object to be warped.
+    - image_path: Path of the image.
+    - scale: 1, 2, 4 or 8.
 
-    No return value.
+    Returns:
+    - The image array, or None when the file cannot be read.
+    """
+    if scale > 1 and is_jpeg(image_path):
+        with Image.open(image_path) as header:
+            single_band = header.mode in ("L", "I", "F")
+        flags = REDUCED_DECODE_FLAGS[scale][0 if single_band else 1]
+        return cv.imread(image_path, flags | cv.IMREAD_IGNORE_ORIENTATION)
+    img_arry = cv.imread(image_path, cv.IMREAD_UNCHANGED)
+    if img_arry is None or scale == 1:
+        return img_arry
+    height, width = img_arry.shape[:2]
+    return cv.resize(img_arry, (math.ceil(width / scale), math.ceil(height / scale)), interpolation=cv.INTER_AREA)
+
+
+def equalize_images(image_array):
     """
-    dst_crs = rasterio.crs.CRS.from_epsg(config.epsg_code)
-
-    transform, width, height = calculate_default_transform(
-        dataset.crs, dst_crs, dataset.width, dataset.height, *dataset.bounds)
-
-    kwargs = dataset.meta.copy()
-    kwargs.update({
-        'crs': dst_crs,
-        'transform': transform,
-        'width': width,
-        'height': height,
-        'nodata': 0  # Set nodata value to 0 (transparent)
-    })
-
-    with rasterio.open(geotiff_file, 'w', num_threads='all_cpus', **kwargs) as dst:
-        for i in range(1, dataset.count + 1):
-            reproject(
-                source=rasterio.band(dataset, i),
-                destination=rasterio.band(dst, i),
-                src_transform=dataset.transform,
-                src_crs=dataset.crs,
-                dst_transform=transform,
-                dst_crs=dst_crs,
-                resampling=Resampling.nearest)
-
-    if config.cog:
-        # Convert the GeoTIFF to a Cloud Optimized GeoTIFF (COG)
-        cogeo_profile = 'deflate'
-        with suppress_stdout_stderr():
-            cog_translate(geotiff_file, geotiff_file, cog_profiles.get(cogeo_profile), in_memory=True)
+    Equalizes the brightness and contrast of an image array.
+
+    Parameters:
+    - image_array: The image array to be equalized.
+
+    Returns:
+    - The equalized image array.
+    """
+    # Normalize the image if necessary
+    if image_array.dtype == np.float32:  # Assuming the image is in float32 format
+        image_array_normalized = image_array / 255
+    else:  # Assuming the image is in uint8 format
+        image_array_normalized = image_array.astype(np.float32) / 255
+
+    # Apply CLAHE
+    image_array_equalized = equalize_adapthist(image_array_normalized) * 255
+    if image_array.dtype == np.uint8:
+        image_array_equalized = image_array_equalized.astype(np.uint8)
+
+    return image_array_equalized
 
 
 def calculate_grid(num_images):
@@ -0,0 +1,164 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Run manifest: an append-only record of the images processed into an output directory.
+
+Each processed image appends one JSON line with its input fingerprint (path, size and modification time), a
+hash of the parameters that affect its output, its GeoJSON features, its footprint corners and its GeoTIFF path
+and grid. A rerun skips images
+whose record is complete and current, and the mission GeoJSON can be rebuilt from the records alone. Records
+keep the number of the last completed run that included their image, so a rebuild can leave out the images of
+earlier runs on other input sets.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from loguru import logger
+from Utils import config
+from Utils.metadata_cache import file_identity
+
+MANIFEST_FILE_NAME: str = "manifest.jsonl"
+# Settings that change the footprint or the GeoTIFF of an image. The memory budget decides which frames are warped
+# in blocks, which cannot be equalized.
+OUTPUT_SETTINGS: tuple = ("epsg_code", "rtk", "correct_magnetic_declinaison", "cog", "dtm_path", "global_elevation",
+                          "elevation_url", "image_equalize", "lense_correction", "absolute_ground", "footprints_only",
+                          "target_gsd", "downscale", "memory_budget")
+
+
+def output_parameters_hash(sensor_dimensions: dict) -> str:
+    """
+    Hash of the run parameters that affect the output of an image: the output settings of config, the DSM file
+    and the sensor table (including -w/-t overrides).
+    """
+    parameters = {name: getattr(config, name) for name in OUTPUT_SETTINGS}
+    if config.dtm_path and os.path.isfile(config.dtm_path):
+        parameters["dtm"] = file_identity(config.dtm_path)
+    parameters["sensors"] = [[list(key), list(value)] for key, value in sensor_dimensions.items()]
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def source_identity(data: dict) -> tuple:
+    """File identity of the source image of a metadata dictionary; size and time are None if it cannot be read."""
+    try:
+        return file_identity(data["SourceFile"])
+    except OSError:
+        return str(Path(data["SourceFile"]).absolute()), None, None
+
+
+def image_record(image, identity: tuple, parameters: str) -> dict:
+    """
+    Manifest record of a processed image.
+
+    Parameters:
+    - image (ImageDrone): The processed image.
+    - identity (tuple): File identity of its source image, from file_identity().
+    - parameters (str): Hash from output_parameters_hash().
+    """
+    geotiff = str(image.geotiff_file) if image.geotiff_file and os.path.isfile(image.geotiff_file) else None
+    return dict(path=identity[0], size=identity[1], mtime_ns=identity[2], parameters=parameters,
+                file_name=image.file_name, geotiff=geotiff, raster=(image.raster or None) if geotiff else None,
+                point=image.feature_point, polygon=image.feature_polygon,
+                corners=[[float(value) for value in point] for point in image.footprint_coordinates],
+                image_size=[image.image_width, image.image_height],
+                longitude=image.longitude, latitude=image.latitude, datetime_original=image.datetime_original,
+                drone_model=image.drone_model, sensor_model=image.sensor_model, epsg=config.epsg_code, cog=config.cog,
+                drone=[image.drone_make, image.drone_model, image.camera_make, image.sensor_model,
+                       image.sensor_width, image.sensor_height, image.lens_FOV_width, image.lens_FOV_height,
+                       image.focal_length, image.max_aperture_value])
+
+
+class RunManifest:
+    """
+    The run manifest of an output directory.
+
+    Records are appended and flushed one by one, so an interrupted run keeps every image it completed; the
+    latest record of an image wins. compact() rewrites the file with one record per image.
+    """
+
+    def __init__(self, output_directory):
+        self.path = Path(output_directory) / MANIFEST_FILE_NAME
+        self.records = {}
+        # Paths of the images of the current run, in mission order (see compact).
+        self.run_paths = []
+        self._file = None
+        self.load()
+
+    def load(self):
+        """Read the records of previous runs; a line cut short by an interruption is ignored."""
+        self.records = {}
+        if not self.path.is_file():
+            return
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.records[record["path"]] = record
+
+    def complete_record(self, identity: tuple, parameters: str) -> dict:
+        """
+        The record of an image whose source file, parameters and GeoTIFF (unless footprints only) are unchanged,
+        or None when the image has to be processed.
+        """
+        record = self.records.get(identity[0])
+        if (record is None or identity[1] is None or (record["size"], record["mtime_ns"]) != tuple(identity[1:])
+                or record["parameters"] != parameters):
+            return None
+        if not config.footprints_only and (record["geotiff"] is None or not os.path.isfile(record["geotiff"])):
+            return None
+        return record
+
+    def append(self, record: dict):
+        """Add the record of an image and write it to the manifest right away."""
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, default=float) + "\n")
+        self._file.flush()
+        self.records[record["path"]] = record
+
+    def compact(self, order: list = None):
+        """
+        Rewrite the manifest with one record per image.
+
+        Parameters:
+        - order (list): Paths whose records are written last, in this order (the images of the current run). Their
+          records get the number of the run (see latest_run_records).
+        """
+        self.close()
+        order = [path for path in order or [] if path in self.records]
+        run = max((record.get("run") or 0 for record in self.records.values()), default=0) + 1
+        for path in order:
+            self.records[path]["run"] = run
+        self.run_paths = order
+        ordered = set(order)
+        first = [path for path in self.records if path not in ordered]
+        temporary = self.path.with_suffix(".tmp")
+        with open(temporary, "w", encoding="utf-8") as file:
+            for path in first + order:
+                file.write(json.dumps(self.records[path], default=float) + "\n")
+        os.replace(temporary, self.path)
+        logger.debug(f"Run manifest {self.path} compacted to {len(self.records)} records.")
+
+    def run_records(self) -> list:
+        """Records of the images of the current run, in mission order."""
+        return [self.records[path] for path in self.run_paths]
+
+    def latest_run_records(self) -> list:
+        """
+        Records of the images of the last completed run, in file order; every record for a manifest written before
+        runs were numbered.
+        """
+        latest = max((record.get("run") or 0 for record in self.records.values()), default=0)
+        return [record for record in self.records.values() if (record.get("run") or 0) == latest]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
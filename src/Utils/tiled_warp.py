@@ -0,0 +1,219 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Tiled, bounded-memory orthorectification.
+
+The output GeoTIFF is produced block by block: the pixels of each output block are mapped back through the
+inverse homography (and the lens distortion map, when lens correction is enabled) to source image
+coordinates, only the source window they cover is read, and the block is resampled with cv.remap. Source
+windows larger than the memory budget are read decimated, so peak memory stays bounded whatever the size of
+the input frame. Tiled TIFF inputs are read efficiently; JPEG windows are decoded from the start of the file.
+
+Within the budget, the output matches the whole-frame path (raster_utils.warp_image_to_geotiff) to 1 DN, at every
+decode scale, for frames whose dimensions are multiples of the decode scale (benchmarks/check_tiled_warp.py). For
+other dimensions the reduced decode rounds the frame size up, which shifts the whole-frame result by a fraction of an
+output pixel.
+"""
+
+import math
+import warnings
+import numpy as np
+import cv2 as cv
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
+from loguru import logger
+import Utils.config as config
+from Utils.raster_utils import COLOR_INTERPRETATIONS, geotiff_writer, grid_resolution, image_to_grid_homography, \
+    is_jpeg, pixel_homography, raster_grid
+
+TILE_SIZE: int = 512
+# Full-size copies held by the in-memory path: decoded frame, undistorted/colour-converted copy, warped
+# frame and the band-interleaved buffer written to the GeoTIFF.
+FULL_FRAME_COPIES: int = 4
+# Source coordinate used for output pixels that do not map into the image.
+OUTSIDE: float = -1e6
+
+
+def open_source(image_path):
+    """Open an image for windowed reading (drone images carry no georeferencing)."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        return rasterio.open(image_path)
+
+
+def full_frame_bytes(width, height, bands, dtype):
+    """
+    Estimate the memory needed to warp a frame in one piece.
+
+    The float64 copies made by contrast equalization are not counted: equalization needs the whole frame, so
+    counting them would send ordinary frames to the tiled path, which cannot equalize.
+
+    Returns:
+    - int: Bytes held by the full-size copies of the in-memory path.
+    """
+    return FULL_FRAME_COPIES * width * height * bands * np.dtype(dtype).itemsize
+
+
+def needs_tiling(image_path, memory_budget_mb, scale=1):
+    """
+    Whether a frame is too large to be warped in one piece within the memory budget.
+
+    Parameters:
+    - image_path: Path of the source image.
+    - memory_budget_mb: Memory budget in MB; 0 or None disables tiling.
+    - scale: Decode scale of the frame (see raster_utils.read_image).
+    """
+    if not memory_budget_mb:
+        return False
+    with open_source(image_path) as src:
+        needed = full_frame_bytes(math.ceil(src.width / scale), math.ceil(src.height / scale), src.count,
+                                  src.dtypes[0])
+        if scale > 1 and not is_jpeg(image_path):
+            # Only JPEGs are decoded straight to the reduced size; other formats are decoded in full first.
+            needed += src.width * src.height * src.count * np.dtype(src.dtypes[0]).itemsize
+    return needed > memory_budget_mb * 2 ** 20
+
+
+def _lens_sample(lens_modifier, u, v, width, height):
+    """
+    Map undistorted image coordinates to coordinates in the distorted source image.
+
+    The lensfun distortion map is computed only for the sub-window covering the requested points and
+    interpolated bilinearly at their positions.
+    """
+    inside = (u >= 0) & (u <= width - 1) & (v >= 0) & (v <= height - 1)
+    sx = np.full(u.shape, OUTSIDE, dtype=np.float32)
+    sy = np.full(u.shape, OUTSIDE, dtype=np.float32)
+    if not inside.any():
+        return sx, sy
+    x0, y0 = int(np.floor(u[inside].min())), int(np.floor(v[inside].min()))
+    x1 = min(int(np.ceil(u[inside].max())) + 1, width)
+    y1 = min(int(np.ceil(v[inside].max())) + 1, height)
+    lens_map = lens_modifier.apply_geometry_distortion(x0, y0, x1 - x0, y1 - y0).astype(np.float32)
+    map_u = np.where(inside, u - x0, OUTSIDE).astype(np.float32)
+    map_v = np.where(inside, v - y0, OUTSIDE).astype(np.float32)
+    sx = cv.remap(np.ascontiguousarray(lens_map[..., 0]), map_u, map_v, cv.INTER_LINEAR,
+                  borderMode=cv.BORDER_CONSTANT, borderValue=OUTSIDE)
+    sy = cv.remap(np.ascontiguousarray(lens_map[..., 1]), map_u, map_v, cv.INTER_LINEAR,
+                  borderMode=cv.BORDER_CONSTANT, borderValue=OUTSIDE)
+    return sx, sy
+
+
+def _source_coordinates(window, inverse_homography, width, height, lens_modifier=None):
+    """
+    Source image coordinates of every pixel of an output window.
+
+    Returns:
+    - Tuple of float32 arrays (x, y) with the shape of the window.
+    """
+    cols = np.arange(window.col_off, window.col_off + window.width, dtype=np.float64)
+    rows = np.arange(window.row_off, window.row_off + window.height, dtype=np.float64)
+    x, y = np.meshgrid(cols, rows)
+    h = inverse_homography
+    w = h[2, 0] * x + h[2, 1] * y + h[2, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = np.where(w > 0, (h[0, 0] * x + h[0, 1] * y + h[0, 2]) / w, OUTSIDE)
+        v = np.where(w > 0, (h[1, 0] * x + h[1, 1] * y + h[1, 2]) / w, OUTSIDE)
+    if lens_modifier is not None:
+        return _lens_sample(lens_modifier, u, v, width, height)
+    return u.astype(np.float32), v.astype(np.float32)
+
+
+def _warp_window(src, window, inverse_homography, window_budget, lens_modifier=None, scale=1):
+    """
+    Resample one output window from the source image.
+
+    The source window is read decimated by the output scale, averaging source pixels, and further if it would
+    not fit in the budget.
+
+    Returns:
+    - numpy.ndarray of shape (bands, height, width), or None when the window does not overlap the image.
+    """
+    sx, sy = _source_coordinates(window, inverse_homography, src.width, src.height, lens_modifier)
+    # Output pixels within one decoded pixel of the image, blended with the border like cv.warpPerspective does.
+    margin = (scale + 1) / 2
+    valid = (sx > -margin) & (sx < src.width + margin - 1) & (sy > -margin) & (sy < src.height + margin - 1)
+    if not valid.any():
+        return None
+
+    x0 = max(int(np.floor(sx[valid].min())) - 1, 0)
+    y0 = max(int(np.floor(sy[valid].min())) - 1, 0)
+    x1 = min(int(np.ceil(sx[valid].max())) + 2, src.width)
+    y1 = min(int(np.ceil(sy[valid].max())) + 2, src.height)
+    window_bytes = (x1 - x0) * (y1 - y0) * src.count * np.dtype(src.dtypes[0]).itemsize
+    factor = max(math.sqrt(window_bytes / window_budget) if window_bytes > window_budget else 1.0, scale)
+    if factor == scale > 1:
+        # Align the window on the grid of the image decoded at this scale, so each decimated pixel averages the
+        # same source pixels as in the whole-frame path.
+        x0, y0 = x0 // scale * scale, y0 // scale * scale
+        x1, y1 = min(-(-x1 // scale) * scale, src.width), min(-(-y1 // scale) * scale, src.height)
+    read_width, read_height = x1 - x0, y1 - y0
+
+    # Read the covering source window, decimated if it would not fit in the budget.
+    out_width = max(1, math.ceil(read_width / factor))
+    out_height = max(1, math.ceil(read_height / factor))
+    source = src.read(window=Window(x0, y0, read_width, read_height), out_shape=(src.count, out_height, out_width),
+                      resampling=Resampling.average)
+    scale_x, scale_y = read_width / out_width, read_height / out_height
+    map_x = np.where(valid, (sx - x0 + 0.5) / scale_x - 0.5, OUTSIDE).astype(np.float32)
+    map_y = np.where(valid, (sy - y0 + 0.5) / scale_y - 0.5, OUTSIDE).astype(np.float32)
+
+    tile = np.empty((src.count, window.height, window.width), dtype=source.dtype)
+    for band in range(src.count):
+        tile[band] = cv.remap(source[band], map_x, map_y, cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT,
+                              borderValue=0)
+    return tile
+
+
+def warp_file_to_geotiff_tiled(image_path, geotiff_file, polygon, coordinate_array, memory_budget_mb,
+                               lens_modifier=None, scale=1):
+    """
+    Orthorectifies an image file onto the output CRS grid block by block within a memory budget.
+
+    The output grid (square pixels sized by grid_resolution over the footprint bounds) and homography are the
+    same as for warp_image_to_geotiff. Contrast equalization needs the
+    whole frame and is not applied in tiled mode.
+
+    Parameters:
+    - image_path: Path of the source image.
+    - geotiff_file: Destination path for the output GeoTIFF file.
+    - polygon: The footprint polygon in the output CRS.
+    - coordinate_array: Footprint corners in the output CRS, in the order of the image corners.
+    - memory_budget_mb: Memory budget in MB for image data (source windows, output blocks and GDAL cache). The GDAL
+      cache keeps its own size setting: overriding GDAL_CACHEMAX around the warp made COG output slower.
+    - lens_modifier: Initialized lensfunpy.Modifier for the full frame, or None to skip lens correction.
+    - scale: Decode scale matched to the output resolution; source windows are read decimated by it.
+
+    Returns:
+    - dict: The grid of the GeoTIFF (see raster_utils.raster_grid).
+    """
+    budget = memory_budget_mb * 2 ** 20
+    with open_source(image_path) as src:
+        bands, dtype = src.count, src.dtypes[0]
+        tile_bytes = TILE_SIZE * TILE_SIZE * (bands * np.dtype(dtype).itemsize + 4 * 4)
+        # A quarter of the budget is left for the GDAL block cache, the rest goes to source windows and blocks.
+        window_budget = max(budget * 3 // 4 - 2 * tile_bytes, tile_bytes)
+        # Sized from the decoded frame, like the whole-frame path.
+        resolution = grid_resolution(polygon, math.ceil(src.width / scale), math.ceil(src.height / scale), scale)
+        h_matrix, transform, (grid_width, grid_height) = image_to_grid_homography(src.width, src.height, polygon,
+                                                                                  coordinate_array, resolution)
+        inverse_homography = np.linalg.inv(h_matrix)
+
+        profile = dict(width=grid_width, height=grid_height, count=bands, dtype=dtype,
+                       crs=rasterio.crs.CRS.from_epsg(config.epsg_code), transform=transform, nodata=0,
+                       tiled=True, blockxsize=TILE_SIZE, blockysize=TILE_SIZE)
+        with geotiff_writer(geotiff_file, in_memory=False, **profile) as dst:
+            for _, window in dst.block_windows(1):
+                tile = _warp_window(src, window, inverse_homography, window_budget, lens_modifier, scale)
+                # Blocks outside the footprint are left unwritten and read back as nodata.
+                if tile is not None:
+                    dst.write(tile, window=window)
+            if bands in COLOR_INTERPRETATIONS:
+                dst.colorinterp = COLOR_INTERPRETATIONS[bands]
+    logger.debug(f"Warped {image_path} in {TILE_SIZE}x{TILE_SIZE} blocks within {memory_budget_mb} MB.")
+    return raster_grid(grid_width, grid_height, bands, dtype, transform, pixel_homography(h_matrix, transform))
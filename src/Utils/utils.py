@@ -2,9 +2,14 @@
 # __author__ = "Dean Hand"
 # __license__ = "AGPL"
 # __version__ = "1.0"
-import pandas as pd
+import csv
+import math
 from loguru import logger
 
+# Numeric columns of the sensor CSV; empty cells are read as NaN.
+SENSOR_CSV_INTEGERS = ("RigCameraIndex",)
+SENSOR_CSV_FLOATS = ("SensorWidth", "SensorHeight", "LensFOVw", "LensFOVh")
+
 
 class Color:
     """Defines color codes for console output."""
@@ -35,6 +40,31 @@ class Color:
         self.color = self.DARKMAGENTA
 
 
+def read_csv_rows(csv_filepath):
+    """
+    Read the rows of a CSV file as dictionaries, with the values of numeric columns converted to numbers and
+    empty cells read as NaN, like pandas.read_csv for this file but without importing pandas.
+
+    Returns:
+    - list[dict]: The rows, or None when the file is empty.
+    """
+    with open(csv_filepath, newline="") as file:
+        reader = csv.DictReader(file)
+        if reader.fieldnames is None:
+            return None
+        rows = []
+        for row in reader:
+            for column, text in row.items():
+                if text == "":
+                    row[column] = math.nan
+                elif column in SENSOR_CSV_INTEGERS:
+                    row[column] = int(text) if text.lstrip("-").isdigit() else float(text)
+                elif column in SENSOR_CSV_FLOATS:
+                    row[column] = float(text)
+            rows.append(row)
+    return rows
+
+
 def read_sensor_dimensions_from_csv(csv_filepath, default_sensor_width=0, default_sensor_height=0, default_lens_FOVw=0,
                                     default_lens_FOVh=0):
     """
@@ -53,8 +83,11 @@ def read_sensor_dimensions_from_csv(csv_filepath, default_sensor_width=0, defaul
     """
     sensor_dimensions = {}
     try:
-        df = pd.read_csv(csv_filepath)
-        for _, row in df.iterrows():
+        rows = read_csv_rows(csv_filepath)
+        if rows is None:
+            logger.critical("Error: The CSV file is empty.")
+            return sensor_dimensions
+        for row in rows:
             drone_make = row["DroneMake"]
             drone_model = row["DroneModel"]
             camera_make = row["CameraMake"]
@@ -79,8 +112,6 @@ def read_sensor_dimensions_from_csv(csv_filepath, default_sensor_width=0, defaul
 
     except FileNotFoundError:
         logger.critical(f"Error: The file {csv_filepath} was not found.")
-    except pd.errors.EmptyDataError:
-        logger.critical("Error: The CSV file is empty.")
     except Exception as e:
         logger.critical(f"An unexpected error occurred: {e}")
     return sensor_dimensions
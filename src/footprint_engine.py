@@ -0,0 +1,165 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Vectorized footprint engine.
+
+Computes the ground footprint corners of a whole flight in a single NumPy pass with float64 rotation
+matrices. It reproduces the geometry of the former per-image mpmath/vector3d/quaternion implementation:
+the gimbal angles are turned into z-y-z Euler angles, the four corner rays of the camera frustum are
+rotated and intersected with the ground plane below the drone.
+
+Tolerance: corner offsets agree with the former implementation to a relative error of 1e-12 of the corner
+distance (float64 rounding, measured at about 1e-13 by benchmarks/check_footprint_engine.py), i.e. far below
+a millimetre even for oblique frames whose corners reach kilometres from the drone.
+"""
+
+import numpy as np
+
+# Corner order of the camera rays (vertical sign, horizontal sign), matching the historical ray order.
+RAY_SIGNS = np.array([[-1.0, 1.0], [-1.0, -1.0], [1.0, -1.0], [1.0, 1.0]])
+
+
+def fov_angles(sensor_width, sensor_height, focal_length, lens_fov_w=1.0, lens_fov_h=1.0):
+    """
+    Calculate the corrected horizontal and vertical fields of view.
+
+    Parameters:
+    - sensor_width, sensor_height (float or array): Sensor dimensions in millimeters.
+    - focal_length (float or array): Focal length in millimeters.
+    - lens_fov_w, lens_fov_h (float or array): Lens correction factors from the sensor database.
+
+    Returns:
+    tuple: Field of view width and height in radians, as float64 arrays.
+    """
+    focal_length = np.asarray(focal_length, dtype=np.float64)
+    fov_w = 2 * np.arctan(np.asarray(sensor_width, dtype=np.float64) / (2 * focal_length))
+    fov_h = 2 * np.arctan(np.asarray(sensor_height, dtype=np.float64) / (2 * focal_length))
+    return fov_w * np.asarray(lens_fov_w, dtype=np.float64), fov_h * np.asarray(lens_fov_h, dtype=np.float64)
+
+
+def gimbal_angles_to_radians(gimbal_yaw_deg, gimbal_pitch_deg, gimbal_roll_deg, declination=None):
+    """
+    Convert gimbal angles to the Euler angles used to rotate the camera rays.
+
+    - Yaw is measured from east, optionally corrected for magnetic declination, and wrapped to [0, 2*pi).
+    - Pitch is offset so that near-nadir shots (-120 to -60 degrees) point the camera straight down.
+    - Roll is converted directly to radians.
+
+    Parameters:
+    - gimbal_yaw_deg, gimbal_pitch_deg, gimbal_roll_deg (float or array): Gimbal angles in degrees.
+    - declination (float or array, optional): Magnetic declination in degrees; None disables the correction.
+
+    Returns:
+    tuple: Yaw, pitch and roll arrays in radians.
+    """
+    yaw = np.asarray(gimbal_yaw_deg, dtype=np.float64)
+    pitch = np.asarray(gimbal_pitch_deg, dtype=np.float64)
+    roll = np.asarray(gimbal_roll_deg, dtype=np.float64)
+
+    near_nadir = (pitch >= -120) & (pitch <= -60)
+    pitch_rad = np.radians(np.where(near_nadir, 90 - pitch, 180 - pitch))
+    if declination is not None:
+        yaw = yaw + np.asarray(declination, dtype=np.float64)
+    yaw_rad = np.mod(np.pi / 2 - np.radians(yaw), 2 * np.pi)
+    return yaw_rad, pitch_rad, np.radians(roll)
+
+
+def rotation_matrices(yaw, pitch, roll):
+    """
+    Build z-y-z rotation matrices R = Rz(yaw) @ Ry(pitch) @ Rz(roll) for arrays of angles in radians.
+
+    Returns:
+    numpy.ndarray: Array of shape (N, 3, 3).
+    """
+    yaw, pitch, roll = np.broadcast_arrays(*(np.atleast_1d(np.asarray(a, dtype=np.float64))
+                                             for a in (yaw, pitch, roll)))
+    ca, sa = np.cos(yaw), np.sin(yaw)
+    cb, sb = np.cos(pitch), np.sin(pitch)
+    cg, sg = np.cos(roll), np.sin(roll)
+
+    rotation = np.empty(yaw.shape + (3, 3))
+    rotation[..., 0, 0] = ca * cb * cg - sa * sg
+    rotation[..., 0, 1] = -ca * cb * sg - sa * cg
+    rotation[..., 0, 2] = ca * sb
+    rotation[..., 1, 0] = sa * cb * cg + ca * sg
+    rotation[..., 1, 1] = -sa * cb * sg + ca * cg
+    rotation[..., 1, 2] = sa * sb
+    rotation[..., 2, 0] = -sb * cg
+    rotation[..., 2, 1] = sb * sg
+    rotation[..., 2, 2] = cb
+    return rotation
+
+
+def camera_rays(fov_w, fov_h):
+    """
+    Build the four normalized corner rays of the camera frustum in camera coordinates.
+
+    Returns:
+    numpy.ndarray: Array of shape (N, 4, 3).
+    """
+    fov_w, fov_h = np.broadcast_arrays(np.atleast_1d(np.asarray(fov_w, dtype=np.float64)),
+                                       np.atleast_1d(np.asarray(fov_h, dtype=np.float64)))
+    tan_v = np.tan(fov_h / 2)[:, None]
+    tan_h = np.tan(fov_w / 2)[:, None]
+    rays = np.empty(fov_w.shape + (4, 3))
+    rays[..., 0] = RAY_SIGNS[:, 0] * tan_v
+    rays[..., 1] = RAY_SIGNS[:, 1] * tan_h
+    rays[..., 2] = 1.0
+    return rays / np.linalg.norm(rays, axis=-1, keepdims=True)
+
+
+def ground_offsets(gimbal_yaw_deg, gimbal_pitch_deg, gimbal_roll_deg, altitude, fov_w, fov_h, declination=None):
+    """
+    Compute the footprint corners of many images at once.
+
+    Parameters:
+    - gimbal_yaw_deg, gimbal_pitch_deg, gimbal_roll_deg (array): Gimbal angles in degrees.
+    - altitude (array): Height of the camera above the ground plane in meters.
+    - fov_w, fov_h (array): Fields of view in radians (see fov_angles).
+    - declination (array, optional): Magnetic declination in degrees; None disables the correction.
+
+    Returns:
+    numpy.ndarray: Array of shape (N, 4, 2) with the east/north offsets in meters of each footprint corner
+    from the point below the drone. Corners whose ray is parallel to the ground are NaN.
+    """
+    yaw, pitch, roll = gimbal_angles_to_radians(gimbal_yaw_deg, gimbal_pitch_deg, gimbal_roll_deg, declination)
+    rotated = np.einsum("nij,nkj->nki", rotation_matrices(yaw, pitch, roll), camera_rays(fov_w, fov_h))
+
+    altitude = np.atleast_1d(np.asarray(altitude, dtype=np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = np.where(rotated[..., 2] == 0, np.nan, -altitude[:, None] / rotated[..., 2])
+    return rotated[..., :2] * scale[..., None]
+
+
+def image_ground_offsets(images, altitude=None, correct_declination=False):
+    """
+    Compute footprint corner offsets for a list of ImageDrone objects in one vectorized pass.
+
+    Parameters:
+    - images (list[ImageDrone]): Images of the flight.
+    - altitude (array, optional): Height above ground for each image; defaults to 1 m so that the result
+      can be scaled by each image's height once it is known (offsets are linear in altitude).
+    - correct_declination (bool): Add each image's magnetic declination to the gimbal yaw.
+
+    Returns:
+    numpy.ndarray: Array of shape (N, 4, 2), see ground_offsets.
+    """
+    if not images:
+        return np.empty((0, 4, 2))
+    fov_w, fov_h = fov_angles([image.sensor_width for image in images],
+                              [image.sensor_height for image in images],
+                              [image.focal_length for image in images],
+                              [image.lens_FOV_width for image in images],
+                              [image.lens_FOV_height for image in images])
+    declination = None
+    if correct_declination:
+        declination = [image.declination or 0.0 for image in images]
+    if altitude is None:
+        altitude = np.ones(len(images))
+    return ground_offsets([image.gimbal_yaw_degree for image in images],
+                          [image.gimbal_pitch_degree for image in images],
+                          [image.gimbal_roll_degree for image in images],
+                          altitude, fov_w, fov_h, declination)
@@ -1,15 +1,39 @@
 import os
 from dataclasses import dataclass,field
 from pathlib import Path
-from datetime import datetime
-import geojson
-from geojson_rewind import rewind
-from magnetic_field_calculator import MagneticFieldCalculator
-import magnetismi.magnetismi as api
-from shapely.geometry import Polygon
 from Utils.utils import Color
 from Utils import config
-from create_geotiffs import set_raster_extents
+
+# Group-qualified tags read by ImageDrone.__post_init__; metadata extraction is restricted to these.
+METADATA_TAGS = [
+    "File:FileName",
+    "Composite:GPSLatitude", "EXIF:GPSLatitude", "Composite:GPSLongitude", "EXIF:GPSLongitude",
+    "Composite:GPSAltitude", "XMP:RelativeAltitude", "XMP:AbsoluteAltitude",
+    "EXIF:FocalLength", "EXIF:FocalLengthIn35mmFormat", "EXIF:MaxApertureValue",
+    "XMP:GimbalRollDegree", "XMP:GimbalPitchDegree", "XMP:GimbalYawDegree",
+    "MakerNotes:CameraRoll", "MakerNotes:CameraPitch", "MakerNotes:CameraYaw", "XMP:Roll", "XMP:Pitch", "XMP:Yaw",
+    "XMP:FlightPitchDegree", "XMP:FlightRollDegree", "XMP:FlightYawDegree",
+    "MakerNotes:Pitch", "MakerNotes:Roll", "MakerNotes:Yaw",
+    "EXIF:ImageWidth", "EXIF:ImageHeight", "EXIF:ExifImageWidth", "EXIF:ExifImageHeight",
+    "EXIF:DateTimeOriginal", "EXIF:Model", "XMP:RigCameraIndex", "XMP:SensorIndex",
+]
+
+# Decimals kept in GeoJSON coordinates (about 0.1 m in degrees), the default of the geojson package.
+GEOJSON_PRECISION = 6
+
+
+def rewind_ring(coordinates) -> list:
+    """
+    Close a ring of (x, y) points and orient it counterclockwise, as RFC 7946 requires for exterior rings.
+
+    Coordinates are rounded to GEOJSON_PRECISION decimals and the winding rule is that of geojson_rewind, so the
+    result is the same as the former round trip of the ring through shapely, geojson and geojson_rewind.
+    """
+    ring = [[round(float(value), GEOJSON_PRECISION) for value in point] for point in coordinates]
+    if ring[0] != ring[-1]:
+        ring.append(list(ring[0]))
+    area = sum((ring[i][0] - ring[i - 1][0]) * (ring[i - 1][1] + ring[i][1]) for i in range(len(ring)))
+    return ring[::-1] if area >= 0 else ring
 
 
 @dataclass
@@ -27,6 +51,8 @@ class ImageDrone:
     image_path : str = ""
     output_file : str = ""
     geotiff_file : str = ""
+    timings : dict = field(default_factory=dict)
+    raster : dict = field(default_factory=dict)
 
     def __post_init__(self):
 
@@ -133,27 +159,30 @@ class ImageDrone:
         self.create_properties()
         self.create_hash()
 
+    def __getstate__(self):
+        # The config module cannot be pickled; worker processes re-attach their own copy on unpickling.
+        state = self.__dict__.copy()
+        state["config"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.config = config
 
 
-#def find_declination(altitude, focal_length, drone_latitude, drone_longitude, datetime_original):
     def find_declination(self):
-        str_date = datetime.strptime(self.datetime_original, '%Y:%m:%d %H:%M:%S')
-
-        if str(str_date.year) > str(2019):
-            mag_date = api.dti.date(str_date.year, str_date.month, str_date.day)
-            # Find the magnetic declination reference
-            model = api.Model(mag_date.year)
-            field_point = model.at(lat_dd=self.latitude, lon_dd=self.longitude, alt_ft=self.relative_altitude, date=mag_date)
-            declination = field_point.dec
-        else:
-            calculator = MagneticFieldCalculator()
-            model = calculator.calculate(latitude=self.latitude, longitude=self.longitude)
-            dec = model['field-value']['declination']
-            declination = dec['value']
+        """
+        Look up the magnetic declination of the image (offline and cached), only when correction is enabled.
+        """
+        if not config.correct_magnetic_declinaison:
+            self.declination = None
+            return
 
         if self.relative_altitude < 0 or self.focal_length <= 0:
-            config.pbar.write(Color.RED + ValueError("Altitude and focal length must be positive.") + Color.END)
-        self.declination=declination
+            config.pbar.write(f"{Color.RED}Altitude and focal length must be positive.{Color.END}")
+        # The magnetic model (magnetismi) is only loaded when declination correction is enabled.
+        from Utils.declination import find_declination
+        self.declination = find_declination(self.latitude, self.longitude, self.datetime_original)
 
 
 
@@ -164,7 +193,8 @@ class ImageDrone:
         self.image_path = os.path.join(indir_path, self.file_name)
         self.output_file = f"{Path(self.file_name).stem}.tif"
         self.geotiff_file = Path(geotiff_dir) / self.output_file
-        #generate_geotiff(image_path, geotiff_file, self.coord_array)
+        # The raster stack (cv2, rasterio, lensfunpy, skimage) is only loaded when GeoTIFFs are generated.
+        from create_geotiffs import set_raster_extents
         try:
             set_raster_extents(self)
         except ValueError as e:
@@ -181,9 +211,7 @@ class ImageDrone:
         # Properties setup and other related processing goes here.
         # This is simplified to focus on structure. Implement as needed based on the original function.
 
-        geojson_polygon = geojson.dumps(Polygon(self.footprint_coordinates))
-        rewound_polygon = rewind(geojson.loads(geojson_polygon))
-        array_rw = rewound_polygon["coordinates"][0]
+        array_rw = rewind_ring(self.footprint_coordinates)
         closed_array = [
             (array_rw[0]),
             (array_rw[3]),
@@ -3,127 +3,368 @@
 # License: AGPL
 # Version: 1.0
 import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from tqdm import tqdm
 from loguru import logger
 from Utils.utils import Color
 from Utils import config
+from Utils import logger_config
+from Utils import perf
+from Utils.new_elevation import get_elevation_source, elevation_stats, open_elevation_snapshot, \
+    restore_open_elevations, open_elevation_stats, open_elevation_subset, add_open_elevations
+from Utils.declination import declination_stats
+from Utils.run_manifest import RunManifest, output_parameters_hash, source_identity, image_record
+from Utils.footprint_index import write_index
 from imagedrone import ImageDrone
-from new_fov import HighAccuracyFOVCalculator
-import itertools
+from new_fov import HighAccuracyFOVCalculator, prefetch_open_elevations
+from footprint_engine import image_ground_offsets
+import json
+from collections import deque
+from typing import Iterable
+import numpy as np
 
 
-def process_metadata(metadata:list[dict], indir_path:str, geotiff_dir:str, sensor_dimensions:dict) -> tuple[dict, list[ImageDrone]]:
+def init_worker(settings: dict, log_path, open_elevations: dict = None):
     """
-    Process and convert image metadata into GeoJSON features and create GeoTIFFs.
+    Initialize a worker process with the mission-wide settings and logging of the parent process.
+
+    Args:
+        settings (dict): Snapshot of the parent's settings from config.get_settings().
+        log_path (Path): Log file of the run, or None when logging was not initialized.
+        open_elevations (dict): Prefetched elevation service results from open_elevation_snapshot(), or None.
+    """
+    config.apply_settings(settings)
+    if open_elevations is not None:
+        restore_open_elevations(open_elevations)
+    if log_path is not None:
+        logger_config.init_logger(log_path=log_path)
+
+
+def log_image_error(error: Exception, image: ImageDrone, data: dict):
+    """
+    Log an image whose metadata could not be used.
+
+    Args:
+        error (Exception): The TypeError, KeyError or ValueError raised while processing the image.
+        image (ImageDrone): The image, or None if it could not be created.
+        data (dict): Metadata of the image file.
+    """
+    file_name = image.file_name if image is not None else data.get('SourceFile', 'unknown')
+    if isinstance(error, ValueError):
+        logger.exception(f"Invalid value for metadata key: {error} for image: {file_name}")
+    else:
+        logger.exception(f"Missing metadata key: {error} for image: {file_name}")
+
+
+def prepare_images(metadata: list[dict], sensor_dimensions: dict) -> tuple[list[ImageDrone], np.ndarray]:
+    """
+    Create the ImageDrone objects of a flight and compute all their footprint corners in one vectorized pass.
 
     Args:
         metadata (list[dict]): Metadata from each image file.
-        indir_path (Path): Input directory path containing the original images.
-        geotiff_dir (Path): Output directory path for saving generated GeoTIFFs.
         sensor_dimensions (dict): A dictionary with sensor model keys and dimension values.
 
     Returns:
-        dict: A GeoJSON FeatureCollection comprising features derived from the image metadata.
+        tuple: The usable images and their footprint corner offsets for a 1 m height, shape (N, 4, 2).
     """
-    feature_collection = {"type": "FeatureCollection", "features": []}
-    line_coordinates = []
-    outer = tqdm(total=len(metadata),position=0,desc=f'{Color.CYAN}Image Files',leave=False)
-    pbar = tqdm(total=len(metadata), position=1, leave=False, bar_format='{desc}')
-    line_feature = ""
-    nb_processed_images = 0
-    logger.info("Processing images for GeoTiff and GeoJSON creation.")
-    #same_drone_as_previous_image_array = []
-    images_array : list[ImageDrone] = []
-
-    datetime_original = ""
+    images = []
     for data in metadata:
-        # pprint(data)clear
         image = None
         try:
             image = ImageDrone(data, sensor_dimensions, config)
-            images_array.append(image)
-            pbar.set_description_str(f'{Color.YELLOW}Current file: {image.file_name}{Color.END}')
+            with perf.collect(image.timings), perf.span("declination"):
+                image.find_declination()
+            images.append(image)
+        except (TypeError, KeyError, ValueError) as error:
+            log_image_error(error, image, data)
+    with perf.span("footprint_offsets"):
+        unit_offsets = image_ground_offsets(images, correct_declination=config.correct_magnetic_declinaison)
+    return images, unit_offsets
 
-            # Extract detailed sensor and drone info for the current image
 
-            #properties, same_drone_as_previous_image = extract_sensor_info(data, sensor_dimensions, image.file_name)
-            #same_drone_as_previous_image_array.append(same_drone_as_previous_image)
+def process_image(image: ImageDrone, unit_offsets: np.ndarray, indir_path: str, geotiff_dir: str) -> ImageDrone:
+    """
+    Run the per-image pipeline: footprint calculation, GeoJSON features and GeoTIFF generation.
+
+    All per-image state travels with the returned ImageDrone, so this function can run in a worker process.
 
-            datetime_original = image.datetime_original
-            config.update_file_name(image.file_name)
-            config.update_abso_altitude(image.absolute_altitude)
-            config.update_rel_altitude(image.relative_altitude)
+    Args:
+        image (ImageDrone): The image to process.
+        unit_offsets (numpy.ndarray): Footprint corner offsets of the image for a 1 m height.
+        indir_path (Path): Input directory path containing the original images.
+        geotiff_dir (Path): Output directory path for saving generated GeoTIFFs.
 
+    Returns:
+        ImageDrone: The processed image, or None if its metadata could not be used.
+    """
+    try:
+        with perf.collect(image.timings):
             # Calculate Field of View (FOV) or any other necessary geometric calculations
-            image.coord_array, image.footprint_coordinates = HighAccuracyFOVCalculator(image).get_fov_bbox()
+            with perf.span("footprint"):
+                image.coord_array, image.footprint_coordinates = HighAccuracyFOVCalculator(
+                    image, unit_offsets).get_fov_bbox()
 
-            image.create_geojson_feature(image.properties)
+            with perf.span("geojson"):
+                image.create_geojson_feature(image.properties)
+            if config.footprints_only:
+                return image
             # Generate GeoTIFF for the current image
-            image.generate_geotiff(indir_path, geotiff_dir,logger)
+            image.generate_geotiff(indir_path, geotiff_dir, logger)
+        return image
+
+    except (TypeError, KeyError, ValueError) as error:
+        log_image_error(error, image, image.metadata)
+    return None
+
+
+def process_image_task(image: ImageDrone, unit_offsets: np.ndarray, open_elevations: dict, indir_path: str,
+                       geotiff_dir: str) -> tuple:
+    """
+    Pool entry point: process one image and report the cumulative counters of the executing process.
+
+    Args:
+        open_elevations (dict): Prefetched elevation service results for the points of the image, or None.
+
+    Returns:
+        tuple: (ImageDrone or None, process id, counters dict).
+    """
+    add_open_elevations(open_elevations)
+    image = process_image(image, unit_offsets, indir_path, geotiff_dir)
+    return image, os.getpid(), collect_process_stats()
+
+
+def collect_process_stats() -> dict:
+    """Cumulative performance counters of the current process, grouped by component."""
+    stats = dict(elevation=elevation_stats(), declination=declination_stats(), open_elevation=open_elevation_stats())
+    if not config.footprints_only:
+        from Utils.lens_correction import lens_stats
+        stats["lens"] = lens_stats()
+    return stats
+
+
+def merge_process_stats(stats_by_process: dict) -> dict:
+    """Sum the latest counters reported by each process into mission totals."""
+    merged = {}
+    for stats in stats_by_process.values():
+        for component, counters in stats.items():
+            totals = merged.setdefault(component, {})
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+    return merged
+
 
-            feature_collection["features"].append(image.feature_point)
-            feature_collection["features"].append(image.feature_polygon)
+def log_process_stats(stats: dict):
+    """Log the mission totals of the performance counters."""
+    elevation = stats.get("elevation")
+    if elevation:
+        logger.info(f"DSM elevation source: {elevation['hits']} point queries served from memory, "
+                    f"{elevation['out_of_bounds']} outside the DSM, {elevation['sample_time']:.3f}s sampling, "
+                    f"loaded by {elevation['loads']} process(es) in {elevation['load_time']:.2f}s.")
+    declination = stats.get("declination")
+    if declination:
+        logger.info(f"Magnetic declination: {declination['misses']} grid cells computed offline, "
+                    f"{declination['hits']} lookups served from cache.")
+    lens = stats.get("lens")
+    if lens:
+        lookups = lens['hits'] + lens['misses']
+        logger.info(f"Lens correction: {lens['misses']} undistortion maps computed, {lens['hits']} reused "
+                    f"(hit rate {lens['hits'] / lookups:.0%}).")
+    open_elevation = stats.get("open_elevation")
+    if open_elevation:
+        logger.info(f"Elevation service: {open_elevation['requests']} batched requests "
+                    f"({open_elevation['failures']} failed), {open_elevation['hits']} lookups answered, "
+                    f"{open_elevation['misses']} without elevation.")
+        if "cache_hits" in open_elevation:
+            logger.info(f"Elevation cache: {open_elevation['cache_hits']} hits, "
+                        f"{open_elevation['cache_misses']} misses.")
 
-            # Update line coordinates for potential LineString creation
-            line_coordinates.append([image.longitude, image.latitude])
 
+def process_metadata(metadata: Iterable[list[dict]], indir_path:str, geotiff_dir:str, sensor_dimensions:dict,
+                     total: int = None, manifest: RunManifest = None,
+                     resume: bool = True, sinks=None) -> tuple[dict, list[ImageDrone]]:
+    """
+    Process and convert image metadata into GeoJSON features and create GeoTIFFs.
+
+    Metadata arrives in chunks (see Drone_Footprints.get_metadata); each chunk is processed as soon as it is
+    available, so the first images are processed while later ones are still being read. The footprint
+    geometry of a chunk is computed in one vectorized pass (footprint_engine). With config.workers > 1 the
+    per-image pipeline runs in a process pool that is kept across chunks and fed the next chunk before the
+    results of the current one are collected; results are merged back in the order of the metadata, so the
+    output is identical to a sequential run.
+
+    With a run manifest, every processed image is recorded as soon as it is complete, and images whose record
+    is complete and current (same source file, same output parameters, GeoTIFF present) are not processed
+    again; the GeoJSON and the footprint index (see Utils.footprint_index) are assembled from the records.
+
+    Args:
+        metadata (Iterable[list[dict]]): Metadata from each image file, in chunks. A single list of
+            metadata dictionaries is also accepted.
+        indir_path (Path): Input directory path containing the original images.
+        geotiff_dir (Path): Output directory path for saving generated GeoTIFFs.
+        sensor_dimensions (dict): A dictionary with sensor model keys and dimension values.
+        total (int): Number of images, for the progress bar; defaults to the length of a single list.
+        manifest (RunManifest): Run manifest of the output directory, or None.
+        resume (bool): Skip the images that the manifest records as complete.
+        sinks (FootprintSinks): Footprint outputs fed the record of each image as soon as it is complete
+            (see Utils.footprint_sinks), or None.
+
+    Returns:
+        tuple: A GeoJSON FeatureCollection comprising features derived from the image metadata, and the images
+        processed in this run.
+    """
+    if isinstance(metadata, list) and (not metadata or isinstance(metadata[0], dict)):
+        metadata = [metadata]
+        total = total if total is not None else len(metadata[0])
+    outer = tqdm(total=total,position=0,desc=f'{Color.CYAN}Image Files',leave=False)
+    pbar = tqdm(total=total, position=1, leave=False, bar_format='{desc}')
+    logger.info("Processing images for GeoTiff and GeoJSON creation.")
+    images_array : list[ImageDrone] = []
+
+    records = []
+    identities = {}
+    parameters = output_parameters_hash(sensor_dimensions)
+    stats_by_process = {}
+    worker = partial(process_image_task, indir_path=indir_path, geotiff_dir=geotiff_dir)
+    workers = config.workers if config.workers > 0 else os.cpu_count()
+    executor = None
+
+    def submit(chunk):
+        nonlocal executor
+        if not chunk:
+            return [], iter(())
+        images, unit_offsets = prepare_images(chunk, sensor_dimensions)
+        outer.update(len(chunk) - len(images))
+        open_elevations = [None] * len(images)
+        if config.global_elevation:
+            with perf.span("elevation_prefetch"):
+                points = prefetch_open_elevations(images, unit_offsets)
+            if workers > 1:
+                open_elevations = [open_elevation_subset(image_points) for image_points in points]
+        if workers <= 1:
+            return images, map(worker, images, unit_offsets, open_elevations)
+        if executor is None:
+            if config.dtm_path:
+                # Load (and, for large rasters, stage the memory-mapped copy of) the DSM once before forking.
+                get_elevation_source()
+            logger.info(f"Processing images with {Color.PURPLE}{workers} worker processes{Color.END}.")
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                           initargs=(config.get_settings(),
+                                                     getattr(logger_config, "current_log_path", None),
+                                                     open_elevation_snapshot()))
+        return images, executor.map(worker, images, unit_offsets, open_elevations)
+
+    def complete_record(data):
+        identities[data["SourceFile"]] = identity = source_identity(data)
+        return manifest.complete_record(identity, parameters) if manifest is not None and resume else None
+
+    def chunk_results(chunk):
+        done = [complete_record(data) for data in chunk]
+        images, processed = submit([data for data, record in zip(chunk, done) if record is None])
+        prepared = {id(image.metadata) for image in images}
+
+        def merged():
+            # Manifest records of complete images, in order with the results of the images processed.
+            for data, record in zip(chunk, done):
+                if record is not None:
+                    yield record
+                elif id(data) in prepared:
+                    yield next(processed)
+        return merged()
+
+    def results():
+        pending = deque()
+        for chunk in metadata:
+            pending.append(chunk_results(chunk))
+            # With a pool, the next chunk is queued before the results of the current one are collected.
+            while len(pending) > (1 if executor is not None else 0):
+                yield from pending.popleft()
+        for remaining in pending:
+            yield from remaining
+
+    try:
+        for result in results():
             outer.update(1)
+            if isinstance(result, dict):
+                # Complete in an earlier run.
+                records.append(result)
+                if sinks is not None:
+                    sinks.write(result)
+                continue
+            image, pid, process_stats = result
+            stats_by_process[pid] = process_stats
+            if image is None:
+                continue
+            images_array.append(image)
+            pbar.set_description_str(f'{Color.YELLOW}Current file: {image.file_name}{Color.END}')
+            record = image_record(image, identities[image.metadata["SourceFile"]], parameters)
+            if manifest is not None:
+                manifest.append(record)
+            records.append(record)
+            if sinks is not None:
+                sinks.write(record)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if manifest is not None:
+            manifest.close()
+    stats_by_process.setdefault(os.getpid(), collect_process_stats())
+    log_process_stats(merge_process_stats(stats_by_process))
+    skipped = len(records) - len(images_array)
+    if skipped:
+        logger.info(f"{Color.PURPLE}{skipped} images{Color.END} were already complete in the run manifest.")
+    if manifest is not None:
+        manifest.compact(order=[record["path"] for record in records])
+        write_index(records, manifest.path.parent)
+
+    pbar.close()
+    outer.close()
+    return mission_feature_collection(records), images_array
+
+
+def mission_feature_collection(records: list[dict]) -> dict:
+    """
+    Assemble the mission GeoJSON from the manifest records of its images (see Utils.run_manifest).
+
+    The collection starts with the flight line, whose properties describe the mission, followed by the point
+    and footprint polygon of each image in the order of the records.
+
+    Args:
+        records (list[dict]): Manifest records of the images, in capture order.
+
+    Returns:
+        dict: A GeoJSON FeatureCollection.
+    """
+    feature_collection = {"type": "FeatureCollection", "features": []}
+    line_coordinates = []
+    for record in records:
+        feature_collection["features"].append(record["point"])
+        feature_collection["features"].append(record["polygon"])
+        # Update line coordinates for potential LineString creation
+        line_coordinates.append([record["longitude"], record["latitude"]])
 
-        except TypeError as t:
-            file_name = image.file_name if image is not None else data.get('SourceFile', 'unknown')
-            logger.exception(f"Missing metadata key: {t} for image: {file_name}")
-        except KeyError as k:
-            file_name = image.file_name if image is not None else data.get('SourceFile', 'unknown')
-            logger.exception(f"Missing metadata key: {k} for image: {file_name}")
-        except ValueError as e:
-            file_name = image.file_name if image is not None else data.get('SourceFile', 'unknown')
-            logger.exception(f"Invalid value for metadata key: {e} for image: {file_name}")
-        nb_processed_images = nb_processed_images + 1
-
-    # Add lines to the GeoJSON feature collection if necessary
-    drone_props = config.drone_properties
-    # print("Drone Props", Drone_props)
-    # exit()
     now = datetime.datetime.now()
     process_date = f"{now.strftime('%Y-%m-%d %H-%M')}"
     line_geometry = dict(type="LineString", coordinates=line_coordinates)
+    last = records[-1] if records else {}
+    datetime_original = last.get("datetime_original", "")
+    epsg = last.get("epsg", config.epsg_code)
+    cog = last.get("cog", config.cog)
 
-    same_drone_for_all_images : bool = None
     ### Compare drone_data for all images
-    for a , b in itertools.combinations(images_array, 2):
-        if not same_drone_for_all_images:
-            same_drone_for_all_images = a.drone_hash == b.drone_hash 
-        else:
-            same_drone_for_all_images = a.drone_hash == b.drone_hash == same_drone_for_all_images
-
-
-    mission_props = dict(date=datetime_original, Process_date=process_date, epsg=config.epsg_code,
-                             cog=config.cog, drone_model=image.drone_model,
-                             sensor_make=image.sensor_model)
-
-    if not same_drone_for_all_images and image.sensor_model != "M3M":
-        mission_props = dict(date=datetime_original, Process_date=process_date, epsg=config.epsg_code,
-                             cog=config.cog, drone_model="Multiple", sensor_make="Multiple") 
-
-
-    # # multiple drones and Mavic 3 Multispectral
-    # if False in same_drone_as_previous_image_array and drone_props['SensorModel'] == "M3M":
-    #     mission_props = dict(date=datetime_original, Process_date=process_date, epsg=config.epsg_code,
-    #                          cog=config.cog, drone_model=drone_props['DroneModel'],
-    #                          sensor_make=drone_props['SensorModel'])
-    # # multiple drones and not Mavic 3 Multispectral
-    # elif False in same_drone_as_previous_image_array:
-    #     mission_props = dict(date=datetime_original, Process_date=process_date, epsg=config.epsg_code,
-    #                          cog=config.cog, drone_model="Multiple", sensor_make="Multiple")
-    #     # only one drone
-    # else:
-    #     mission_props = dict(date=datetime_original, Process_date=process_date, epsg=config.epsg_code,
-    #                          cog=config.cog, drone_model=drone_props['DroneModel'],
-    #                          sensor_make=drone_props['SensorModel'])
+    same_drone_for_all_images = len({json.dumps(record["drone"]) for record in records}) <= 1
+
+    mission_props = dict(date=datetime_original, Process_date=process_date, epsg=epsg,
+                             cog=cog, drone_model=last.get("drone_model"),
+                             sensor_make=last.get("sensor_model"))
+
+    if not same_drone_for_all_images and last.get("sensor_model") != "M3M":
+        mission_props = dict(date=datetime_original, Process_date=process_date, epsg=epsg,
+                             cog=cog, drone_model="Multiple", sensor_make="Multiple")
 
     line_feature = dict(type="Feature", geometry=line_geometry, properties=mission_props)
     feature_collection["features"].insert(0, line_feature)
+    return feature_collection
+
 
-    pbar.close()
-    outer.close()
-    return feature_collection, images_array
@@ -4,230 +4,174 @@
 #  __version__ = "1.0"
 
 
+import math
 import numpy as np
-from mpmath import mp, radians, sqrt
-import quaternion
 from loguru import logger
-from vector3d.vector import Vector
-from Utils.geospatial_conversions import find_geodetic_intersections, gps_to_utm, translate_to_wgs84, utm_to_latlon
-from Utils.new_elevation import get_altitude_at_point, get_altitude_from_open, get_altitudes_from_open
+from footprint_engine import image_ground_offsets
+from Utils.geospatial_conversions import find_geodetic_intersections, gps_to_utm, translate_to_wgs84, utm_points_to_latlon
+from Utils.new_elevation import get_altitude_at_point, get_altitude_from_open, get_altitudes_from_open, \
+    get_open_elevation_table
 from Utils import config
+from Utils import perf
 from imagedrone import ImageDrone
 
-latitude = 0
-longitude = 0
-lens_FOVh = 0.0
-lens_FOVw = 0.0
-mp.dps = 50  # set a higher precision
-
 
 class HighAccuracyFOVCalculator:
-    def __init__(self,image:ImageDrone):
-
-        global latitude, longitude, lens_FOVh, lens_FOVw
+    def __init__(self, image:ImageDrone, unit_offsets=None):
+        # All per-image state is read from the image itself so that calculators can run in parallel processes.
         self.image = image
         self.drone_gps = (image.latitude, image.longitude)
-        latitude = image.latitude
-        longitude = image.longitude
-
-        lens_FOVh = self.image.lens_FOV_height
-        lens_FOVw = self.image.lens_FOV_width
-
-    def calculate_fov_dimensions(self):
-        FOVw = 2 * mp.atan(mp.mpf(self.image.sensor_width) / (2 * self.image.focal_length))
-        FOVh = 2 * mp.atan(mp.mpf(self.image.sensor_height) / (2 * self.image.focal_length))
-
-        # _sensor_lens_correction now inside this function
-        corrected_fov_width = FOVw * lens_FOVw
-        corrected_fov_height = FOVh * lens_FOVh
+        self.latitude = image.latitude
+        self.longitude = image.longitude
+        self.file_name = image.file_name
 
-        return corrected_fov_width, corrected_fov_height
+        self.lens_FOVh = self.image.lens_FOV_height
+        self.lens_FOVw = self.image.lens_FOV_width
+        # Footprint corner offsets for a 1 m height, normally computed for the whole flight at once by
+        # footprint_engine.image_ground_offsets; computed on demand when not provided.
+        self.unit_offsets = unit_offsets
 
-
-    @staticmethod
-    def calculate_rads_from_angles(gimbal_yaw_deg, gimbal_pitch_deg, gimbal_roll_deg, declination):
+    def get_unit_ground_offsets(self):
         """
-        Adjusts the gimbal's angles for magnetic declination and normalizes the roll orientation.
-        - Yaw is adjusted for magnetic declination.
-        - Roll is normalized if within a specific range to handle edge cases around 90 degrees.
-        - Pitch is converted directly to radians.
-
-        Parameters:
-        - gimbal_yaw_deg (float): The gimbal's yaw angle in degrees.
-        - gimbal_pitch_deg (float): The gimbal's pitch angle in degrees.
-        - gimbal_roll_deg (float): The gimbal's roll angle in degrees.
-        - declination (float): Magnetic declination in degrees.
+        Footprint corner offsets (east, north) in meters for a camera 1 m above the ground.
 
         Returns:
-        - tuple: Adjusted yaw, pitch, and roll angles in radians.
-        """
-        # Normalize yaw for magnetic declination
-        if -120 <= gimbal_pitch_deg <= -60:
-            pitch_rad = radians(90 - gimbal_pitch_deg)
-        else:
-            pitch_rad = radians(180 - gimbal_pitch_deg)
-
-        if config.correct_magnetic_declinaison:
-            yaw_rad = (mp.pi / 2) - radians(gimbal_yaw_deg + declination)
-        else:
-            yaw_rad = (mp.pi / 2) - radians(gimbal_yaw_deg)
-        yaw_rad = yaw_rad % (2 * mp.pi)
-        roll_rad = radians(gimbal_roll_deg)
-
-        return yaw_rad, pitch_rad, roll_rad
-
-    def get_bounding_polygon(self, FOVh, FOVv):
+            numpy.ndarray: Array of shape (4, 2).
         """
-        Calculates the bounding polygon of a camera's footprint given its field of view, position, and orientation.
+        if self.unit_offsets is None:
+            self.image.find_declination()
+            self.unit_offsets = image_ground_offsets(
+                [self.image], correct_declination=config.correct_magnetic_declinaison)[0]
+        return self.unit_offsets
 
-        Parameters:
-            FOVh (float): The horizontal field of view in radians.
-            FOVv (float): The vertical field of view in radians.
-            altitude (float): The altitude above ground in meters.
-            roll (float): The roll angle in radians.
-            pitch (float): The pitch angle in radians.
-            yaw (float): The yaw angle in radians.
-
-        Returns:
-            list: A list of Vector objects representing the corners of the bounding polygon on the ground.
+    def get_ground_altitude(self, utmx, utmy, warn=True):
         """
+        Height of the drone above the ground below it, corrected for atmospheric refraction.
 
-        # Define camera rays based on field of view
-        rays = [
-            Vector(-mp.tan(FOVv / 2), mp.tan(FOVh / 2), 1).normalize(),  # Flip horizontally
-            Vector(-mp.tan(FOVv / 2), -mp.tan(FOVh / 2), 1).normalize(),  # Flip horizontally
-            Vector(mp.tan(FOVv / 2), -mp.tan(FOVh / 2), 1).normalize(),  # Flip horizontally
-            Vector(mp.tan(FOVv / 2), mp.tan(FOVh / 2), 1).normalize()  # Flip horizontally
-        ]
-        # Rotate rays according to camera orientation
-        rotated_vectors = self.rotate_rays(rays)
-
-        return rotated_vectors
-
-    def rotate_rays(self, rays):
-        # Calculate adjusted angles for gimbal and flight orientations
-        self.image.find_declination()
-        declination = self.image.declination
-
-        adj_yaw, adj_pitch, adj_roll = self.calculate_rads_from_angles(self.image.gimbal_yaw_degree,
-                                                                       self.image.gimbal_pitch_degree,
-                                                                       self.image.gimbal_roll_degree,
-                                                                       declination)
-
-        q = quaternion.from_euler_angles(adj_yaw, adj_pitch, adj_roll)
-        # Normalize the quaternion
-        q = q.normalized()
-
-        # Apply rotation to each ray
-        return [Vector(*(q * np.quaternion(0, ray.x, ray.y, ray.z) * q.inverse()).vec) for ray in rays]
+        Uses, in order of preference, the absolute ground reference, the DSM and the elevation service, and
+        falls back to the drone's relative altitude.
+        """
+        new_altitude = None
+        if config.absolute_ground is not None:
+            new_altitude = self.image.absolute_altitude - config.absolute_ground
+        elif config.dtm_path:
+            new_altitude = get_altitude_at_point(utmx, utmy, self.image.absolute_altitude, self.file_name)
+        elif config.global_elevation:
+            new_altitude = get_altitude_from_open(self.latitude, self.longitude, self.image.absolute_altitude,
+                                                  self.file_name)
+
+        if new_altitude is None:
+            new_altitude = self.image.relative_altitude
+            if warn and (config.global_elevation or config.dtm_path):
+                logger.warning(f"Failed to get elevation for {self.file_name}, using drone altitude.")
+
+        return self._atmospheric_refraction_correction(new_altitude)
+
+    def get_footprint_utm(self, corrected_altitude):
+        """
+        Footprint corners as (easting, northing) pairs in the UTM zone of the drone.
+        """
+        elevation_bbox = HighAccuracyFOVCalculator.get_ray_ground_intersections(self.get_unit_ground_offsets(),
+                                                                                float(corrected_altitude))
+        return find_geodetic_intersections(elevation_bbox, self.longitude, self.latitude)
 
     def get_fov_bbox(self):
         try:
-            FOVw, FOVh = self.calculate_fov_dimensions()
-            rotated_vectors = self.get_bounding_polygon(FOVw, FOVh)
-            utmx, utmy, zone_number, zone_letter = gps_to_utm(latitude, longitude)
-            new_altitude = None
-            if config.absolute_ground is not None:
-                new_altitude = config.absolute_altitude - config.absolute_ground
-            elif config.dtm_path:
-                new_altitude = get_altitude_at_point(utmx, utmy)
-            elif config.global_elevation:
-                new_altitude = get_altitude_from_open(latitude, longitude)
-
-            if new_altitude is None:
-                new_altitude = config.relative_altitude
-                if config.global_elevation or config.dtm_path:
-                    logger.warning(f"Failed to get elevation for {config.im_file_name}, using drone altitude.")
-
-            corrected_altitude = self._atmospheric_refraction_correction(new_altitude)
-
-            elevation_bbox = HighAccuracyFOVCalculator.get_ray_ground_intersections(rotated_vectors, Vector(0, 0, float(
-                corrected_altitude)))
-            translated_bbox = find_geodetic_intersections(elevation_bbox, longitude, latitude)
+            utmx, utmy, zone_number, zone_letter = gps_to_utm(self.latitude, self.longitude)
+            with perf.span("elevation"):
+                corrected_altitude = self.get_ground_altitude(utmx, utmy)
+            translated_bbox = self.get_footprint_utm(corrected_altitude)
             self.image.center_distance = drone_distance_to_polygon_center(translated_bbox, (utmx, utmy), corrected_altitude)
             new_translated_bbox = translated_bbox
             if config.dtm_path:
-                altitudes = [get_altitude_at_point(*box[:2]) for box in new_translated_bbox]
+                with perf.span("elevation"):
+                    altitudes = [get_altitude_at_point(*box[:2], self.image.absolute_altitude, self.file_name)
+                                 for box in new_translated_bbox]
                 if None in altitudes:
                     logger.warning(
-                        f"Failed to get elevation for image {config.im_file_name}. See log for details.")
-                    return translate_to_wgs84(new_translated_bbox, longitude, latitude)
+                        f"Failed to get elevation for image {self.file_name}. See log for details.")
+                    return translate_to_wgs84(new_translated_bbox, self.longitude, self.latitude)
 
                 # Calculate the ratios of distances to check the 5 times condition
-                distances = [sqrt((new_translated_bbox[(i + 1) % len(new_translated_bbox)][0] - box[0]) ** 2 +
+                distances = [math.sqrt((new_translated_bbox[(i + 1) % len(new_translated_bbox)][0] - box[0]) ** 2 +
                                   (new_translated_bbox[(i + 1) % len(new_translated_bbox)][1] - box[1]) ** 2)
                              for i, box in enumerate(new_translated_bbox)]
                 for dist in distances:
                     if any(other_dist * 6 < dist for other_dist in distances if other_dist != dist):
                         logger.warning(
-                            f"One side of the polygon for {config.im_file_name} is at least 5 times longer than another.")
-                        return translate_to_wgs84(new_translated_bbox, longitude, latitude)
+                            f"One side of the polygon for {self.file_name} is at least 5 times longer than another.")
+                        return translate_to_wgs84(new_translated_bbox, self.longitude, self.latitude)
 
             if config.global_elevation is True:
-                trans_utmbox = [utm_to_latlon(box[0], box[1], zone_number, zone_letter) for box in new_translated_bbox]
-                altitudes = get_altitudes_from_open(trans_utmbox)
+                trans_utmbox = utm_points_to_latlon(new_translated_bbox, self.longitude, self.latitude)
+                with perf.span("elevation"):
+                    altitudes = get_altitudes_from_open(trans_utmbox, self.image.absolute_altitude, self.file_name)
 
-                if None in altitudes:
-                    logger.warning(f"Failed to get elevation at point for {config.im_file_name}.")
-                    return translate_to_wgs84(new_translated_bbox, longitude, latitude)
+                if altitudes is None:
+                    logger.warning(f"Failed to get elevation at point for {self.file_name}.")
+                    return translate_to_wgs84(new_translated_bbox, self.longitude, self.latitude)
 
                 # Calculate the ratios of distances to check the 5 times condition
-                distances = [sqrt((new_translated_bbox[(i + 1) % len(new_translated_bbox)][0] - box[0]) ** 2 +
+                distances = [math.sqrt((new_translated_bbox[(i + 1) % len(new_translated_bbox)][0] - box[0]) ** 2 +
                                   (new_translated_bbox[(i + 1) % len(new_translated_bbox)][1] - box[1]) ** 2)
                              for i, box in enumerate(new_translated_bbox)]
                 for dist in distances:
                     if any(other_dist * 5 < dist for other_dist in distances if other_dist != dist):
                         logger.warning(
-                            f"One side of the polygon for {config.im_file_name} is at least 5 times longer than another.")
-                        return translate_to_wgs84(new_translated_bbox, longitude, latitude)
+                            f"One side of the polygon for {self.file_name} is at least 5 times longer than another.")
+                        return translate_to_wgs84(new_translated_bbox, self.longitude, self.latitude)
 
             # If no special conditions are met, process normally
-            return translate_to_wgs84(new_translated_bbox, longitude, latitude)
+            return translate_to_wgs84(new_translated_bbox, self.longitude, self.latitude)
 
         except Exception as e:
             logger.warning(f"Error in get_fov_bbox: {e}")
             return None, None
 
     @staticmethod
-    def get_ray_ground_intersections(rays, origin):
+    def get_ray_ground_intersections(unit_offsets, altitude):
         """
-        Calculates the intersection points of the given rays with the ground plane.
+        Scales the footprint corner offsets of a camera 1 m above the ground to the given height.
 
         Parameters:
-            rays (list): A list of Vector objects representing the rays.
-            origin (Vector): The origin point of the rays.
+            unit_offsets (numpy.ndarray): Corner offsets (east, north) for a 1 m height, shape (4, 2).
+            altitude (float): Height of the camera above the ground plane in meters.
 
         Returns:
-            list: A list of Vector objects representing the intersection points on the ground.
+            numpy.ndarray: The ground intersections; corners whose ray is parallel to the ground are dropped.
         """
+        intersections = np.asarray(unit_offsets) * altitude
+        return intersections[~np.isnan(intersections).any(axis=1)]
 
-        intersections = [HighAccuracyFOVCalculator.find_ray_ground_intersection(ray, origin) for ray in rays if
-                         HighAccuracyFOVCalculator.find_ray_ground_intersection(ray, origin) is not None]
-
-        return intersections
-
-    @staticmethod
-    def find_ray_ground_intersection(ray, origin):
-        """
-        Finds the intersection point of a single ray with the ground plane.
+    def _atmospheric_refraction_correction(self, altitude):
+        return altitude + (altitude * 0.0001)
 
-        Parameters:
-            ray (Vector): The ray vector.
-            origin (Vector): The origin point of the ray.
 
-        Returns:
-            Vector: The intersection point with the ground, or None if the ray is parallel to the ground.
-        """
+def prefetch_open_elevations(images:list[ImageDrone], unit_offsets) -> list[list[tuple]]:
+    """
+    Fetch the terrain elevations of a batch of images from the elevation service in batched requests.
 
-        if ray.z == 0:  # Ray is parallel to ground
-            return None
+    Image centres are fetched first; footprint corners are then predicted from the centre elevations exactly
+    as get_fov_bbox computes them, so the per-image calculations are answered from the prefetched table.
 
-        # Calculate intersection parameter t
-        t = -origin.z / ray.z
-        return Vector(origin.x + ray.x * t, origin.y + ray.y * t, 0)
+    Parameters:
+    - images (list[ImageDrone]): Images of the mission.
+    - unit_offsets (numpy.ndarray): Footprint corner offsets of the images for a 1 m height.
 
-    def _atmospheric_refraction_correction(self, altitude):
-        return altitude + (altitude * 0.0001)
+    Returns:
+    - list[list[tuple]]: The (lat, lon) points queried by each image.
+    """
+    table = get_open_elevation_table()
+    centres = [(image.latitude, image.longitude) for image in images]
+    table.prefetch(centres)
+    points = []
+    for image, offsets, centre in zip(images, unit_offsets, centres):
+        calculator = HighAccuracyFOVCalculator(image, offsets)
+        utmx, utmy, _, _ = gps_to_utm(calculator.latitude, calculator.longitude)
+        footprint = calculator.get_footprint_utm(calculator.get_ground_altitude(utmx, utmy, warn=False))
+        points.append([centre] + utm_points_to_latlon(footprint, calculator.longitude, calculator.latitude))
+    table.prefetch([point for image_points in points for point in image_points[1:]])
+    return points
 
 
 def calculate_centroid(polygon_coords):
@@ -243,7 +187,7 @@ def calculate_centroid(polygon_coords):
 
 def distance_3d(point1, point2):
     """Calculate the 3D distance between two points in UTM coordinates."""
-    return sqrt((point1[0] - point2[0]) ** 2 + (point1[1] - point2[1]) ** 2 + (point1[2] - point2[2]) ** 2)
+    return math.sqrt((point1[0] - point2[0]) ** 2 + (point1[1] - point2[1]) ** 2 + (point1[2] - point2[2]) ** 2)
 
 
 def drone_distance_to_polygon_center(polygon_coords, drone_coords, drone_altitude):
@@ -262,7 +206,4 @@ def drone_distance_to_polygon_center(polygon_coords, drone_coords, drone_altitud
     centroid = calculate_centroid(polygon_coords)
     centroid_3d = (centroid[0], centroid[1], 0)
     drone_position_3d = (drone_coords[0], drone_coords[1], drone_altitude)
-    center_distance=distance_3d(centroid_3d, drone_position_3d)
-    config.update_center_distance(center_distance)
-    return center_distance
-    # Calculate and return the 3D distance
+    return distance_3d(centroid_3d, drone_position_3d)
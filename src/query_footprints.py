@@ -0,0 +1,44 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+"""
+Query the footprint index of a processed mission: which images cover a point or a bounding box, and for a point,
+at which source pixel.
+
+Usage:
+    python query_footprints.py -o OUTPUT_DIRECTORY --point LONGITUDE LATITUDE
+    python query_footprints.py -o OUTPUT_DIRECTORY --bbox MIN_LONGITUDE MIN_LATITUDE MAX_LONGITUDE MAX_LATITUDE
+
+The matches are printed as a JSON list.
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output_directory", required=True,
+                        help="Output directory of the mission, holding footprint_index.npz.")
+    query = parser.add_mutually_exclusive_group(required=True)
+    query.add_argument("--point", type=float, nargs=2, metavar=("LONGITUDE", "LATITUDE"),
+                       help="Images covering a WGS84 point, with the source pixel of the point.")
+    query.add_argument("--bbox", type=float, nargs=4,
+                       metavar=("MIN_LONGITUDE", "MIN_LATITUDE", "MAX_LONGITUDE", "MAX_LATITUDE"),
+                       help="Images whose footprint intersects a WGS84 bounding box.")
+    args = parser.parse_args()
+
+    from Utils.footprint_index import FootprintIndex, INDEX_FILE_NAME
+    if not (Path(args.output_directory) / INDEX_FILE_NAME).is_file():
+        sys.exit(f"No {INDEX_FILE_NAME} in {args.output_directory}; process the mission first.")
+    index = FootprintIndex(args.output_directory)
+    matches = index.query_point(*args.point) if args.point else index.query_bbox(*args.bbox)
+    print(json.dumps(matches, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+from check_footprint_engine import TOLERANCE, worst_corner_error
+
+
+def test_engine_matches_former_implementation():
+    assert worst_corner_error(poses=200) <= TOLERANCE
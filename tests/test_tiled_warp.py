@@ -0,0 +1,34 @@
+#  Copyright (c) 2024.
+#  __author__ = "Dean Hand"
+#  __license__ = "AGPL"
+#  __version__ = "1.0"
+
+import cv2
+import pytest
+
+from Utils import config
+from Utils.raster_utils import DECODE_SCALES
+from check_tiled_warp import EPSG, compare, synthetic_frame
+
+# The frame of the check script: every decode scale divides it, and the reduced JPEG decodes of OpenCV and GDAL
+# agree within the tolerance on it.
+WIDTH, HEIGHT = 2400, 1600
+
+
+@pytest.fixture
+def output_crs():
+    config.update_epsg(EPSG)
+    yield
+    config.update_epsg(4326)
+    config.update_downscale(1)
+
+
+@pytest.mark.parametrize("scale", sorted(DECODE_SCALES))
+@pytest.mark.parametrize("suffix", [".tif", ".jpg"])
+def test_tiled_warp_matches_whole_frame(tmp_path, output_crs, suffix, scale):
+    image_file = tmp_path / f"frame{suffix}"
+    cv2.imwrite(str(image_file), synthetic_frame(WIDTH, HEIGHT))
+    config.update_downscale(scale)
+    largest, over, coverage, rim = compare(image_file, scale, tmp_path)
+    assert over == 0, f"{over} pixels differ by more than the tolerance (up to {largest} DN)"
+    assert coverage == 0, f"{coverage} pixels inside the footprint are covered by one warp only"